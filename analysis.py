@@ -0,0 +1,242 @@
+# encoding: utf-8
+
+# Copyright (c) 2015-2019 Stanford Research Systems
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnshished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+
+""" Online analysis of decoded stream blocks, for runs that only need reduced results.
+
+        StreamAnalysis takes the sample blocks as they are decoded and keeps, per channel:
+          a decimated copy of the stream, from a cascade of FIR low-pass stages
+          running mean, standard deviation, RMS, min and max
+          the mean, min and max of each summary interval (the envelope)
+          a Welch averaged power spectral density
+        The results are rewritten to a small JSON summary file every t_flush seconds. It holds
+        only the last INTERVALS_KEPT intervals; every interval is appended, one JSON line each,
+        to name_intervals.jsonl next to it.
+        Needs numpy.
+"""
+import collections
+import json
+import os
+import time
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    np = None               #pylint: disable=invalid-name
+
+
+WELCH_NPERSEG = 1024        # samples per Welch segment. Bins are rate/WELCH_NPERSEG wide
+TAPS_PER_FACTOR = 8         # FIR taps per unit of stage decimation
+INTERVALS_KEPT = 120        # intervals in the summary file, 10 minutes at the default t_flush
+
+
+def stage_factors(i_decimate):
+    """ split the total decimation into stages of 4, then 2, then whatever is left
+    """
+    lst_factors = []
+    for i_factor in (4, 2):
+        while i_decimate % i_factor == 0 and i_decimate > 1:
+            lst_factors.append(i_factor)
+            i_decimate //= i_factor
+    if i_decimate > 1:
+        lst_factors.append(i_decimate)
+    return lst_factors
+
+
+class DecimatorStage:
+    """ One windowed-sinc low-pass FIR followed by keeping every i_factor-th output.
+        The filter history and the decimation phase carry over from block to block, so
+        the output does not depend on how the stream was cut into blocks.
+    """
+    def __init__(self, i_factor, count_vars):
+        count_taps = TAPS_PER_FACTOR*i_factor + 1
+        n = np.arange(count_taps) - (count_taps-1)/2
+        # cutoff at 0.4 of the output rate
+        taps = np.sinc(0.8*n/i_factor) * np.hamming(count_taps)
+        self.taps = taps[::-1] / taps.sum()
+        self.i_factor = i_factor
+        self.hist = None
+        self.count_vars = count_vars
+        self.i_phase = 0                # index in the next block of the next sample to keep
+
+    def process(self, block):
+        """ filter and decimate a (samples, channels) block. return the kept outputs
+        """
+        if self.hist is None:           # start from a steady state instead of zeros
+            self.hist = np.repeat(block[:1], len(self.taps)-1, axis=0)
+        x = np.concatenate([self.hist, block])
+        windows = sliding_window_view(x, len(self.taps), axis=0)[self.i_phase::self.i_factor]
+        self.i_phase = (self.i_phase - len(block)) % self.i_factor
+        self.hist = x[len(x)-len(self.taps)+1:]
+        return windows @ self.taps
+
+
+class StreamAnalysis:      #pylint: disable=too-many-instance-attributes
+    """ Incremental statistics and spectra over decoded blocks.
+        s_channels is the streamed channels ("X", "XY", "RT" or "XYRT"). When X and Y are
+        streamed without R, R and theta (degrees) are derived and analyzed as well.
+        sink_decimated, if given, gets the decimated blocks, one column per name in
+        lst_names, through its write() method.
+    """
+    def __init__(self, f_name, s_channels, f_rate, i_decimate=1024, sink_decimated=None, t_flush=5.0, i_nperseg=WELCH_NPERSEG):   #pylint: disable=too-many-arguments, line-too-long
+        self.f_name = f_name
+        self.s_channels = s_channels.upper()
+        self.b_derive = 'X' in self.s_channels and 'Y' in self.s_channels and 'R' not in self.s_channels   #pylint: disable=line-too-long
+        self.lst_names = list(self.s_channels) + (['R', 'T'] if self.b_derive else [])
+        count_vars = len(self.lst_names)
+        self.f_rate = f_rate
+        self.i_decimate = i_decimate
+        self.lst_stages = [DecimatorStage(i_factor, count_vars) for i_factor in stage_factors(i_decimate)]   #pylint: disable=line-too-long
+        self.sink_decimated = sink_decimated
+        self.t_flush = t_flush
+        self.t_last_flush = time.perf_counter()
+        # running moments, combined block by block (Chan et al.)
+        self.count = 0
+        self.mean = np.zeros(count_vars)
+        self.m2 = np.zeros(count_vars)
+        self.vmin = np.full(count_vars, np.inf)
+        self.vmax = np.full(count_vars, -np.inf)
+        # the current summary interval
+        self.interval = None
+        self.lst_intervals = collections.deque(maxlen=INTERVALS_KEPT)
+        self.f_intervals = os.path.splitext(f_name)[0] + '_intervals.jsonl'
+        self.f_ptr_intervals = None
+        # Welch
+        self.i_nperseg = i_nperseg
+        self.window = np.hanning(i_nperseg)
+        self.tail = np.zeros((0, count_vars))
+        self.psd_sum = np.zeros((count_vars, i_nperseg//2 + 1))
+        self.count_segments = 0
+
+    def write(self, samples):
+        """ add a decoded block: a (samples, channels) array. None is ignored.
+        """
+        if samples is None or not len(samples):     #pylint: disable=len-as-condition
+            return
+        block = np.asarray(samples, dtype=np.float64)
+        if self.b_derive:
+            x, y = block[:, self.s_channels.index('X')], block[:, self.s_channels.index('Y')]
+            block = np.column_stack([block, np.hypot(x, y), np.degrees(np.arctan2(y, x))])
+        self._moments(block)
+        self._welch(block)
+        decimated = block
+        for stage in self.lst_stages:
+            decimated = stage.process(decimated)
+        if self.sink_decimated is not None and len(decimated):
+            self.sink_decimated.write(decimated)
+        if time.perf_counter() - self.t_last_flush > self.t_flush:
+            self.flush()
+
+    def _moments(self, block):
+        count_block = len(block)
+        mean_block = block.mean(axis=0)
+        m2_block = ((block - mean_block)**2).sum(axis=0)
+        min_block, max_block = block.min(axis=0), block.max(axis=0)
+        delta = mean_block - self.mean
+        count_total = self.count + count_block
+        self.m2 += m2_block + delta**2*self.count*count_block/count_total
+        self.mean += delta*count_block/count_total
+        self.count = count_total
+        self.vmin = np.minimum(self.vmin, min_block)
+        self.vmax = np.maximum(self.vmax, max_block)
+        if self.interval is None:
+            self.interval = {'first': self.count - count_block, 'count': 0,
+                             'sum': np.zeros_like(mean_block), 'min': min_block, 'max': max_block}
+        self.interval['count'] += count_block
+        self.interval['sum'] += mean_block*count_block
+        self.interval['min'] = np.minimum(self.interval['min'], min_block)
+        self.interval['max'] = np.maximum(self.interval['max'], max_block)
+
+    def _welch(self, block):
+        i_step = self.i_nperseg // 2            # 50% overlap
+        x = np.concatenate([self.tail, block])
+        count_segs = (len(x) - self.i_nperseg)//i_step + 1 if len(x) >= self.i_nperseg else 0
+        if count_segs:
+            frames = sliding_window_view(x, self.i_nperseg, axis=0)[:count_segs*i_step:i_step]
+            frames = frames - frames.mean(axis=-1, keepdims=True)
+            spectra = np.fft.rfft(frames*self.window, axis=-1)
+            self.psd_sum += (spectra.real**2 + spectra.imag**2).sum(axis=0)
+            self.count_segments += count_segs
+        self.tail = x[count_segs*i_step:]
+
+    def psd(self):
+        """ return the one-sided power spectral density, (channels, bins) in units^2/Hz
+        """
+        if not self.count_segments:
+            return self.psd_sum
+        psd = self.psd_sum / (self.count_segments * self.f_rate * (self.window**2).sum())
+        psd[:, 1:-1] *= 2
+        return psd
+
+    def summary(self):
+        """ return the results so far as a dict ready for JSON
+        """
+        std = np.sqrt(self.m2/self.count) if self.count else self.m2
+        rms = np.sqrt(std**2 + self.mean**2)
+        dict_stats = {s_name: {'mean': self.mean[i], 'std': std[i], 'rms': rms[i],
+                               'min': self.vmin[i], 'max': self.vmax[i]}
+                      for i, s_name in enumerate(self.lst_names)}
+        psd = self.psd()
+        return {'channels': self.lst_names,
+                'rate': self.f_rate,
+                'samples': self.count,
+                'decimate': self.i_decimate,
+                'stats': {k: {s: float(v) for s, v in d.items()} for k, d in dict_stats.items()},
+                'intervals': list(self.lst_intervals),
+                'intervals_file': self.f_intervals,
+                'psd': {'df': self.f_rate/self.i_nperseg,
+                        'averages': self.count_segments,
+                        'density': {s_name: psd[i].tolist() for i, s_name in enumerate(self.lst_names)}}}   #pylint: disable=line-too-long
+
+    def flush(self):
+        """ close the current summary interval, append it to the intervals file and rewrite
+            the summary file
+        """
+        if self.interval is not None:
+            dict_interval = {'first': self.interval['first'],
+                             'count': self.interval['count'],
+                             'time': time.time(),
+                             'mean': (self.interval['sum']/self.interval['count']).tolist(),
+                             'min': self.interval['min'].tolist(),
+                             'max': self.interval['max'].tolist()}
+            self.lst_intervals.append(dict_interval)
+            if self.f_ptr_intervals is None:
+                self.f_ptr_intervals = open(self.f_intervals, 'w')     #pylint: disable=consider-using-with
+            self.f_ptr_intervals.write(json.dumps(dict_interval) + '\n')
+            self.f_ptr_intervals.flush()
+            self.interval = None
+        s_tmp = self.f_name + '.tmp'
+        with open(s_tmp, 'w') as f_ptr:
+            json.dump(self.summary(), f_ptr)
+        os.replace(s_tmp, self.f_name)     # readers never see a half written file
+        self.t_last_flush = time.perf_counter()
+
+    def close(self):
+        """ final flush
+        """
+        self.flush()
+        if self.f_ptr_intervals is not None:
+            self.f_ptr_intervals.close()
+        if self.sink_decimated is not None:
+            self.sink_decimated.close()
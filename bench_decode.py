@@ -0,0 +1,439 @@
+#! /usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) 2015-2019 Stanford Research Systems
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnshished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+
+""" Time decoding, drop detection and export on synthetic data and check for regressions.
+
+        Builds deterministic fixtures for every stream format (float/int, X/XY/RT/XYRT,
+        the four packet lengths): clean packets, and packets with some lost and some
+        swapped with their neighbour. Also builds cap860 captures served as CAPTUREGET?
+        replies. The packets are those sr865sim would send. Each case runs --repeat times
+        and the fastest run gives its samples per second; cases that look slow are timed
+        again before they count as regressions. The decoded samples and gaps
+        are checked against the fixtures before anything is timed.
+        Every round also times a reference case, plain python that none of the scripts
+        change, and each rate is kept relative to the reference's rate in the same run, so a
+        faster or busier host does not move it. The relative rates are compared with a
+        baseline JSON file that holds one baseline per decoder (numpy version, or none), and
+        any case slower than its tolerance allows fails the run. The first run with a
+        decoder the file has no baseline for saves one for it. --save writes a new baseline.
+        No hardware or network is used.
+
+        python bench_decode.py -h        to see the list of options
+"""
+import array
+import contextlib
+import io
+import json
+import os
+import random
+from struct import iter_unpack, pack
+import sys
+import tempfile
+import time
+import zlib
+
+import cap860
+import export
+import sr865sim
+import stream
+
+try:
+    import docopt           # handy command line parser.
+except ImportError:
+    print('python docopt library not found. Please install docopt')
+
+
+USE_STR = """
+ --Time decoding, drop detection and export against a baseline--
+ Usage:
+  bench_decode  [--baseline=<B>] [--fixtures=<F>] [--only=<O>] [--packets=<P>] [--repeat=<N>] [--save] [--tolerance=<T>]
+  bench_decode -h | --help
+
+ Options:
+  -b --baseline <B>    Baseline JSON file. bench_decode_baseline.json next to this script if not
+                       given.
+  -f --fixtures <F>    Also write the fixtures to directory <F>: the packets as record files that
+                       "stream decode" reads, the captures as their CAPTUREGET? replies back to back
+  -h --help            Show this screen
+  -k --only <O>        Only run the cases whose name contains <O>
+  -p --packets <P>     Packets in each stream fixture [default: 2048]
+  -n --repeat <N>      Timed runs per case. The fastest counts [default: 5]
+  -s --save            Write the results as the new baseline for this decoder instead of comparing
+  -t --tolerance <T>   Allowed slowdown as a fraction of the baseline rate, e.g. 0.3. Overrides the
+                       tolerances stored in the baseline, or with --save is stored for every case.
+                       A new baseline otherwise allows 0.3, and 0.5 for the cases that write files.
+    """
+
+LST_VARS = ['X', 'XY', 'RT', 'XYRT']
+DROP_FRACTION = 0.01        # share of packets lost in the drop fixtures
+REORDER_FRACTION = 0.01     # share of packets sent after the packet that follows them
+EXPORT_PACKETS = 256        # 1 kB packets exported per export case
+CAPTURE_KB = 1024           # size of each capture fixture, 16 CAPTUREGET? replies
+MIN_RUN_TIME = 0.05         # seconds each timed run repeats its case for
+REFERENCE_VALUES = 16384    # floats summed by the reference case
+REFERENCE_NAME = 'reference'
+TOLERANCE = 0.3             # default allowed slowdown written into a new baseline
+DICT_TOLERANCE = {'csv': 0.5, 'binary': 0.5}    # the cases that write files vary more
+
+
+def make_sim(s_vars, idx_pkt_len, b_integers):
+    """ return an sr865sim.Instrument set up for the format. It never streams, it only
+        supplies the packet contents.
+    """
+    sim = sr865sim.Instrument()
+    sim.settings.update({'STREAMCH': LST_VARS.index(s_vars), 'STREAMPCKT': idx_pkt_len,
+                         'STREAMFMT': 1 if b_integers else 0})
+    return sim
+
+
+def make_packets(sim, count_packets, f_drop=0.0, f_reorder=0.0, i_seed=0):
+    """ return count_packets of the simulator's packets back to back (headers included),
+        less the ones lost, and the sequence numbers of the ones kept in the order sent.
+        The first and last packets always arrive, so every hole can be detected.
+    """
+    lst_payloads = sim.make_payloads()
+    rand = random.Random(i_seed)
+    lst_seqs = []
+    held = None                     # a packet being sent late
+    for seq in range(count_packets):
+        b_ends = seq in (0, count_packets-1)
+        if not b_ends and rand.random() < f_drop:
+            continue
+        if held is None and not b_ends and rand.random() < f_reorder:
+            held = seq
+            continue
+        lst_seqs.append(seq)
+        if held is not None:
+            lst_seqs.append(held)
+            held = None
+    buf = b''.join(pack('>I', seq & 0xff) + lst_payloads[seq & 0xff] for seq in lst_seqs)
+    return buf, lst_seqs
+
+
+def expected_gaps(lst_seqs):
+    """ the (n_lost, first lost sequence number) gaps a SequenceTracker should report
+    """
+    lst_sorted = sorted(lst_seqs)
+    return [(seq - prev - 1, prev + 1) for prev, seq in zip(lst_sorted, lst_sorted[1:]) if seq - prev > 1]   #pylint: disable=line-too-long
+
+
+def expected_bytes(sim, lst_seqs, b_integers):
+    """ the samples of the packets in sequence order as little-endian bytes, which is
+        what stream.sample_bytes() makes of the decoded blocks
+    """
+    lst_payloads = sim.make_payloads()
+    arr = array.array('h' if b_integers else 'f', b''.join(lst_payloads[seq & 0xff] for seq in sorted(lst_seqs)))   #pylint: disable=line-too-long
+    arr.byteswap()              # the payloads are big-endian
+    return arr.tobytes()
+
+
+def decode_batches(buf, bytes_per_packet, fmt_unpk, count_vars):
+    """ decode_packets() a BATCH_PACKETS batch at a time, as the receive loops do.
+        return the sample blocks and the gaps.
+    """
+    lst_blocks = []
+    lst_gaps = []
+    prev_pkt_cntr = None
+    bytes_per_batch = stream.BATCH_PACKETS * bytes_per_packet
+    for offset in range(0, len(buf), bytes_per_batch):
+        samples, _, gaps, prev_pkt_cntr = stream.decode_packets(buf[offset:offset+bytes_per_batch], bytes_per_packet, fmt_unpk, count_vars, prev_pkt_cntr, offset//bytes_per_packet)   #pylint: disable=line-too-long
+        lst_blocks.append(samples)
+        lst_gaps += gaps
+    return lst_blocks, lst_gaps
+
+
+def decode_tracked(buf, bytes_per_packet, fmt_unpk, count_vars):
+    """ decode_ordered() a BATCH_PACKETS batch at a time through a new SequenceTracker,
+        flushing at the end. return the sample blocks and the gaps.
+    """
+    tracker = stream.SequenceTracker()
+    lst_blocks = []
+    bytes_per_batch = stream.BATCH_PACKETS * bytes_per_packet
+    for offset in range(0, len(buf) + 1, bytes_per_batch):
+        samples, _, _ = stream.decode_ordered(tracker, buf[offset:offset+bytes_per_batch], bytes_per_packet, fmt_unpk, count_vars, offset + bytes_per_batch > len(buf))   #pylint: disable=line-too-long
+        if samples is not None:
+            lst_blocks.append(samples)
+    return lst_blocks, tracker.lst_gaps
+
+
+class ReplayInstrument:
+    """ Stands in for the vxi11.Instrument of cap860.retrieve_data(). Answers every
+        CAPTUREGET? it will send for a capture with a reply built in advance.
+    """
+    def __init__(self, data):
+        self.dict_replies = {}
+        count_blocks = (len(data) + 1023) // 1024
+        for i_block in range(0, count_blocks, 64):
+            i_count = min(64, count_blocks - i_block)
+            payload = data[i_block*1024:(i_block+i_count)*1024]
+            s_len = '%d'%len(payload)
+            self.dict_replies['CAPTUREGET? %d, %d'%(i_block, i_count)] = ('#%d%s'%(len(s_len), s_len)).encode('ascii') + payload   #pylint: disable=line-too-long
+        self.reply = b''
+
+    def write(self, s_cmd):
+        """ queue the reply to s_cmd
+        """
+        self.reply = self.dict_replies[s_cmd]
+
+    def read_raw(self):
+        """ return the queued reply
+        """
+        return self.reply
+
+
+def time_call(fn, t_min=MIN_RUN_TIME):
+    """ call fn() until at least t_min has passed. return the seconds per call.
+    """
+    count_calls = 0
+    t_start = time.perf_counter()
+    t_run = 0.0
+    while t_run < t_min:
+        fn()
+        count_calls += 1
+        t_run = time.perf_counter() - t_start
+    return t_run / count_calls
+
+
+def stream_cases(count_packets, s_dir_fixtures):
+    """ yield (name, fixture checksum, samples, function to time, check) for the decode
+        and drop cases of every stream format. check() returns an error message or None.
+    """
+    for b_integers in (False, True):
+        for s_vars in LST_VARS:
+            for idx_pkt_len in range(4):
+                sim = make_sim(s_vars, idx_pkt_len, b_integers)
+                bytes_per_pkt, fmt_unpk, _ = stream.packet_format(idx_pkt_len, b_integers, len(s_vars))   #pylint: disable=line-too-long
+                s_format = '<i2' if b_integers else '<f4'
+                s_tag = '%s %s %d'%('i2' if b_integers else 'f4', s_vars, bytes_per_pkt)
+                for s_kind, f_loss, fn_decode in (('decode', 0.0, decode_batches), ('drops', DROP_FRACTION, decode_tracked)):   #pylint: disable=line-too-long
+                    buf, lst_seqs = make_packets(sim, count_packets, f_loss, f_loss and REORDER_FRACTION)   #pylint: disable=line-too-long
+                    if s_dir_fixtures is not None:
+                        dict_header = {'channels': s_vars, 'rate': sim.stream_params()[1], 'ints': b_integers,   #pylint: disable=line-too-long
+                                       'length': idx_pkt_len, 'packet_bytes': bytes_per_pkt+4, 'stamp': False}   #pylint: disable=line-too-long
+                        with open(os.path.join(s_dir_fixtures, '%s_%s.rec'%(s_kind, s_tag.replace(' ', '_'))), 'wb') as f_ptr:   #pylint: disable=line-too-long
+                            f_ptr.write(export.binary_header(dict_header) + buf)
+
+                    def run(buf=buf, bytes_per_pkt=bytes_per_pkt, fmt_unpk=fmt_unpk, s_vars=s_vars, fn_decode=fn_decode):   #pylint: disable=too-many-arguments
+                        return fn_decode(buf, bytes_per_pkt+4, fmt_unpk, len(s_vars))
+
+                    def check(run=run, sim=sim, lst_seqs=lst_seqs, b_integers=b_integers, s_format=s_format):   #pylint: disable=too-many-arguments
+                        lst_blocks, lst_gaps = run()
+                        if lst_gaps != expected_gaps(lst_seqs):
+                            return 'gaps %s, expected %s'%(lst_gaps[:4], expected_gaps(lst_seqs)[:4])   #pylint: disable=line-too-long
+                        if b''.join(stream.sample_bytes(x, s_format) for x in lst_blocks) != expected_bytes(sim, lst_seqs, b_integers):   #pylint: disable=line-too-long
+                            return 'decoded samples differ from the packets'
+                        return None
+                    yield '%s %s'%(s_kind, s_tag), zlib.crc32(buf), len(lst_seqs)*bytes_per_pkt//((2 if b_integers else 4)*len(s_vars)), run, check   #pylint: disable=line-too-long
+
+
+def export_cases(s_dir_tmp):
+    """ yield the export cases: stream.py's CSV and binary output of decoded blocks, for
+        every sample format and variable set
+    """
+    for b_integers in (False, True):
+        for s_vars in LST_VARS:
+            sim = make_sim(s_vars, 0, b_integers)
+            bytes_per_pkt, fmt_unpk, _ = stream.packet_format(0, b_integers, len(s_vars))
+            buf, _ = make_packets(sim, EXPORT_PACKETS)
+            lst_blocks, _ = decode_batches(buf, bytes_per_pkt+4, fmt_unpk, len(s_vars))
+            count_samples = sum(len(x) for x in lst_blocks)
+            s_tag = '%s %s'%('i2' if b_integers else 'f4', s_vars)
+            f_name = os.path.join(s_dir_tmp, 'export')
+
+            def run_csv(s_vars=s_vars, lst_blocks=lst_blocks):
+                stream.write_to_file(f_name, s_vars, lst_blocks)
+
+            def run_binary(s_vars=s_vars, lst_blocks=lst_blocks, b_integers=b_integers):
+                sink = stream.BinarySink(f_name, s_vars, 1e5, b_integers)
+                for samples in lst_blocks:
+                    sink.write(samples)
+                sink.close()
+            yield 'csv stream %s'%s_tag, zlib.crc32(buf), count_samples, run_csv, lambda: None
+            yield 'binary stream %s'%s_tag, zlib.crc32(buf), count_samples, run_binary, lambda: None
+
+
+def capture_cases(s_dir_tmp, s_dir_fixtures):
+    """ yield the cap860 cases: retrieve_data() of a capture from its CAPTUREGET? replies,
+        and write_to_file() of the result, for every variable set
+    """
+    for s_vars in LST_VARS:
+        count_samples = CAPTURE_KB * 256 // len(s_vars)
+        data = pack('<%df'%(count_samples*len(s_vars)), *[sr865sim.Instrument.capture_value(None, i) for i in range(count_samples*len(s_vars))])   #pylint: disable=line-too-long
+        vx_replay = ReplayInstrument(data)
+        if s_dir_fixtures is not None:
+            with open(os.path.join(s_dir_fixtures, 'capture_%s.blk'%s_vars), 'wb') as f_ptr:
+                f_ptr.write(b''.join(vx_replay.dict_replies.values()))
+        f_name = os.path.join(s_dir_tmp, 'export')
+
+        def run_retrieve(vx_replay=vx_replay, s_vars=s_vars, count_samples=count_samples):
+            return cap860.retrieve_data(vx_replay, count_samples*len(s_vars)*4, count_samples, s_vars)   #pylint: disable=line-too-long
+
+        def check(run_retrieve=run_retrieve, data=data):
+            f_data = run_retrieve()
+            if sys.byteorder == 'big':
+                f_data.byteswap()
+            return None if f_data.tobytes() == data else 'retrieved capture differs from the replies'   #pylint: disable=line-too-long
+        f_data = run_retrieve()
+
+        def run_csv(s_vars=s_vars, f_data=f_data):
+            cap860.write_to_file(f_name, s_vars, f_data, 'w')
+        yield 'retrieve cap860 f4 %s'%s_vars, zlib.crc32(data), count_samples, run_retrieve, check
+        yield 'csv cap860 f4 %s'%s_vars, zlib.crc32(data), count_samples, run_csv, lambda: None
+
+
+def reference_case():
+    """ return the reference case: unpacks and sums floats in python. It measures how
+        fast the host runs the interpreter right now, and nothing in the scripts changes it.
+    """
+    data = pack('<%df'%REFERENCE_VALUES, *[sr865sim.Instrument.capture_value(None, i) for i in range(REFERENCE_VALUES)])   #pylint: disable=line-too-long
+
+    def run():
+        return sum(x for x, in iter_unpack('<f', data))
+    return REFERENCE_NAME, zlib.crc32(data), REFERENCE_VALUES, run, lambda: None
+
+
+def run_cases(opts, set_names=None):
+    """ check every case selected by --only (or named in set_names), then time them along
+        with the reference case. Each of the --repeat rounds times every case once, so that
+        a slow spell on the host does not land on all the runs of one case. The fastest
+        round counts.
+        return {name: {'samples_per_s': ..., 'relative': ..., 'crc': ..., 'samples': ...,
+        'tolerance': ...}}, where relative is samples_per_s over the reference's, and a list
+        of check failures
+    """
+    lst_failed = []
+    i_repeat = int(opts['--repeat'])
+    s_dir_fixtures = opts['--fixtures']
+    if s_dir_fixtures is not None:
+        os.makedirs(s_dir_fixtures, exist_ok=True)
+    with tempfile.TemporaryDirectory() as s_dir_tmp:
+        lst_cases = [case for cases in (stream_cases(int(opts['--packets']), s_dir_fixtures), export_cases(s_dir_tmp), capture_cases(s_dir_tmp, s_dir_fixtures))   #pylint: disable=line-too-long
+                     for case in cases if (opts['--only'] is None or opts['--only'] in case[0]) and (set_names is None or case[0] in set_names)]   #pylint: disable=line-too-long
+        lst_cases.append(reference_case())
+        dict_best = {}
+        with contextlib.redirect_stdout(io.StringIO()):     # the exporters show their own status
+            for s_name, _, _, _, fn_check in lst_cases:
+                s_error = fn_check()
+                if s_error is not None:
+                    lst_failed.append('%s: %s'%(s_name, s_error))
+        for i_round in range(i_repeat):
+            for s_name, _, _, fn_run, _ in lst_cases:
+                stream.show_status('round %d of %d'%(i_round+1, i_repeat), s_name)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    t_call = time_call(fn_run)
+                dict_best[s_name] = min(t_call, dict_best.get(s_name, t_call))
+    print(' '*80)
+    f_reference = REFERENCE_VALUES / dict_best[REFERENCE_NAME]
+    return {s_name: {'samples_per_s': count_samples / dict_best[s_name], 'crc': i_crc, 'samples': count_samples,   #pylint: disable=line-too-long
+                     'relative': count_samples / dict_best[s_name] / f_reference,
+                     'tolerance': DICT_TOLERANCE.get(s_name.split()[0], TOLERANCE)}
+            for s_name, i_crc, count_samples, _, _ in lst_cases if s_name != REFERENCE_NAME}, lst_failed   #pylint: disable=line-too-long
+
+
+def verdict(result, base, f_tolerance):
+    """ return '' if result is within the tolerance of the baseline result base,
+        otherwise what is wrong with it
+    """
+    f_allowed = f_tolerance if f_tolerance is not None else base.get('tolerance', TOLERANCE)
+    if base['crc'] != result['crc'] or base['samples'] != result['samples']:
+        return 'FIXTURE CHANGED'
+    if result['relative'] < (1.0 - f_allowed) * base['relative']:
+        return 'SLOWER (allowed %.0f%%)'%(100*f_allowed)
+    return ''
+
+
+def compare(dict_results, dict_baseline, f_tolerance):
+    """ print the results next to the baseline. The ratio is of the rates relative to the
+        reference case.
+        return the names of the cases that are slower than their tolerance allows,
+        or whose fixture no longer matches the baseline's.
+    """
+    lst_bad = []
+    dict_base_results = dict_baseline.get('results', {})
+    print(' %-26s %14s %14s %7s'%('case', 'samples/s', 'baseline', 'ratio'))
+    for s_name, result in dict_results.items():
+        base = dict_base_results.get(s_name)
+        if base is None:
+            print(' %-26s %14.0f %14s %7s  new'%(s_name, result['samples_per_s'], '-', '-'))
+            continue
+        s_verdict = verdict(result, base, f_tolerance)
+        if s_verdict:
+            lst_bad.append(s_name)
+        print(' %-26s %14.0f %14.0f %7.2f  %s'%(s_name, result['samples_per_s'], base['samples_per_s'], result['relative'] / base['relative'], s_verdict))   #pylint: disable=line-too-long
+    return lst_bad
+
+
+def test(opts):
+    """ run the cases, then save them as the baseline or compare them with it.
+        return True when nothing failed
+    """
+    f_name_baseline = opts['--baseline']
+    if f_name_baseline is None:
+        f_name_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_decode_baseline.json')   #pylint: disable=line-too-long
+    f_tolerance = None if opts['--tolerance'] is None else float(opts['--tolerance'])
+    s_numpy = 'numpy %s'%stream.np.__version__ if stream.load_numpy() is not None else 'no numpy'
+
+    dict_results, lst_failed = run_cases(opts)
+    for s_failed in lst_failed:
+        print('**** CHECK FAILED: %s ****'%s_failed)
+
+    dict_file = {'decoders': {}}
+    if os.path.exists(f_name_baseline):
+        with open(f_name_baseline) as f_ptr:
+            dict_file = json.load(f_ptr)
+    dict_file.setdefault('decoders', {})
+    dict_baseline = dict_file['decoders'].get(s_numpy)
+    if opts['--save'] or dict_baseline is None:
+        if f_tolerance is not None:
+            for result in dict_results.values():
+                result['tolerance'] = f_tolerance
+        if opts['--only'] is not None and dict_baseline is not None:    # update just those cases
+            dict_baseline['results'].update(dict_results)
+        else:
+            dict_file['decoders'][s_numpy] = {'packets': int(opts['--packets']), 'results': dict_results}   #pylint: disable=line-too-long
+        with open(f_name_baseline, 'w') as f_ptr:
+            json.dump(dict_file, f_ptr, indent=1, sort_keys=True)
+        print('%d results saved to %s as the baseline for %s'%(len(dict_results), f_name_baseline, s_numpy))   #pylint: disable=line-too-long
+        return not lst_failed
+
+    # time the slow looking cases again before calling them regressions: on a busy host
+    # any one case can have a slow spell
+    dict_base_results = dict_baseline.get('results', {})
+    set_slow = {s_name for s_name, result in dict_results.items()
+                if s_name in dict_base_results and verdict(result, dict_base_results[s_name], f_tolerance).startswith('SLOWER')}   #pylint: disable=line-too-long
+    if set_slow:
+        dict_again, _ = run_cases(opts, set_slow)
+        for s_name, result in dict_again.items():
+            if result['relative'] > dict_results[s_name]['relative']:
+                dict_results[s_name] = result
+    lst_bad = compare(dict_results, dict_baseline, f_tolerance)
+    if lst_bad:
+        print('\n**** %d OF %d CASES REGRESSED: %s ****'%(len(lst_bad), len(dict_results), ', '.join(lst_bad)))   #pylint: disable=line-too-long
+    return not lst_bad and not lst_failed
+
+
+if __name__ == '__main__':
+    dict_options = docopt.docopt(USE_STR, version='0.0.2')  #pylint: disable=invalid-name
+    sys.exit(0 if test(dict_options) else 1)
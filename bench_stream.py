@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) 2015-2019 Stanford Research Systems
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnshished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+""" Find the highest packet rate each receive mode of stream.py can take without drops.
+
+        Runs stream.test() against the sr865sim simulator, doubling the simulated
+        STREAMRATEMAX until packets are dropped, then bisecting between the last
+        good rate and the first bad one. No hardware or firewall changes needed.
+        The search stops at RATE_MAX, the fastest an SR865 streams. The simulator sends
+        from a python thread, so on a fast host it may fall behind first: a trial where
+        it sends less than SIM_FRACTION of the packet rate counts as simulator-bound.
+
+        python bench_stream.py -h        to see the list of options
+"""
+import contextlib
+import io
+import types
+
+import scpi
+import sr865sim
+import stream
+
+try:
+    import docopt           # handy command line parser.
+except ImportError:
+    print('python docopt library not found. Please install docopt')
+
+
+USE_STR = """
+ --Measure zero-drop packet rates of the stream.py receive modes--
+ Usage:
+  bench_stream  [--vars=<V>] [--length=<L>] [--duration=<D>] [--start=<S>] [--steps=<N>] [--modes=<M>] [--ints]
+  bench_stream -h | --help
+
+ Options:
+  -d --duration <D>    Seconds streamed per trial [default: 2]
+  -h --help            Show this screen
+  -i --ints            Data in 16-bit ints instead of 32-bit floats
+  -l --length <L>      Packet length enum (0 to 3) [default: 3]
+  -m --modes <M>       Comma separated receive modes to test [default: block,thread,buffer,process]
+  -n --steps <N>       Bisection steps after the first failure [default: 3]
+  -s --start <S>       First simulated sample rate per second [default: 1e4]
+  -v --vars <V>        Lock-in variables to stream [default: XYRT]
+    """
+
+DICT_MODE_ARGS = {'block': [], 'thread': ['--thread'], 'buffer': ['--buffer'], 'process': ['--process']}   #pylint: disable=line-too-long
+RATE_MAX = 1.25e6           # samples/s. The SR865's highest STREAMRATEMAX
+SIM_FRACTION = 0.9          # a simulator sending less of the packet rate than this is the
+                            # bottleneck
+
+
+def run_trial(s_mode, f_rate, opts, i_port=1865):
+    """ stream for opts['--duration'] seconds at f_rate samples/sec with stream.test().
+        return the number of packets dropped, the packet rate asked of the simulator and the
+        packets it actually sent per second.
+    """
+    lst_sims = []
+
+    def make_sim(host):
+        lst_sims.append(sr865sim.Instrument(host, f_rate_max=f_rate))
+        return lst_sims[-1]
+    stream.vxi11 = types.SimpleNamespace(Instrument=make_sim)
+    # every trial talks to a new simulated instrument with its own max rate
+    scpi.dict_cache.clear()
+    lst_argv = ['--address', '127.0.0.1', '--port', '%d'%i_port, '--rate', '%g'%f_rate, '--silent',
+                '--duration', opts['--duration'], '--vars', opts['--vars'], '--length', opts['--length']]   #pylint: disable=line-too-long
+    if opts['--ints']:
+        lst_argv.append('--ints')
+    dict_stream_opts = docopt.docopt(stream.USE_STR, argv=lst_argv + DICT_MODE_ARGS[s_mode])
+    with contextlib.redirect_stdout(io.StringIO()):
+        lst_dropped = stream.test(dict_stream_opts)
+    _, _, f_pkt_rate = lst_sims[0].stream_params()
+    return sum(x[0] for x in lst_dropped), f_pkt_rate, lst_sims[0].sent_rate()
+
+
+def trial_result(s_mode, f_rate, opts):
+    """ run a trial. return its packet rate and what it ran into: None, 'drops' or
+        'simulator-bound'
+    """
+    n_dropped, f_pkt_rate, f_sent_rate = run_trial(s_mode, f_rate, opts)
+    stream.show_status('%s %.0f S/s'%(s_mode, f_rate), '%d dropped, simulator sent %.0f%%'%(n_dropped, 100*f_sent_rate/f_pkt_rate))   #pylint: disable=line-too-long
+    if n_dropped:
+        return f_pkt_rate, 'drops'
+    if f_sent_rate < SIM_FRACTION*f_pkt_rate:
+        return f_pkt_rate, 'simulator-bound'
+    return f_pkt_rate, None
+
+
+def find_max_rate(s_mode, opts):
+    """ return the highest zero-drop sample rate and its packet rate (0 if even the start rate
+        drops), and what stopped the search: 'drops', 'simulator-bound' or 'SR865 max'
+    """
+    f_good, f_pkt_good = 0.0, 0.0
+    f_bad = None
+    s_limit = 'SR865 max'
+    f_rate = min(float(opts['--start']), RATE_MAX)
+    while f_bad is None:
+        f_pkt_rate, s_result = trial_result(s_mode, f_rate, opts)
+        if s_result is not None:
+            f_bad, s_limit = f_rate, s_result
+        else:
+            f_good, f_pkt_good = f_rate, f_pkt_rate
+            if f_rate >= RATE_MAX:
+                return f_good, f_pkt_good, s_limit
+            f_rate = min(2*f_rate, RATE_MAX)
+    for _ in range(int(opts['--steps'])):
+        if not f_good:
+            break
+        f_rate = (f_good + f_bad) / 2
+        f_pkt_rate, s_result = trial_result(s_mode, f_rate, opts)
+        if s_result is not None:
+            f_bad, s_limit = f_rate, s_result
+        else:
+            f_good, f_pkt_good = f_rate, f_pkt_rate
+    return f_good, f_pkt_good, s_limit
+
+
+def test(opts):
+    """ measure every requested mode and print a table
+    """
+    lst_results = []
+    for s_mode in opts['--modes'].split(','):
+        lst_results.append((s_mode,) + find_max_rate(s_mode.strip(), opts))
+    print('\n\n %-10s %14s %14s  %s'%('mode', 'samples/s', 'packets/s', 'limited by'))
+    for s_mode, f_rate, f_pkt_rate, s_limit in lst_results:
+        print(' %-10s %14.0f %14.0f  %s'%(s_mode, f_rate, f_pkt_rate, s_limit))
+
+
+if __name__ == '__main__':
+    dict_options = docopt.docopt(USE_STR, version='0.0.2')  #pylint: disable=invalid-name
+    test(dict_options)
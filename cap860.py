@@ -33,38 +33,54 @@
         compatability with your network.
 
 """
+import array
 import math
-from struct import unpack_from
 import signal
 import sys
 import time
 
+import export
+import profiling
+import scpi
 
-# you may need to install these python modules
-try:
-    import vxi11            # required
-except ImportError:
-    print('required python vxi11 library not found. Please install vxi11')
+# vxi11 (required) and docopt are imported the first time they are used, by open_instrument()
+# and the __main__ block, so that importing cap860 as a library stays quick.
+vxi11 = None                #pylint: disable=invalid-name
 
-try:
-    import docopt       # useStr (below) defines the syntax and documents it at the same time.
-except ImportError:
-    print('python docopt library not found. Please install docopt or remove the docopt code from test() and main') #pylint: disable=C0301
+
+def open_instrument(s_address):
+    """ return a vxi11 session with the SR865 at s_address, importing vxi11 if need be
+    """
+    global vxi11            #pylint: disable=W0603,C0103
+    if vxi11 is None:
+        try:
+            import vxi11    #pylint: disable=W0621,C0415
+        except ImportError:
+            print('required python vxi11 library not found. Please install vxi11')
+            raise
+    return vxi11.Instrument(s_address)
 
 
 USE_STR = """
  --Capture Data on an SR865 and save it to a file--
  Usage:
-  cap860  [--address=<A>] [--count=<C>] [--debug] [--file=<F>] [--mode=<M>] [--silent] [--vars=<V>] [--wait=<W>]
+  cap860  [--address=<A>] [--compress=<Z>] [--count=<C>] [--debug] [--file=<F>] [--mode=<M>] [--output=<O>] [--pipeline] [--profile=<P>] [--silent] [--vars=<V>] [--wait=<W>]
   cap860 -h | --help
 
  Options:
   -a --address <A>     IP address of SR865 [default: 172.25.98.253]
   -c --count <C>       number of data points to capture [default: 500]
+  -z --compress <Z>    Write --output as independently compressed chunks: zlib, lzma or bz2,
+                       optionally followed by :shuffle (the default), :delta or :none
   -d --debug           Print lot's of stuff
   -f --file <F>        Name for file output. No file output without a file name.
   -h --help            Show this screen
   -m --mode <M>        Trigger mode [default: IMM]  TRIG or SAMP are also allowed
+  -o --output <O>      Name for binary output (little-endian floats after a JSON header line)
+  -p --pipeline        Retrieve completed blocks while the capture is still running
+  --profile <P>        Time the CAPTUREBYTES? and CAPTUREGET? round trips and the file writes
+                       and print a report at the end. The numbers also go to the JSON file <P>
+                       unless <P> is -
   -s --silent          Refrain from printing running capture count and data until complete
   -w --wait <W>        Seconds to wait for a point before timeout [default: 5]
   -v --vars <V>        Lock-in variables to stream [default: X]    XY, RT, or XYRT are also allowed
@@ -77,50 +93,77 @@ def show_status(left_t='', right_t=''):
     print(' %-30s %48s\r'%(left_t[:30], right_t[:48]), end=' ')
 
 
-# global that gets assigned to the vxi11 object to allow SIGINT to cleanup properly
-the_vx_ifc = None        #pylint: disable=global-statement, invalid-name
+# global that gets assigned the Capture to allow SIGINT to cleanup properly
+the_capture = None          #pylint: disable=global-statement, invalid-name
+# --profile enables it
+the_profiler = profiling.Profiler(False)    #pylint: disable=invalid-name
 
 
 def cleanup():
     """ Stop the stream and close the socket and vxi11.
     """
-    # global the_vx_ifc
     print("\n cleaning up...", end=' ')
-    the_vx_ifc.close()
+    the_capture.close()
     print('connections closed\n')
 
 
-def open_interfaces(ipadd):
-    """ open a vxi11 instrument and assign it to the global the_vx_ifc
+
+def dut_config(vx_handle, str_chans, i_wait_count):
+    """ Setup the SR865 for capture. Return the capture rate
+        The settings go out in one scpi.Batch write, leaving out any the instrument already
+        has. CAPTURERATEMAX? is only asked the first time for these channels, CAPTURERATE?
+        every time.
     """
-    global the_vx_ifc           #pylint: disable=W0603,C0103
-    print('opening VXI-11 at %s ...'%ipadd, end=' ')
-    the_vx_ifc = vxi11.Instrument(ipadd)
-    print('done')
+    batch = scpi.Batch(vx_handle)
+    batch.setting('CAPTURECFG', str_chans)    # the vars to captures
+    i_cap_len_k = math.ceil(len(str_chans) * i_wait_count / 256.0)
+    batch.setting('CAPTURELEN', i_cap_len_k)   # in kB. dut rounds odd numbers up to next even
+    f_rate_max = float(batch.limit('CAPTURERATEMAX?'))      # filters determine the max data rate
+    return f_rate_max / 2.0**int(batch.ask('CAPTURERATE?'))     # the rate is max/2^n
 
 
+POLL_FRACTION = 0.8     # share of the predicted time left slept before the next CAPTUREBYTES?
+POLL_MIN = 0.002        # seconds. Shortest sleep between polls
+POLL_IDLE = 0.05        # seconds between polls while nothing predicts the end, e.g. waiting
+                        # for a trigger
 
-def dut_config(vx_handle, str_chans, i_wait_count):
-    """ Setup the SR865 for streaming. Return the total expected sample count
+
+def poll_delay(s_mode, i_bytes_captured, i_bytes_wanted, f_bytes_rate, t_elapsed, t_timeout):   #pylint: disable=R0913
+    """ Seconds to sleep before the next CAPTUREBYTES? poll.
+        The end of the capture is predicted from the rate seen so far, or from
+        the capture rate before any data shows up in IMM mode, and most of the time left
+        is slept, so the polls close in on the predicted end with shorter and shorter sleeps.
+        Never sleeps more than half of t_timeout, so a stall is still noticed about when
+        --wait says it should be.
     """
-    vx_handle.write('CAPTURECFG %s'%str_chans)    # the vars to captures
-    i_cap_len_k = math.ceil(len(str_chans) * i_wait_count / 256.0)
-    vx_handle.write('CAPTURELEN %d'%i_cap_len_k)   # in kB. dut rounds odd numbers up to next even
-    # print 'CAPTURELEN %d'%i_cap_len_k       # in kB. dut rounds odd number up
-    f_rate_max = float(vx_handle.ask('CAPTURERATEMAX?'))      # filters determine the max data rate
-    return f_rate_max
+    if i_bytes_captured:
+        f_bytes_per_sec = i_bytes_captured / max(t_elapsed, POLL_MIN)
+    else:
+        f_bytes_per_sec = f_bytes_rate if s_mode == 'IMM' else 0
+    if not f_bytes_per_sec:
+        return min(POLL_IDLE, t_timeout / 2)
+    t_left = (i_bytes_wanted - i_bytes_captured) / f_bytes_per_sec
+    return max(POLL_MIN, min(POLL_FRACTION * t_left, t_timeout / 2))
 
 
-def capture_data(vx_handle, s_mode, s_channels, i_wait_count, t_timeout, b_show_status): #pylint: disable=R0913
-    """ tell the SR865 to take data and wait until it completes
+def capture_data(vx_handle, s_mode, s_channels, i_wait_count, t_timeout, b_show_status, f_rate, b_start=True): #pylint: disable=R0913
+    """ tell the SR865 to take data and wait until it completes.
+        Polls CAPTUREBYTES? on the poll_delay() schedule rather than as fast as possible.
+        b_start=False skips CAPTURESTART, for a capture the caller already armed.
     """
     t_start = time.perf_counter()
-    vx_handle.write('CAPTURESTART ONE, %s'%s_mode)
+    if b_start:
+        vx_handle.write('CAPTURESTART ONE, %s'%s_mode)
+    i_bytes_wanted = i_wait_count * 4 * len(s_channels)
     i_bytes_captured = 0
     i_last_cap_byte = 0
     t_last = t_start
-    while i_bytes_captured < (i_wait_count * 4 * len(s_channels)):
+    while i_bytes_captured < i_bytes_wanted:
+        time.sleep(poll_delay(s_mode, i_bytes_captured, i_bytes_wanted, f_rate * 4 * len(s_channels),   #pylint: disable=C0301
+                              time.perf_counter() - t_start, t_timeout))
+        t_ask = time.perf_counter_ns()
         i_bytes_captured = int(vx_handle.ask('CAPTUREBYTES?'))
+        the_profiler.add('CAPTUREBYTES?', time.perf_counter_ns() - t_ask)
         if b_show_status:
             show_status('dut has captured %4d of %4d samples'%
                         (i_bytes_captured / (4 * len(s_channels)), i_wait_count))
@@ -140,62 +183,155 @@ def capture_data(vx_handle, s_mode, s_channels, i_wait_count, t_timeout, b_show_
     return i_bytes_captured
 
 
-def retrieve_data(vx_handle, i_bytes_captured, i_wait_count, s_channels):
-    """ Use the binary transfer command over vx interface to retrieve the capture buffer.
+def iter_capture(vx_handle, s_mode, s_channels, t_timeout, b_show_status, f_rate, f_data, b_start=True): #pylint: disable=R0913, R0914
+    """ capture_data() and retrieve_data() overlapped: every 1 kB block the SR865 has
+        finished (going by CAPTUREBYTES?) is pulled with CAPTUREGET? into f_data, an
+        array.array('f') sized for the whole capture, while the capture is still running.
+        Polls on the poll_delay() schedule, aiming at the next 64 block chunk rather than the end.
+        b_start=False skips CAPTURESTART, as for capture_data().
+        Yields (bytes retrieved into f_data, bytes captured) whenever more has been retrieved,
+        the last time after the tail, when f_data has been trimmed to what was retrieved.
+        Nothing is polled while the caller holds on to a yield.
+    """
+    i_wait_count = len(f_data) // len(s_channels)
+    i_bytes_wanted = len(f_data) * 4
+    i_blocks_wanted = int(math.ceil(i_bytes_wanted / 1024.0))
+    mv_data = memoryview(f_data).cast('B')
+    t_start = time.perf_counter()
+    if b_start:
+        vx_handle.write('CAPTURESTART ONE, %s'%s_mode)
+    i_block_offset = 0
+    i_bytes_captured = 0
+    t_last = t_start
+    while i_bytes_captured < i_bytes_wanted:
+        i_bytes_next = min(i_bytes_wanted, (i_block_offset + 64) * 1024)
+        time.sleep(poll_delay(s_mode, i_bytes_captured, max(i_bytes_next, i_bytes_captured), f_rate * 4 * len(s_channels),   #pylint: disable=C0301
+                              time.perf_counter() - t_start, t_timeout))
+        t_ask = time.perf_counter_ns()
+        i_bytes_now = int(vx_handle.ask('CAPTUREBYTES?'))
+        the_profiler.add('CAPTUREBYTES?', time.perf_counter_ns() - t_ask)
+        if i_bytes_now == i_bytes_captured:
+            if (time.perf_counter() - t_last) > t_timeout:
+                print('\n\n**** CAPTURE TIMEOUT! ****')
+                if not i_bytes_now:
+                    print('**** NO DATA CAPTURED - missing trigger? ****\n')
+                    sys.exit(-1)
+                break
+        else:
+            t_last = time.perf_counter()
+        i_bytes_captured = i_bytes_now
+        i_blocks_done = min(i_bytes_captured // 1024, i_blocks_wanted)
+        if i_blocks_done > i_block_offset:      # pull what is finished, up to 64 blocks at a time
+            i_block_cnt = min(64, i_blocks_done - i_block_offset)
+            i_block_offset += get_blocks(vx_handle, mv_data, i_block_offset, i_block_cnt) // 1024
+            yield min(i_block_offset * 1024, i_bytes_wanted), i_bytes_captured
+        if b_show_status:
+            show_status('dut has captured %4d of %4d samples'%
+                        (i_bytes_captured / (4 * len(s_channels)), i_wait_count),
+                        '%d blocks retrieved'%i_block_offset)
+    t_end = time.perf_counter()
+    vx_handle.write('CAPTURESTOP')
+    print('capture took %.3f seconds. Retrieving the last %d blocks...'%
+          (t_end-t_start, max(0, i_blocks_wanted - i_block_offset)))
+    mv_data.release()
+    retrieve_data(vx_handle, i_bytes_captured, i_wait_count, s_channels, f_data, i_block_offset)
+    yield len(f_data) * 4, i_bytes_captured
+
+
+def capture_pipelined(vx_handle, s_mode, s_channels, i_wait_count, t_timeout, b_show_status, f_rate, b_start=True): #pylint: disable=R0913
+    """ Run iter_capture() to the end.
+        return the captured byte count and the floats in an array.array('f')
+    """
+    f_data = array.array('f', bytes(i_wait_count * 4 * len(s_channels)))
+    i_bytes_captured = 0
+    for _, i_bytes_captured in iter_capture(vx_handle, s_mode, s_channels, t_timeout, b_show_status, f_rate, f_data, b_start):   #pylint: disable=C0301
+        pass
+    return i_bytes_captured, f_data
+
+
+def parse_block_header(buf):
+    """ Check the IEEE-488.2 definite length block header CAPTUREGET? sends, #nccccxxxxxxx...
+        n is the number of length digits cccc and x the little-endian float bytes (manual page 139).
+        return the offset and length of the data. Raise ValueError if the header is bad
+        or the data is shorter than it says.
+    """
+    if len(buf) < 2 or buf[0] != ord('#') or not chr(buf[1]).isdigit() or buf[1] == ord('0'):
+        raise ValueError('no #n block header')
+    i_start = 2 + buf[1] - ord('0')
+    s_len = bytes(buf[2:i_start])
+    if len(s_len) < i_start - 2 or not s_len.isdigit():
+        raise ValueError('bad block length %r'%s_len)
+    i_len = int(s_len)
+    if len(buf) < i_start + i_len:
+        raise ValueError('%d data bytes of %d'%(len(buf) - i_start, i_len))
+    return i_start, i_len
+
+
+def get_blocks(vx_handle, mv_data, i_block_offset, i_block_cnt):
+    """ Send CAPTUREGET? for i_block_cnt 1 kB blocks from i_block_offset and copy the data
+        into mv_data, a byte memoryview of the whole capture, at the same offset.
+        return the number of bytes copied, 0 if the dut sent nothing usable.
+    """
+    t_ask = time.perf_counter_ns()
+    vx_handle.write('CAPTUREGET? %d, %d'%(i_block_offset, i_block_cnt))
+    buf = vx_handle.read_raw()         # read whatever dut sends
+    the_profiler.add('CAPTUREGET?', time.perf_counter_ns() - t_ask, len(buf))
+    try:
+        i_start, i_len = parse_block_header(buf)
+    except ValueError as err:
+        print('bad response from dut for block %d: %s'%(i_block_offset, err))
+        return 0
+    i_pos = i_block_offset * 1024
+    i_copy = min(i_len, i_block_cnt * 1024, len(mv_data) - i_pos)
+    mv_data[i_pos:i_pos + i_copy] = memoryview(buf)[i_start:i_start + i_copy]
+    return i_copy
+
+
+def retrieve_data(vx_handle, i_bytes_captured, i_wait_count, s_channels, f_data=None, i_block_first=0):   #pylint: disable=R0913
+    """ Use the binary transfer command over vx interface to retrieve the capture buffer,
+        starting at block i_block_first.
         maximum block count for CAPTUREGET? is 64 so loop over blocks as needed to
         get all the desired data.
-        Note: I don't actually look at the data byte count in the response header.
-            Instead, I use the length of the binary buffer returned to calculate
-            the number of floats to convert.
+        The floats go straight into f_data, an array.array('f') for the whole capture that
+        is allocated here if not given. Each reply's payload is copied in place through
+        memoryviews, with its length taken from the block header.
+        return f_data, trimmed to what was retrieved.
     """
-    i_bytes_remaining = min(i_bytes_captured, i_wait_count * 4 * len(s_channels))
-    i_block_offset = 0
-    f_data = []
+    i_bytes_total = min(i_bytes_captured, i_wait_count * 4 * len(s_channels))
+    if f_data is None:
+        f_data = array.array('f', bytes(i_bytes_total))
+    del f_data[i_bytes_total // 4:]
+    mv_data = memoryview(f_data).cast('B')
+    i_block_offset = i_block_first
     i_retries = 0
-    while i_bytes_remaining > 0:
-        i_block_cnt = min(64, int(math.ceil(i_bytes_remaining / 1024.0)))
-        vx_handle.write('CAPTUREGET? %d, %d'%(i_block_offset, i_block_cnt))
-        buf = vx_handle.read_raw()         # read whatever dut sends
-        if not buf:
-            print('empty response from dut for block %d'%i_block_offset)
+    while i_block_offset * 1024 < i_bytes_total:
+        i_block_cnt = min(64, int(math.ceil((i_bytes_total - i_block_offset * 1024) / 1024.0)))
+        i_copied = get_blocks(vx_handle, mv_data, i_block_offset, i_block_cnt)
+        if i_block_offset * 1024 + i_copied < i_bytes_total and i_copied < i_block_cnt * 1024:
+            i_copied -= i_copied % 1024     # a short reply: ask again from its first partial block
             i_retries += 1
             if i_retries > 5:
                 print('\n\n**** TOO MANY RETRIES ATTEMPTING TO GET DATA! ****')
-                if not i_block_offset:
+                if not i_block_offset and not i_copied:
                     print('**** NO DATA RETUNED ****\n')
                     sys.exit(-1)
-
-        # binary block CAPTUREGET returns #nccccxxxxxxx...
-        #   with little-endian float x bytes see manual page 139
-        # if b_show_debug:
-        #   print(' '.join(['%02X'%ord(x) for x in buf[:6]]))
-        #   print(str_blocks_hex(buf[6:262]))
-
-        raw_data = buf[2 + int(buf[1]):]
-        i_bytes_to_convert = min(i_bytes_remaining, len(raw_data))
-        # convert to floats
-        f_block_data = list(unpack_from('<%df'%(i_bytes_to_convert/4), raw_data))
-        # if b_show_debug:
-        #   print(len(f_block_data), 'floats received')
-        #   print(str_blocks_float(f_block_data))
-        f_data += f_block_data
-        i_block_offset += i_block_cnt
-        i_bytes_remaining -= i_block_cnt * 1024
+                mv_data.release()
+                del f_data[(i_block_offset * 1024 + i_copied) // 4:]
+                return f_data
+        i_block_offset += int(math.ceil(i_copied / 1024.0))
+    mv_data.release()
+    if sys.byteorder == 'big':
+        f_data.byteswap()
     return f_data
 
 
 def write_to_file(file_name, s_channels, f_data, open_mode='a'):
-    """ Save ASCII data to a comma separated file. We could also have used the csv python module...
+    """ Save ASCII data to a comma separated file using the chunked exporter shared with stream.py
     """
     if f_data:
         show_status('writing %s ...'%file_name)
-        with open(file_name, open_mode) as f_out:
-            s_fmt = '%+12.6e,'*len(s_channels)
-            f_out.write(''.join(['%s,'%str.upper(v) for v in s_channels])+'\n')
-            for i in range(0, len(f_data)//len(s_channels), len(s_channels)):
-                a_line = f_data[i:i+len(s_channels)]
-                f_out.write(s_fmt%tuple(a_line)+'\n')
-            show_status('%s written'%file_name)
+        export.write_csv(file_name, s_channels, [f_data], open_mode, b_threads=True)
+        show_status('%s written'%file_name)
     else:
         show_status('no data! File not writtten!')
 
@@ -231,7 +367,75 @@ def interrupt_handler(signum, frame):  #pylint: disable=W0613
                   # removes the close process behaviour of Ctrl-C
 
 
-signal.signal(signal.SIGINT, interrupt_handler)
+class Capture:      #pylint: disable=R0902
+    """ One capture on an SR865 inside another python program, e.g.
+
+            with cap860.Capture('172.25.98.253', 'XY', 100000) as capture:
+                for block in capture:
+                    use(block)
+
+        open() connects and configures the instrument. Iterating starts the capture and yields
+        array.array('f') blocks of i_block samples (channels interleaved, the last block may be
+        shorter) as the pipelined retrieval of iter_capture() brings them in, while the capture
+        is still running. The instrument's capture buffer holds everything not yet retrieved, so
+        a slow consumer only delays the retrieval; at most one CAPTUREGET? (64 kB) is fetched
+        ahead of it. f_data holds the whole capture afterwards.
+    """
+    def __init__(self, s_address, s_channels='X', i_wait_count=500, s_mode='IMM', t_timeout=5.0,   #pylint: disable=R0913
+                 i_block=None, b_show_status=False):
+        self.s_address = s_address
+        self.s_channels = s_channels
+        self.i_wait_count = i_wait_count
+        self.s_mode = s_mode
+        self.t_timeout = t_timeout
+        self.i_block = i_block or 256   # samples per block
+        self.b_show_status = b_show_status
+        self.vx_ifc = None
+        self.f_rate = None
+        self.f_data = None
+        self.i_bytes_captured = 0
+        self.b_running = False          # CAPTURESTART sent, CAPTURESTOP not yet
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """ open the vxi11 session, configure the capture and stop any capture in progress
+        """
+        print('opening VXI-11 at %s ...'%self.s_address, end=' ')
+        self.vx_ifc = open_instrument(self.s_address)
+        print('done')
+        self.f_rate = dut_config(self.vx_ifc, self.s_channels, self.i_wait_count)
+        self.vx_ifc.write('CAPTURESTOP')                     # stop any current capture
+
+    def __iter__(self):
+        """ start the capture and yield the blocks as they are retrieved
+        """
+        i_vals_block = self.i_block * len(self.s_channels)
+        self.f_data = array.array('f', bytes(self.i_wait_count * 4 * len(self.s_channels)))
+        i_vals_out = 0
+        self.b_running = True
+        for i_bytes_ready, self.i_bytes_captured in iter_capture(self.vx_ifc, self.s_mode, self.s_channels, self.t_timeout, self.b_show_status, self.f_rate, self.f_data):   #pylint: disable=C0301
+            while i_bytes_ready // 4 - i_vals_out >= i_vals_block:
+                yield self.f_data[i_vals_out:i_vals_out + i_vals_block]
+                i_vals_out += i_vals_block
+        self.b_running = False
+        if len(self.f_data) > i_vals_out:
+            yield self.f_data[i_vals_out:]
+
+    def close(self):
+        """ stop a capture left running and close vxi11. Safe to call more than once.
+        """
+        if self.vx_ifc is not None:
+            if self.b_running:
+                self.vx_ifc.write('CAPTURESTOP')
+                self.b_running = False
+            self.vx_ifc.close()
+            self.vx_ifc = None
 
 
 
@@ -249,32 +453,47 @@ def enforce_choice(key, d_obj, allowed):
 def test(options):
     """ the main program -----------------------------------------------
     """
-    # global the_vx_ifc
+    global the_capture      #pylint: disable=W0603,C0103
 
     # group the docopt stuff to make it easier to remove, if desired
     dut_add = options['--address']                # IP address of the SR86x
     i_wait_count = int(options['--count'])         # how many points to capture
     f_name = options['--file']                     # file to write, if file name provided
+    f_name_binary = options['--output']            # binary file to write, if file name provided
     b_show_status = not options['--silent']
     b_show_debug = options['--debug']
+    b_pipeline = options['--pipeline']
+    the_profiler.b_enabled = options['--profile'] is not None
     t_timeout = float(options['--wait'])           # give up if >'wait' seconds between points
 
     s_channels = enforce_choice('--vars', options, ['X', 'XY', 'RT', 'XYRT'])
     s_mode = enforce_choice('--mode', options, ['IMM', 'TRIG', 'SAMP',])
+    if options['--compress'] is not None:
+        try:
+            export.parse_compress(options['--compress'])
+        except ValueError as err:
+            print(err)
+            sys.exit(-1)
 
     # --------------- setup the capture ---------------------------
-    open_interfaces(dut_add)                    # sets the the_vx_ifc global to our comm object
-    f_rate_max = dut_config(the_vx_ifc, s_channels, i_wait_count)
-    the_vx_ifc.write('CAPTURESTOP')                     # stop any current capture
+    the_capture = Capture(dut_add, s_channels, i_wait_count, s_mode, t_timeout, b_show_status=b_show_status)   #pylint: disable=C0301
+    the_capture.open()
+    signal.signal(signal.SIGINT, interrupt_handler)
+    vx_ifc = the_capture.vx_ifc
+    f_rate = the_capture.f_rate
 
-    show_status('waiting for capture (at least %.1f seconds)...'%(i_wait_count/f_rate_max))
+    show_status('waiting for capture (at least %.1f seconds)...'%(i_wait_count/f_rate))
     if 'IMM' not in s_mode:
         show_status('FYI: apply trigger to BNC')
 
     # --------------- capture the data and retieve it from the dut ------------
-    i_bytes_captured = capture_data(the_vx_ifc, s_mode, s_channels, \
-                                    i_wait_count, t_timeout, b_show_status)
-    f_data = retrieve_data(the_vx_ifc, i_bytes_captured, i_wait_count, s_channels)
+    if b_pipeline:
+        i_bytes_captured, f_data = capture_pipelined(vx_ifc, s_mode, s_channels, i_wait_count, \
+                                                     t_timeout, b_show_status, f_rate)
+    else:
+        i_bytes_captured = capture_data(vx_ifc, s_mode, s_channels, i_wait_count, \
+                                        t_timeout, b_show_status, f_rate)
+        f_data = retrieve_data(vx_ifc, i_bytes_captured, i_wait_count, s_channels)
 
     # ------------- display or write the data to a file -----------------------
     if b_show_debug and i_bytes_captured:
@@ -284,10 +503,27 @@ def test(options):
         print(str_blocks_float(f_data[-16:]))
 
     if f_name is not None:
+        t_start = time.perf_counter_ns()
         write_to_file(f_name, s_channels, f_data, 'w')
+        the_profiler.add('write_to_file', time.perf_counter_ns() - t_start, len(f_data))
+    if f_name_binary is not None:
+        t_start = time.perf_counter_ns()
+        export.write_binary(f_name_binary, s_channels, f_rate, f_data, s_compress=options['--compress'])   #pylint: disable=C0301
+        the_profiler.add('write_binary', time.perf_counter_ns() - t_start, len(f_data))
+        show_status('%s written'%f_name_binary)
     cleanup()
+    if options['--profile'] is not None:
+        for s_line in the_profiler.report():
+            print(s_line)
+        if options['--profile'] != '-':
+            the_profiler.dump(options['--profile'])
 
 
 if __name__ == '__main__':
+    try:
+        import docopt       # useStr (above) defines the syntax and documents it at the same time.
+    except ImportError:
+        print('python docopt library not found. Please install docopt or remove the docopt code from test() and main') #pylint: disable=C0301
+        sys.exit(-1)
     OPTS = docopt.docopt(USE_STR, version='0.0.2')
     test(OPTS)
@@ -0,0 +1,365 @@
+# encoding: utf-8
+
+# Copyright (c) 2015-2019 Stanford Research Systems
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnshished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+""" Comma separated and binary file export shared by stream.py and cap860.py
+
+        Rows are formatted a chunk at a time: one % operation builds the text for
+        CHUNK_ROWS rows, which then goes to the file in a single write.
+        Binary files start with a JSON header line padded to BINARY_HEADER_BYTES,
+        followed by the little-endian samples, or by independently compressed chunks
+        of them (ChunkWriter and ChunkReader).
+"""
+import array
+import bz2
+import collections
+import json
+import lzma
+import os
+import struct
+import sys
+import zlib
+
+
+CHUNK_ROWS = 4096       # rows formatted and written together
+BINARY_HEADER_BYTES = 256       # the JSON header line is padded to this size so it can be
+                                # rewritten in place
+
+
+def flatten(block):
+    """ Samples arrive as numpy arrays (any shape), lists of sample lists, or flat lists.
+        return a flat list of python numbers.
+    """
+    if hasattr(block, 'ravel'):
+        return block.ravel().tolist()
+    if isinstance(block, array.array):
+        return block.tolist()
+    if block and isinstance(block[0], (list, tuple)):
+        return [v for smpl in block for v in smpl]
+    return list(block)
+
+
+def format_chunk(s_row_fmt, lst_vals, count_vars):
+    """ return the text for all the complete rows in lst_vals
+    """
+    count_rows = len(lst_vals) // count_vars
+    return (s_row_fmt*count_rows)%tuple(lst_vals[:count_rows*count_vars])
+
+
+def iter_chunks(blocks, count_vars):
+    """ Regroup the values in blocks into flat lists of CHUNK_ROWS rows (the last one may be short).
+        numpy and array.array blocks are converted to python numbers a chunk at a time to keep
+        memory down.
+    """
+    count_chunk = CHUNK_ROWS*count_vars
+    lst_vals = []
+    for block in blocks:
+        if hasattr(block, 'ravel') or isinstance(block, array.array):
+            flat = block.ravel() if hasattr(block, 'ravel') else block
+            lst_pieces = (flat[i:i+count_chunk].tolist() for i in range(0, len(flat), count_chunk))
+        else:
+            lst_pieces = [flatten(block)]
+        for lst_piece in lst_pieces:
+            lst_vals += lst_piece
+            i_end = len(lst_vals) - len(lst_vals)%count_chunk
+            for i in range(0, i_end, count_chunk):
+                yield lst_vals[i:i+count_chunk]
+            lst_vals = lst_vals[i_end:]
+    if lst_vals:
+        yield lst_vals
+
+
+def write_csv(f_name, s_channels, blocks, open_mode='w', b_threads=False, b_header=True):   #pylint: disable=too-many-arguments
+    """ Save data to a comma separated file with a header line of channel names.
+        s_channels is "X" or "XY", etc indicating how many values in a sample
+        blocks is a list of sample blocks. Floats are written %+12.6e and ints %+d.
+        With b_threads, chunk N+1 is formatted on a worker thread while chunk N is written.
+        b_header=False leaves out the header line, for pieces of a file written separately.
+        return the number of rows written.
+    """
+    count_vars = len(s_channels)
+    blocks = [b for b in blocks if len(b)]
+    if not blocks:
+        return 0
+    first = flatten(blocks[0][:1])[0]
+    s_row_fmt = ('%+12.6e,' if isinstance(first, float) else '%+d,')*count_vars + '\n'
+    count_rows = 0
+    with open(f_name, open_mode) as f_ptr:
+        if b_header:
+            f_ptr.write(''.join(['%s,'%str.upper(v) for v in s_channels])+'\n')
+        if not b_threads:
+            for lst_vals in iter_chunks(blocks, count_vars):
+                f_ptr.write(format_chunk(s_row_fmt, lst_vals, count_vars))
+                count_rows += len(lst_vals) // count_vars
+            return count_rows
+        from concurrent.futures import ThreadPoolExecutor     #pylint: disable=import-outside-toplevel
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            fut_text = None
+            for lst_vals in iter_chunks(blocks, count_vars):
+                fut_next = pool.submit(format_chunk, s_row_fmt, lst_vals, count_vars)
+                if fut_text is not None:
+                    f_ptr.write(fut_text.result())
+                fut_text = fut_next
+                count_rows += len(lst_vals) // count_vars
+            if fut_text is not None:
+                f_ptr.write(fut_text.result())
+    return count_rows
+
+
+def binary_header(dict_header):
+    """ return dict_header as the padded JSON line that starts a binary file
+    """
+    return json.dumps(dict_header).ljust(BINARY_HEADER_BYTES-1).encode('ascii') + b'\n'
+
+
+def write_binary(f_name, s_channels, f_rate, data, dict_extra=None, s_compress=None):   #pylint: disable=too-many-arguments
+    """ Save an array.array('f') of interleaved samples as a binary file in the format
+        stream.py's BinarySink writes, so stream.read_binary() loads it back.
+        dict_extra adds its keys to the header. s_compress (e.g. "zlib:delta") writes
+        a ChunkWriter container instead.
+        return the number of samples written.
+    """
+    count_samples = len(data) // len(s_channels)
+    dict_header = {'channels': s_channels.upper(), 'rate': f_rate, 'format': '<f4', 'samples': count_samples}   #pylint: disable=line-too-long
+    dict_header.update(dict_extra or {})
+    if sys.byteorder == 'big':
+        data = array.array(data.typecode, data)
+        data.byteswap()
+    if s_compress is not None:
+        writer = ChunkWriter(f_name, dict_header, s_compress)
+        writer.write(memoryview(data).cast('B')[:count_samples*len(s_channels)*4])
+        writer.close()
+        return count_samples
+    with open(f_name, 'wb') as f_ptr:
+        f_ptr.write(binary_header(dict_header))
+        f_ptr.write(memoryview(data)[:count_samples*len(s_channels)])
+    return count_samples
+
+
+# compressed container ----------------------------------------------
+CHUNK_BYTES = 1 << 20       # raw bytes per compressed chunk, a whole number of samples for any
+                            # channel count
+FRAME = struct.Struct('<II')    # in front of each chunk: compressed length, raw length
+CODECS = {'zlib': (lambda b: zlib.compress(b, 1), zlib.decompress),
+          'lzma': (lambda b: lzma.compress(b, preset=1), lzma.decompress),
+          'bz2': (bz2.compress, bz2.decompress)}
+FILTERS = ('none', 'shuffle', 'delta')
+
+
+def parse_compress(s_compress):
+    """ split a --compress value such as "zlib" or "lzma:delta" into (codec, filter).
+        The filter defaults to shuffle. Raise ValueError for anything unknown.
+    """
+    s_codec, _, s_filter = s_compress.lower().partition(':')
+    s_filter = s_filter or 'shuffle'
+    if s_codec not in CODECS or s_filter not in FILTERS:
+        raise ValueError('--compress must be %s, optionally followed by :%s'%('/'.join(CODECS), '/:'.join(FILTERS)))   #pylint: disable=line-too-long
+    return s_codec, s_filter
+
+
+def shuffle(data, i_width):
+    """ regroup the bytes of i_width byte values so byte 0 of every value comes first,
+        then byte 1, and so on. The high bytes of slowly varying values then repeat.
+    """
+    return b''.join(bytes(data[k::i_width]) for k in range(i_width))
+
+
+def unshuffle(data, i_width):
+    """ undo shuffle()
+    """
+    buf = bytearray(len(data))
+    count_vals = len(data) // i_width
+    for k in range(i_width):
+        buf[k::i_width] = data[k*count_vals:(k+1)*count_vals]
+    return bytes(buf)
+
+
+def delta(data, i_width, count_vars, b_undo=False):
+    """ replace each value by its difference from the previous sample's value of the same channel,
+        as unsigned integers of i_width bytes that wrap around, so floats come back bit for bit.
+        b_undo adds the differences back up. Uses numpy if it is installed.
+    """
+    s_type = 'H' if i_width == 2 else 'I'
+    try:
+        import numpy as np      #pylint: disable=import-outside-toplevel
+    except ImportError:
+        vals = array.array(s_type, data)
+        if sys.byteorder == 'big':
+            vals.byteswap()
+        mask = (1 << 8*i_width) - 1
+        rng = range(count_vars, len(vals))
+        if b_undo:
+            for i in rng:
+                vals[i] = (vals[i] + vals[i-count_vars]) & mask
+        else:
+            vals = array.array(s_type, vals[:count_vars].tolist() + [(vals[i] - vals[i-count_vars]) & mask for i in rng])   #pylint: disable=line-too-long
+        if sys.byteorder == 'big':
+            vals.byteswap()
+        return vals.tobytes()
+    vals = np.frombuffer(data, dtype='<u%d'%i_width).reshape(-1, count_vars)
+    if b_undo:
+        return np.cumsum(vals, axis=0, dtype=vals.dtype).tobytes()
+    diffs = vals.copy()
+    diffs[1:] -= vals[:-1]
+    return diffs.tobytes()
+
+
+def pack_chunk(data, s_codec, s_filter, i_width, count_vars):   #pylint: disable=too-many-arguments
+    """ filter and compress one chunk of raw little-endian samples. return it framed.
+    """
+    if s_filter == 'delta':
+        data = delta(data, i_width, count_vars)
+    if s_filter in ('shuffle', 'delta'):
+        data = shuffle(data, i_width)
+    payload = CODECS[s_codec][0](data)
+    return FRAME.pack(len(payload), len(data)) + payload
+
+
+def unpack_chunk(payload, s_codec, s_filter, i_width, count_vars):   #pylint: disable=too-many-arguments
+    """ undo pack_chunk() for one payload, frame removed
+    """
+    data = CODECS[s_codec][1](payload)
+    if s_filter in ('shuffle', 'delta'):
+        data = unshuffle(data, i_width)
+    if s_filter == 'delta':
+        data = delta(data, i_width, count_vars, True)
+    return data
+
+
+class ChunkWriter:      #pylint: disable=too-many-instance-attributes
+    """ Writes a compressed container: the JSON header line of a binary file, with codec,
+        filter and chunk_bytes added, then chunks of CHUNK_BYTES raw bytes, each filtered
+        and compressed on its own behind a FRAME. Chunks are compressed on a pool of
+        i_threads threads (zlib, lzma and bz2 let go of the GIL) and written in order; at
+        most two per thread wait, so a slow disk holds up write() instead of filling memory.
+        Since no chunk depends on another, ChunkReader can decode any one of them alone.
+    """
+    def __init__(self, f_name, dict_header, s_compress, i_threads=None):
+        s_codec, s_filter = parse_compress(s_compress)
+        self.header = dict(dict_header, codec=s_codec, filter=s_filter, chunk_bytes=CHUNK_BYTES, samples=0)   #pylint: disable=line-too-long
+        self.i_width = int(self.header['format'][2:])
+        self.count_vars = len(self.header['channels'])
+        self.bytes_sample = self.i_width*self.count_vars
+        self.i_threads = i_threads or os.cpu_count() or 1
+        from concurrent.futures import ThreadPoolExecutor     #pylint: disable=import-outside-toplevel
+        self.pool = ThreadPoolExecutor(max_workers=self.i_threads)
+        self.dq_pending = collections.deque()     # (future, samples) in file order
+        self.buf = bytearray()
+        self.bytes_compressed = 0
+        self.f_ptr = open(f_name, 'wb')     #pylint: disable=consider-using-with
+        self.f_ptr.write(binary_header(self.header))
+
+    def write(self, data):
+        """ append raw little-endian samples, whole ones only
+        """
+        self.buf += data
+        while len(self.buf) >= CHUNK_BYTES:
+            self._submit(bytes(self.buf[:CHUNK_BYTES]))
+            del self.buf[:CHUNK_BYTES]
+
+    def _submit(self, data):
+        fut = self.pool.submit(pack_chunk, data, self.header['codec'], self.header['filter'], self.i_width, self.count_vars)   #pylint: disable=line-too-long
+        self.dq_pending.append((fut, len(data) // self.bytes_sample))
+        self._drain(2*self.i_threads)
+
+    def _drain(self, count_keep):
+        """ write the finished chunks at the front, and wait for more until at most count_keep
+            are left
+        """
+        while self.dq_pending and (len(self.dq_pending) > count_keep or self.dq_pending[0][0].done()):   #pylint: disable=line-too-long
+            fut, count_samples = self.dq_pending.popleft()
+            chunk = fut.result()
+            self.f_ptr.write(chunk)
+            self.bytes_compressed += len(chunk)
+            self.header['samples'] += count_samples
+
+    def flush(self):
+        """ write what has been compressed, update the sample count in the header and push it
+            to disk
+        """
+        self._drain(len(self.dq_pending))
+        self.f_ptr.seek(0)
+        self.f_ptr.write(binary_header(self.header))
+        self.f_ptr.seek(0, 2)
+        self.f_ptr.flush()
+
+    def close(self):
+        """ compress what is left, wait for every chunk and close
+        """
+        if self.buf:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        self._drain(0)
+        self.pool.shutdown()
+        self.flush()
+        self.f_ptr.close()
+
+
+class ChunkReader:
+    """ Reads a ChunkWriter file. The frames are read to find the chunks, nothing is
+        decompressed until asked for. read() decompresses a range of samples, touching
+        only the chunks that hold it, on a pool of threads when there are several.
+    """
+    def __init__(self, f_name):
+        self.f_name = f_name
+        with open(f_name, 'rb') as f_ptr:
+            self.header = json.loads(f_ptr.read(BINARY_HEADER_BYTES).decode('ascii'))
+            self.lst_offsets = []       # (file offset of the payload, compressed length)
+            count_raw = 0
+            while True:
+                frame = f_ptr.read(FRAME.size)
+                if len(frame) < FRAME.size:
+                    break                   # the end, or a chunk cut short by a crash
+                i_len, i_raw = FRAME.unpack(frame)
+                self.lst_offsets.append((f_ptr.tell(), i_len))
+                count_raw += i_raw
+                f_ptr.seek(i_len, 1)
+        self.i_width = int(self.header['format'][2:])
+        self.count_vars = len(self.header['channels'])
+        self.samples_per_chunk = self.header['chunk_bytes'] // (self.i_width*self.count_vars)
+        self.count_samples = count_raw // (self.i_width*self.count_vars)
+
+    def read_chunk(self, i_chunk):
+        """ return the raw little-endian bytes of chunk i_chunk
+        """
+        i_offset, i_len = self.lst_offsets[i_chunk]
+        with open(self.f_name, 'rb') as f_ptr:
+            f_ptr.seek(i_offset)
+            payload = f_ptr.read(i_len)
+        return unpack_chunk(payload, self.header['codec'], self.header['filter'], self.i_width, self.count_vars)   #pylint: disable=line-too-long
+
+    def read(self, i_first=0, count_samples=None, i_threads=None):
+        """ return samples i_first up to i_first+count_samples (to the end when None)
+            as an array.array, channels interleaved
+        """
+        i_end = self.count_samples if count_samples is None else min(self.count_samples, i_first+count_samples)   #pylint: disable=line-too-long
+        data = array.array('h' if self.i_width == 2 else 'f')
+        if i_end <= i_first:
+            return data
+        rng_chunks = range(i_first // self.samples_per_chunk, (i_end-1) // self.samples_per_chunk + 1)   #pylint: disable=line-too-long
+        from concurrent.futures import ThreadPoolExecutor     #pylint: disable=import-outside-toplevel
+        with ThreadPoolExecutor(max_workers=min(len(rng_chunks), i_threads or os.cpu_count() or 1)) as pool:   #pylint: disable=line-too-long
+            data.frombytes(b''.join(pool.map(self.read_chunk, rng_chunks)))
+        if sys.byteorder == 'big':
+            data.byteswap()
+        i_skip = rng_chunks[0]*self.samples_per_chunk
+        return data[(i_first-i_skip)*self.count_vars:(i_end-i_skip)*self.count_vars]
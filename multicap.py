@@ -0,0 +1,194 @@
+#! /usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) 2015-2019 Stanford Research Systems
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnshished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+""" Example python script to capture from several SR865s at once, typically all
+    waiting on one shared hardware trigger.
+
+        Every instrument gets its own VXI-11 session. A thread pool configures them,
+        arms them, waits on their captures and retrieves their buffers in parallel,
+        so the time from setup to data barely grows with the number of instruments.
+        The captures are saved side by side in one file, row N of every instrument
+        on line N.
+
+        python multicap.py -h        to see the list of options
+        python multicap.py 172.25.98.253 172.25.98.254 -c 10000 -f both.csv
+
+"""
+import array
+from concurrent.futures import ThreadPoolExecutor
+import signal
+import sys
+import time
+
+import cap860
+import export
+
+# you may need to install this python module. vxi11 is imported by cap860.open_instrument()
+try:
+    import docopt           # handy command line parser.
+except ImportError:
+    print('python docopt library not found. Please install docopt')
+
+
+USE_STR = """
+ --Capture Data on several SR865s and save it to one file--
+ Usage:
+  multicap  <address>... [--count=<C>] [--file=<F>] [--mode=<M>] [--output=<O>] [--pipeline] [--silent] [--vars=<V>] [--wait=<W>]
+  multicap -h | --help
+
+ Options:
+  -c --count <C>       number of data points to capture on each instrument [default: 500]
+  -f --file <F>        Name for file output. One row holds a sample from every instrument.
+  -h --help            Show this screen
+  -m --mode <M>        Trigger mode [default: TRIG]  IMM or SAMP are also allowed
+  -o --output <O>      Name for binary output, the same rows as --file
+  -p --pipeline        Retrieve completed blocks while the captures are still running
+  -s --silent          Refrain from printing progress until complete
+  -w --wait <W>        Seconds to wait for a point before timeout [default: 5]
+  -v --vars <V>        Lock-in variables to capture [default: X]    XY, RT, or XYRT are also allowed
+    """
+
+
+class InstrumentCapture:
+    """ One SR865 with its own vxi11 session, capture rate and retrieved data.
+    """
+    def __init__(self, s_address, s_channels, i_wait_count):
+        self.s_address = s_address
+        self.s_channels = s_channels
+        self.i_wait_count = i_wait_count
+        self.vx_ifc = None
+        self.f_rate = None
+        self.i_bytes_captured = 0
+        self.f_data = None
+        self.t_done = None          # seconds from arming to data in hand
+
+    def __str__(self):
+        return self.s_address
+
+    def configure(self):
+        """ open the session, set up the capture and stop any capture in progress
+        """
+        self.vx_ifc = cap860.open_instrument(self.s_address)
+        self.f_rate = cap860.dut_config(self.vx_ifc, self.s_channels, self.i_wait_count)
+        self.vx_ifc.write('CAPTURESTOP')
+
+    def arm(self, s_mode):
+        """ start the capture. In TRIG or SAMP mode it then waits for the trigger
+        """
+        self.vx_ifc.write('CAPTURESTART ONE, %s'%s_mode)
+
+    def collect(self, s_mode, t_timeout, b_pipeline, t_armed):
+        """ wait for the armed capture to finish and retrieve it
+        """
+        if b_pipeline:
+            self.i_bytes_captured, self.f_data = cap860.capture_pipelined(
+                self.vx_ifc, s_mode, self.s_channels, self.i_wait_count, t_timeout, False, self.f_rate, False)   #pylint: disable=line-too-long
+        else:
+            self.i_bytes_captured = cap860.capture_data(
+                self.vx_ifc, s_mode, self.s_channels, self.i_wait_count, t_timeout, False, self.f_rate, False)   #pylint: disable=line-too-long
+            self.f_data = cap860.retrieve_data(self.vx_ifc, self.i_bytes_captured, self.i_wait_count, self.s_channels)   #pylint: disable=line-too-long
+        self.t_done = time.perf_counter() - t_armed
+
+    def close(self):
+        """ close the session
+        """
+        if self.vx_ifc is not None:
+            self.vx_ifc.close()
+
+
+def align(lst_instruments, s_channels):
+    """ Interleave the captures row by row: row N holds sample N of every instrument.
+        Captures that came back short cut every instrument to the shortest.
+        return the array and the number of rows.
+    """
+    count_vars = len(s_channels)
+    count_rows = min(len(x.f_data) for x in lst_instruments) // count_vars
+    count_cols = count_vars * len(lst_instruments)
+    f_rows = array.array('f', bytes(4 * count_rows * count_cols))
+    for i_inst, inst in enumerate(lst_instruments):
+        for i_var in range(count_vars):
+            f_rows[i_inst*count_vars + i_var::count_cols] = inst.f_data[i_var:count_rows*count_vars:count_vars]   #pylint: disable=line-too-long
+    return f_rows, count_rows
+
+
+def capture_all(lst_instruments, s_mode, t_timeout, b_pipeline, b_show_status):   #pylint: disable=too-many-arguments
+    """ configure, arm, wait on and retrieve every instrument, each step in parallel
+    """
+    with ThreadPoolExecutor(max_workers=len(lst_instruments)) as pool:
+        try:
+            list(pool.map(lambda x: x.configure(), lst_instruments))
+            list(pool.map(lambda x: x.arm(s_mode), lst_instruments))
+            t_armed = time.perf_counter()
+            if 'IMM' not in s_mode:
+                cap860.show_status('FYI: apply trigger to BNC on all %d'%len(lst_instruments))
+            lst_futures = [pool.submit(x.collect, s_mode, t_timeout, b_pipeline, t_armed) for x in lst_instruments]   #pylint: disable=line-too-long
+            while not all(x.done() for x in lst_futures):
+                if b_show_status:
+                    cap860.show_status('%d of %d instruments done'%(sum(x.done() for x in lst_futures), len(lst_futures)))   #pylint: disable=line-too-long
+                time.sleep(0.1)
+            for fut in lst_futures:
+                fut.result()            # raise anything a worker hit
+        finally:
+            print('\n cleaning up...', end=' ')
+            list(pool.map(lambda x: x.close(), lst_instruments))
+            print('connections closed')
+    for inst in lst_instruments:
+        print('%s: %d samples at %.3f kS/S, %.3f seconds from arming to data'%(
+            inst, len(inst.f_data) // len(inst.s_channels), inst.f_rate*1e-3, inst.t_done))
+
+
+def test(opts):
+    """ example main()
+    """
+    s_channels = cap860.enforce_choice('--vars', opts, ['X', 'XY', 'RT', 'XYRT'])
+    s_mode = cap860.enforce_choice('--mode', opts, ['IMM', 'TRIG', 'SAMP',])
+    lst_instruments = [InstrumentCapture(s_address, s_channels, int(opts['--count']))
+                       for s_address in opts['<address>']]
+    if len({x.s_address for x in lst_instruments}) != len(lst_instruments):
+        print('each instrument may only be listed once')
+        sys.exit(-1)
+
+    # cap860.py grabs SIGINT for its own global. Here Ctrl-C unwinds capture_all() instead,
+    # which closes every session on the way out.
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    capture_all(lst_instruments, s_mode, float(opts['--wait']), opts['--pipeline'], not opts['--silent'])   #pylint: disable=line-too-long
+
+    if len({x.f_rate for x in lst_instruments}) > 1:
+        print('**** the instruments captured at different rates. Rows are aligned by index only ****')   #pylint: disable=line-too-long
+    f_rows, count_rows = align(lst_instruments, s_channels)
+    if opts['--file'] is not None:
+        with open(opts['--file'], 'w') as f_ptr:
+            f_ptr.write(''.join('%s@%s,'%(s_var, x) for x in lst_instruments for s_var in s_channels) + '\n')   #pylint: disable=line-too-long
+        export.write_csv(opts['--file'], s_channels*len(lst_instruments), [f_rows], 'a', b_threads=True, b_header=False)   #pylint: disable=line-too-long
+        cap860.show_status('%s written'%opts['--file'])
+    if opts['--output'] is not None:
+        export.write_binary(opts['--output'], s_channels*len(lst_instruments), lst_instruments[0].f_rate, f_rows,   #pylint: disable=line-too-long
+                            {'instruments': [x.s_address for x in lst_instruments]})
+        cap860.show_status('%s written'%opts['--output'])
+    print('\n%d aligned rows from %d instruments'%(count_rows, len(lst_instruments)))
+
+
+if __name__ == '__main__':
+    dict_options = docopt.docopt(USE_STR, version='0.0.2')  #pylint: disable=invalid-name
+    test(dict_options)
@@ -0,0 +1,245 @@
+#! /usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) 2015-2019 Stanford Research Systems
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnshished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+""" Example python script to stream from several SR865s at once.
+
+        Every instrument gets its own UDP endpoint, all served by one asyncio event loop,
+        so one host (and one process) can collect from several lock-ins at full rate.
+        Each instrument is configured with its own dut_config() call and keeps its own
+        drop accounting and binary output file.
+
+  ****  Your host computer firewall MUST allow incoming UDP on every streaming port !!! ****
+
+        python multistream.py -h        to see the list of options
+        python multistream.py 172.25.98.253:1865 172.25.98.254:1866 -o run1
+
+"""
+import asyncio
+import math
+import signal
+import sys
+import time
+
+import stream
+
+# you may need to install this python module. vxi11 is imported by stream.open_instrument()
+try:
+    import docopt           # handy command line parser.
+except ImportError:
+    print('python docopt library not found. Please install docopt')
+
+
+USE_STR = """
+ --Stream Data from several SR865s to files--
+ Usage:
+  multistream  <address:port>... [--length=<L>] [--duration=<D>] [--vars=<V>] [--rate=<R>] [--silent] [--output=<O>] [--ints] [--slack=<T>]
+  multistream -h | --help
+
+ Options:
+  -d --duration <D>    How long to transfer in seconds [default: 10]
+  -h --help            Show this screen
+  -i --ints            Data in 16-bit ints instead of 32-bit floats
+  -l --length <L>      Packet length enum (0 to 3) [default: 0]
+  -o --output <O>      Prefix for binary output. Each instrument writes <O>_<address>_<port>.bin
+  -r --rate <R>        Sample rate per second. Actual will be less and depends on filter
+                       settings [default: 1e5]
+  --slack <T>          Seconds of packets each socket receive buffer should hold [default: 0.5]
+  -s --silent          Refrain from printing packet counts until complete
+  -v --vars <V>        Lock-in variables to stream [default: X]    XY, RT, or XYRT are also allowed
+    """
+
+
+class InstrumentStream(asyncio.DatagramProtocol):   #pylint: disable=too-many-instance-attributes
+    """ One SR865 and the UDP endpoint it streams to.
+        Holds its own vxi11 session, dut_config() result, drop accounting and BinarySink.
+    """
+    def __init__(self, s_address, i_port, s_channels, b_integers):
+        self.s_address = s_address
+        self.i_port = i_port
+        self.s_channels = s_channels
+        self.b_integers = b_integers
+        self.vx_ifc = None
+        self.f_rate = 0.0
+        self.bytes_per_pkt = 0
+        self.fmt_unpk = None
+        self.total_packets = 0
+        self.count_packets = 0
+        self.tracker = stream.SequenceTracker()
+        self.lst_batch = []
+        self.lst_dropped = []
+        self.sink = None
+        self.transport = None
+        self.done = None            # future, set when total_packets have arrived
+
+    def __str__(self):
+        return '%s:%d'%(self.s_address, self.i_port)
+
+    def configure(self, idx_pkt_len, f_rate_req, duration_stream, fname_binary):
+        """ open the vxi11 session and set up the instrument. This blocks, so stream_all()
+            runs it in an executor thread for every instrument at once.
+        """
+        self.vx_ifc = stream.open_instrument(self.s_address)
+        self.vx_ifc.write('STREAMPORT %d'%self.i_port)
+        self.f_rate = stream.dut_config(self.vx_ifc, self.s_channels, idx_pkt_len, f_rate_req, self.b_integers)   #pylint: disable=line-too-long
+        self.bytes_per_pkt, self.fmt_unpk, _ = stream.packet_format(idx_pkt_len, self.b_integers, len(self.s_channels))   #pylint: disable=line-too-long
+        self.total_packets = int(math.ceil(duration_stream*self.f_rate*4*len(self.s_channels)/self.bytes_per_pkt))   #pylint: disable=line-too-long
+        if fname_binary is not None:
+            self.sink = stream.BinarySink(fname_binary, self.s_channels, self.f_rate, self.b_integers)   #pylint: disable=line-too-long
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.done.done():
+            return
+        self.lst_batch.append(data)
+        self.count_packets += 1
+        if len(self.lst_batch) >= stream.BATCH_PACKETS or self.count_packets >= self.total_packets:
+            self.decode_batch(self.count_packets >= self.total_packets)
+        if self.count_packets >= self.total_packets:
+            self.done.set_result(self.count_packets)
+
+    def error_received(self, exc):
+        print('\n%s: %s'%(self, exc))
+
+    def decode_batch(self, b_flush=False):
+        """ decode whatever packets are waiting and pass them to the sink.
+            b_flush gives up on any packets still missing.
+        """
+        if not self.bytes_per_pkt:
+            return
+        samples, _, lst_gaps = stream.decode_ordered(self.tracker, b''.join(self.lst_batch), self.bytes_per_pkt+4, self.fmt_unpk, len(self.s_channels), b_flush)   #pylint: disable=line-too-long
+        self.lst_dropped += lst_gaps
+        if samples is not None and self.sink is not None:
+            self.sink.write(samples)
+        self.lst_batch = []
+
+    def stop_receiving(self):
+        """ close the UDP endpoint, so no more datagrams arrive, and decode the packets left.
+            Runs on the event loop thread, which owns the transport, lst_batch and tracker.
+        """
+        if self.transport is not None:
+            self.transport.close()
+        self.decode_batch(True)
+
+    def stop_instrument(self):
+        """ stop the stream and close the vxi11 session. This blocks, so stream_all() runs it
+            in an executor thread.
+        """
+        if self.vx_ifc is not None:
+            self.vx_ifc.write('STREAM OFF')
+            self.vx_ifc.close()
+
+    def close_sink(self):
+        """ close the binary output, once nothing more can be written to it
+        """
+        if self.sink is not None:
+            self.sink.close()
+
+    def show_results(self):
+        """ print the drop statistics for this instrument
+        """
+        print('\n%s at %.3f kS/S'%(self, self.f_rate*1e-3), end='')
+        stream.show_results(sum(x[0] for x in self.lst_dropped), self.count_packets, self.lst_dropped,   #pylint: disable=line-too-long
+                            self.count_packets*self.bytes_per_pkt//(4*len(self.s_channels)), self.tracker.count_late)   #pylint: disable=line-too-long
+
+
+async def show_progress(lst_instruments):
+    """ refresh the status line twice a second until cancelled
+    """
+    while True:
+        stream.show_status('%d instruments'%len(lst_instruments),
+                           ' '.join('%d/%d'%(x.count_packets, x.total_packets) for x in lst_instruments))   #pylint: disable=line-too-long
+        await asyncio.sleep(0.5)
+
+
+async def stream_all(lst_instruments, idx_pkt_len, f_rate_req, duration_stream, s_output, bshow_status, t_slack):   #pylint: disable=too-many-arguments
+    """ configure every instrument, stream from all of them at once and clean up
+    """
+    loop = asyncio.get_running_loop()
+    task_status = None
+    try:
+        await asyncio.gather(*[loop.run_in_executor(None, x.configure, idx_pkt_len, f_rate_req, duration_stream,   #pylint: disable=line-too-long
+                                                    None if s_output is None else '%s_%s_%d.bin'%(s_output, x.s_address, x.i_port))   #pylint: disable=line-too-long
+                               for x in lst_instruments])
+        for inst in lst_instruments:
+            inst.done = loop.create_future()
+            await loop.create_datagram_endpoint(lambda inst=inst: inst, local_addr=('0.0.0.0', inst.i_port))   #pylint: disable=line-too-long
+            stream.tune_socket_buffer(inst.transport.get_extra_info('socket'), inst.f_rate, len(inst.s_channels),   #pylint: disable=line-too-long
+                                      inst.bytes_per_pkt, inst.b_integers, t_slack)
+        time_start = time.perf_counter()
+        await asyncio.gather(*[loop.run_in_executor(None, x.vx_ifc.write, 'STREAM ON') for x in lst_instruments])   #pylint: disable=line-too-long
+        if bshow_status:
+            task_status = asyncio.ensure_future(show_progress(lst_instruments))
+        try:
+            # time out 2 seconds after the expected duration
+            await asyncio.wait_for(asyncio.gather(*[x.done for x in lst_instruments]), duration_stream+2)   #pylint: disable=line-too-long
+        except asyncio.TimeoutError:
+            print('\n**** STREAM TIMEOUT! ****')
+        print('\nTime elapsed: %.3f seconds'%(time.perf_counter()-time_start))
+    finally:
+        if task_status is not None:
+            task_status.cancel()
+        print('\n cleaning up...', end=' ')
+        for inst in lst_instruments:
+            inst.stop_receiving()
+        await asyncio.gather(*[loop.run_in_executor(None, x.stop_instrument) for x in lst_instruments])   #pylint: disable=line-too-long
+        for inst in lst_instruments:
+            inst.close_sink()
+        print('connections closed')
+    for inst in lst_instruments:
+        inst.show_results()
+
+
+def test(opts):
+    """ example main()
+    """
+    lst_vars_allowed = ['X', 'XY', 'RT', 'XYRT']
+    s_channels = str(opts['--vars'])
+    if s_channels.upper() not in lst_vars_allowed:
+        print('bad --vars option (%s). Must be one of'%s_channels.upper(), ', '.join(lst_vars_allowed))   #pylint: disable=line-too-long
+        sys.exit(-1)
+
+    lst_instruments = []
+    for s_pair in opts['<address:port>']:
+        s_address, _, s_port = s_pair.rpartition(':')
+        if not s_address or not s_port.isdigit():
+            print('bad instrument %s. Must be address:port'%s_pair)
+            sys.exit(-1)
+        lst_instruments.append(InstrumentStream(s_address, int(s_port), s_channels, opts['--ints']))
+    if len({x.i_port for x in lst_instruments}) != len(lst_instruments):
+        print('each instrument needs its own UDP port')
+        sys.exit(-1)
+
+    # stream.py grabs SIGINT for its own globals. Here Ctrl-C cancels stream_all() instead,
+    # which stops and closes every instrument on the way out.
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    asyncio.run(stream_all(lst_instruments, int(opts['--length']), float(opts['--rate']),
+                           float(opts['--duration']), opts['--output'], not opts['--silent'],
+                           float(opts['--slack'])))
+
+
+if __name__ == '__main__':
+    dict_options = docopt.docopt(USE_STR, version='0.0.2')  #pylint: disable=invalid-name
+    test(dict_options)
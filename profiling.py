@@ -0,0 +1,118 @@
+# encoding: utf-8
+
+# Copyright (c) 2015-2019 Stanford Research Systems
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnshished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+
+""" Low overhead per-stage timing for stream.py and cap860.py --profile
+
+        The hot loops measure each stage with time.perf_counter_ns() once per batch and call
+        add(); that only bumps a few numbers in a list, so timing a 64 packet batch costs
+        well under a microsecond. Each stage keeps its call and item counts, total, min and
+        max, and a histogram with fixed decade buckets. gauge() does the same for sampled
+        values such as a queue depth. report() formats it all, dump() writes it as JSON.
+        A stage should only be timed from one thread.
+"""
+import bisect
+import json
+
+
+TIME_EDGES_NS = (1000, 10000, 100000, 1000000, 10000000, 100000000, 1000000000)
+TIME_LABELS = ('<=1us', '<=10us', '<=100us', '<=1ms', '<=10ms', '<=100ms', '<=1s', '>1s')
+DEPTH_EDGES = (0, 1, 4, 16, 64, 256, 1024)
+DEPTH_LABELS = ('0', '1', '<=4', '<=16', '<=64', '<=256', '<=1024', '>1024')
+
+
+class Profiler:
+    """ Per-stage timings and sampled values. A Profiler made with b_enabled=False ignores
+        everything, so the hot loops can call it unconditionally.
+    """
+    def __init__(self, b_enabled=True):
+        self.b_enabled = b_enabled
+        self.dict_stages = {}       # name -> [calls, items, total ns, min ns, max ns, buckets]
+        self.dict_gauges = {}       # name -> [samples, sum, min, max, buckets]
+
+    def add(self, s_stage, t_ns, count_items=1):
+        """ hot path: record one call of s_stage that took t_ns and handled count_items
+            (packets, bytes, ...)
+        """
+        if not self.b_enabled:
+            return
+        stage = self.dict_stages.get(s_stage)
+        if stage is None:
+            stage = self.dict_stages[s_stage] = [0, 0, 0, t_ns, t_ns, [0]*(len(TIME_EDGES_NS)+1)]
+        stage[0] += 1
+        stage[1] += count_items
+        stage[2] += t_ns
+        if t_ns < stage[3]:
+            stage[3] = t_ns
+        if t_ns > stage[4]:
+            stage[4] = t_ns
+        stage[5][bisect.bisect_left(TIME_EDGES_NS, t_ns)] += 1
+
+    def gauge(self, s_name, value):
+        """ hot path: record one sample of s_name, e.g. a queue depth
+        """
+        if not self.b_enabled:
+            return
+        gauge = self.dict_gauges.get(s_name)
+        if gauge is None:
+            gauge = self.dict_gauges[s_name] = [0, 0, value, value, [0]*(len(DEPTH_EDGES)+1)]
+        gauge[0] += 1
+        gauge[1] += value
+        gauge[2] = min(gauge[2], value)
+        gauge[3] = max(gauge[3], value)
+        gauge[4][bisect.bisect_left(DEPTH_EDGES, value)] += 1
+
+    def as_dict(self):
+        """ everything recorded, with named fields
+        """
+        return {'time_edges_ns': TIME_EDGES_NS, 'depth_edges': DEPTH_EDGES,
+                'stages': {s_name: dict(zip(('calls', 'items', 'total_ns', 'min_ns', 'max_ns', 'buckets'), stage))   #pylint: disable=line-too-long
+                           for s_name, stage in self.dict_stages.items()},
+                'gauges': {s_name: dict(zip(('samples', 'sum', 'min', 'max', 'buckets'), gauge))
+                           for s_name, gauge in self.dict_gauges.items()}}
+
+    def report(self):
+        """ return the report as a list of lines: a table of the stages by total time,
+            then their histograms, then the gauges
+        """
+        if not self.b_enabled:
+            return []
+        lst_lines = ['%-16s %8s %10s %10s %10s %10s %10s'%('stage', 'calls', 'items', 'total ms', 'mean us', 'min us', 'max us')]   #pylint: disable=line-too-long
+        lst_stages = sorted(self.dict_stages.items(), key=lambda x: -x[1][2])
+        for s_name, (calls, items, total, t_min, t_max, _) in lst_stages:
+            lst_lines.append('%-16s %8d %10d %10.1f %10.1f %10.1f %10.1f'%(s_name, calls, items, total/1e6, total/1e3/calls, t_min/1e3, t_max/1e3))   #pylint: disable=line-too-long
+        lst_lines.append('%-16s '%'calls taking'+' '.join('%7s'%s for s in TIME_LABELS))   #pylint: disable=line-too-long
+        for s_name, stage in lst_stages:
+            lst_lines.append('%-16s '%s_name + ' '.join('%7d'%n for n in stage[5]))
+        if self.dict_gauges:
+            lst_lines.append('%-16s '%'samples of' + ' '.join('%7s'%s for s in DEPTH_LABELS))   #pylint: disable=line-too-long
+            for s_name, (count, total, v_min, v_max, buckets) in self.dict_gauges.items():
+                lst_lines.append('%-16s '%s_name + ' '.join('%7d'%n for n in buckets) +
+                                 '   mean %.1f, min %g, max %g'%(total/count, v_min, v_max))
+        return lst_lines
+
+    def dump(self, f_name):
+        """ write as_dict() to a JSON file
+        """
+        with open(f_name, 'w') as f_ptr:
+            json.dump(self.as_dict(), f_ptr, indent=1)
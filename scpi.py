@@ -0,0 +1,124 @@
+# encoding: utf-8
+
+# Copyright (c) 2015-2019 Stanford Research Systems
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnshished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+
+""" Batched SR865 configuration shared by stream.py and cap860.py
+
+        Settings are collected and sent as one semicolon-joined command string, so a
+        whole configuration costs one VXI-11 round trip. A per-address cache remembers
+        what was last written, and writes that would not change anything are left out.
+        Limits such as STREAMRATEMAX? are queried once per address and stream or capture
+        configuration (CONFIG_HEADERS), and kept until a filter setting or command sent
+        through here changes them. Settings that are not limits, e.g. CAPTURERATE?, go
+        through ask() and are never cached.
+        The cache assumes nothing else (front panel, another program, a filter written
+        straight to the vxi11 session) changes the instrument while this process runs.
+        After such a change call forget_limits(), or forget() to drop all that is known.
+"""
+
+
+FILTER_HEADERS = ('OFLT', 'OFSL', 'SYNC')    # time constant, slope and sync filter: they set the
+                                             # max rates
+# the limits are cached per value of these
+CONFIG_HEADERS = ('STREAMCH', 'STREAMFMT', 'STREAMPCKT', 'CAPTURECFG')
+
+dict_cache = {}         # address -> {'settings': {header: value}, 'limits': {query: answer}}   #pylint: disable=invalid-name
+
+
+def cache_for(vx_ifc):
+    """ return the cache entry of the instrument behind a vxi11 session
+    """
+    return dict_cache.setdefault(getattr(vx_ifc, 'host', id(vx_ifc)), {'settings': {}, 'limits': {}})   #pylint: disable=line-too-long
+
+
+def forget(vx_ifc):
+    """ drop everything cached for this instrument, e.g. after a power cycle
+    """
+    dict_cache.pop(getattr(vx_ifc, 'host', id(vx_ifc)), None)
+
+
+def forget_limits(vx_ifc):
+    """ drop the cached limits of this instrument, e.g. after writing OFLT to it directly
+    """
+    cache_for(vx_ifc)['limits'].clear()
+
+
+class Batch:
+    """ Collects commands for one instrument and sends them in a single write.
+        command() always goes out, setting() only when the value differs from the cache.
+        Use it as a context manager to send() on the way out.
+    """
+    def __init__(self, vx_ifc):
+        self.vx_ifc = vx_ifc
+        self.cache = cache_for(vx_ifc)
+        self.lst_cmds = []
+        self.dict_pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    def command(self, s_cmd):
+        """ queue a command that is sent whatever the cache says, e.g. STREAM OFF
+        """
+        self.lst_cmds.append(s_cmd)
+
+    def setting(self, s_header, value):
+        """ queue "s_header value" unless the instrument already has that value
+        """
+        s_value = str(value).upper()
+        if self.cache['settings'].get(s_header) == s_value:
+            return
+        self.lst_cmds.append('%s %s'%(s_header, s_value))
+        self.dict_pending[s_header] = s_value
+
+    def limit(self, s_query):
+        """ return the answer to s_query (e.g. STREAMRATEMAX?), asked only once per address
+            and configuration. Anything queued is sent first, in case it matters to the answer.
+        """
+        self.send()
+        tpl_key = (s_query,) + tuple(self.cache['settings'].get(s_header) for s_header in CONFIG_HEADERS)   #pylint: disable=line-too-long
+        if tpl_key not in self.cache['limits']:
+            self.cache['limits'][tpl_key] = self.vx_ifc.ask(s_query)
+        return self.cache['limits'][tpl_key]
+
+    def ask(self, s_query):
+        """ send anything queued, then return the answer to s_query, never cached
+        """
+        self.send()
+        return self.vx_ifc.ask(s_query)
+
+    def send(self):
+        """ write everything queued as one semicolon-joined string and update the cache
+        """
+        if not self.lst_cmds:
+            return
+        self.vx_ifc.write(';'.join(self.lst_cmds))
+        self.cache['settings'].update(self.dict_pending)
+        if any(s_cmd.split()[0].upper() in FILTER_HEADERS for s_cmd in self.lst_cmds):
+            self.cache['limits'].clear()
+        self.lst_cmds = []
+        self.dict_pending = {}
@@ -0,0 +1,238 @@
+# encoding: utf-8
+
+# Copyright (c) 2015-2019 Stanford Research Systems
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnshished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+""" A local stand-in for an SR865, for load testing stream.py and cap860.py without hardware.
+
+        Instrument() has the same write/ask/read_raw/close methods as vxi11.Instrument and
+        answers the SCPI subset the scripts use. On STREAM ON it sends correctly framed
+        packets (32 bit header with the 8 bit counter, big-endian payload) to 127.0.0.1
+        on the STREAMPORT, paced at STREAMRATEMAX/2^STREAMRATE samples per second.
+        Packets can be dropped or swapped with their neighbour at random to exercise the
+        drop accounting.
+
+        Swap it in for the real thing by replacing the vxi11 module a script uses:
+            stream.vxi11 = sr865sim
+        or, with non-default settings,
+            stream.vxi11 = types.SimpleNamespace(Instrument=functools.partial(sr865sim.Instrument, f_drop=0.01))   #pylint: disable=line-too-long
+"""
+import math
+import random
+import socket
+from struct import pack
+import threading
+import time
+
+
+class Instrument:       #pylint: disable=too-many-instance-attributes
+    """ Simulated SR865 reached through the vxi11.Instrument interface.
+        f_rate_max is the STREAMRATEMAX? answer, f_capture_rate_max the CAPTURERATEMAX? answer.
+        f_drop is the fraction of stream packets never sent, f_reorder the fraction sent
+        after the packet that follows them. i_seed makes the drops repeatable.
+    """
+    def __init__(self, host='127.0.0.1', f_rate_max=1.25e6, f_capture_rate_max=3.255e5,  #pylint: disable=too-many-arguments
+                 f_drop=0.0, f_reorder=0.0, i_seed=0):
+        self.host = host
+        self.f_rate_max = f_rate_max
+        self.f_capture_rate_max = f_capture_rate_max
+        self.f_drop = f_drop
+        self.f_reorder = f_reorder
+        self.rand = random.Random(i_seed)
+        self.settings = {'STREAMPORT': 1865, 'STREAMCH': 0, 'STREAMFMT': 0, 'STREAMOPTION': 0,
+                         'STREAMPCKT': 0, 'STREAMRATE': 0, 'CAPTURECFG': 0, 'CAPTURELEN': 256, 'CAPTURERATE': 0}   #pylint: disable=line-too-long
+        self.count_sent = 0             # stream packets sent since the last STREAM ON
+        self.t_sending = 0.0            # seconds the last stream ran
+        self.stream_thread = None
+        self.stream_on = threading.Event()
+        self.t_capture_start = None
+        self.t_capture_stop = None
+        self.response = b''             # what the next read_raw() returns
+
+    # ------------- vxi11.Instrument interface ------------------------
+    def write(self, s_cmd):
+        """ accepts one command or several joined with semicolons
+        """
+        for s_one in s_cmd.split(';'):
+            if s_one.strip():
+                self._command(s_one.strip())
+
+    def ask(self, s_cmd):
+        """ send a query and return the answer as a string
+        """
+        self.write(s_cmd)
+        return self.read_raw().decode('ascii').strip()
+
+    def read_raw(self):
+        """ return the response to the last query
+        """
+        response, self.response = self.response, b''
+        return response
+
+    def close(self):
+        """ stops the stream, like dropping the connection to the instrument would
+        """
+        self._stream_off()
+
+    # ------------- SCPI parsing ----------------------------------------
+    lst_channels = ['X', 'XY', 'RT', 'XYRT']
+
+    def _command(self, s_cmd):
+        s_head, _, s_args = s_cmd.partition(' ')
+        s_head = s_head.upper()
+        lst_args = [x.strip() for x in s_args.split(',')] if s_args else []
+        if s_head == '*IDN?':
+            self._answer('Stanford_Research_Systems,SR865,sim,1.0')
+        elif s_head == 'STREAM':
+            if lst_args[0].upper() in ('ON', '1'):
+                self._stream_on()
+            else:
+                self._stream_off()
+        elif s_head == 'STREAMRATEMAX?':
+            self._answer('%g'%self.f_rate_max)
+        elif s_head == 'CAPTURERATEMAX?':
+            self._answer('%g'%self.f_capture_rate_max)
+        elif s_head in ('STREAMCH', 'CAPTURECFG'):
+            self.settings[s_head] = self._enum(lst_args[0], self.lst_channels)
+        elif s_head in self.settings:
+            self.settings[s_head] = int(lst_args[0])
+        elif s_head.endswith('?') and s_head[:-1] in self.settings:
+            self._answer('%d'%self.settings[s_head[:-1]])
+        elif s_head == 'CAPTURESTART':
+            self.t_capture_start = time.perf_counter()
+            self.t_capture_stop = None
+        elif s_head == 'CAPTURESTOP':
+            if self.t_capture_start is not None and self.t_capture_stop is None:
+                self.t_capture_stop = time.perf_counter()
+        elif s_head == 'CAPTUREBYTES?':
+            self._answer('%d'%self._capture_bytes())
+        elif s_head == 'CAPTUREGET?':
+            self._capture_get(int(lst_args[0]), int(lst_args[1]))
+        else:
+            raise ValueError('sr865sim does not know %s'%s_cmd)
+
+    @staticmethod
+    def _enum(s_arg, lst_names):
+        return int(s_arg) if s_arg.isdigit() else lst_names.index(s_arg.upper())
+
+    def _answer(self, s_text):
+        self.response = (s_text + '\n').encode('ascii')
+
+    # ------------- streaming -------------------------------------------
+    def stream_params(self):
+        """ return the packet size (header excluded), sample rate and packet rate
+            for the current settings
+        """
+        bytes_per_pkt = [1024, 512, 256, 128][self.settings['STREAMPCKT']]
+        count_vars = len(self.lst_channels[self.settings['STREAMCH']])
+        bytes_per_val = 2 if self.settings['STREAMFMT'] else 4
+        f_rate = self.f_rate_max / 2.0**self.settings['STREAMRATE']
+        return bytes_per_pkt, f_rate, f_rate*count_vars*bytes_per_val/bytes_per_pkt
+
+    def sent_rate(self):
+        """ return the packets per second the last stream actually sent, which falls short of
+            the packet rate when this python thread can't keep up
+        """
+        return self.count_sent / self.t_sending if self.t_sending else 0.0
+
+    def make_payloads(self):
+        """ 256 payloads, one per counter value, so the stream repeats every 256 packets.
+            Each holds a slow ramp in every channel.
+        """
+        bytes_per_pkt, _, _ = self.stream_params()
+        s_fmt = 'h' if self.settings['STREAMFMT'] else 'f'
+        count_vals = bytes_per_pkt // (2 if self.settings['STREAMFMT'] else 4)
+        b_little = self.settings['STREAMOPTION'] & 1
+        s_order = '<' if b_little else '>'
+        lst_payloads = []
+        for i_cntr in range(256):
+            lst_vals = [(i_cntr*count_vals + i) % 30000 for i in range(count_vals)]
+            lst_payloads.append(pack('%s%d%s'%(s_order, count_vals, s_fmt), *lst_vals))
+        return lst_payloads
+
+    def _stream_on(self):
+        self._stream_off()
+        self.stream_on.set()
+        self.stream_thread = threading.Thread(target=self._send_packets, daemon=True)
+        self.stream_thread.start()
+
+    def _stream_off(self):
+        self.stream_on.clear()
+        if self.stream_thread is not None:
+            self.stream_thread.join()
+            self.stream_thread = None
+
+    def _send_packets(self):
+        """ stream thread: send whatever packets are due about once a millisecond
+        """
+        _, _, f_pkt_rate = self.stream_params()
+        lst_payloads = self.make_payloads()
+        address = ('127.0.0.1', self.settings['STREAMPORT'])
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.count_sent = 0
+        i_pkt = 0
+        held = None                     # a packet being sent late to simulate reordering
+        t_start = time.perf_counter()
+        while self.stream_on.is_set():
+            i_due = int((time.perf_counter() - t_start) * f_pkt_rate)
+            while i_pkt < i_due:
+                buf = pack('>I', i_pkt & 0xff) + lst_payloads[i_pkt & 0xff]
+                i_pkt += 1
+                if self.f_drop and self.rand.random() < self.f_drop:
+                    continue
+                if held is None and self.f_reorder and self.rand.random() < self.f_reorder:
+                    held = buf
+                    continue
+                sock.sendto(buf, address)
+                self.count_sent += 1
+                if held is not None:
+                    sock.sendto(held, address)
+                    self.count_sent += 1
+                    held = None
+            time.sleep(0.001)
+        self.t_sending = time.perf_counter() - t_start
+        sock.close()
+
+    # ------------- capture buffer --------------------------------------
+    def _capture_bytes(self):
+        if self.t_capture_start is None:
+            return 0
+        t_end = self.t_capture_stop if self.t_capture_stop is not None else time.perf_counter()
+        count_vars = len(self.lst_channels[self.settings['CAPTURECFG']])
+        i_len = 1024 * 2 * math.ceil(self.settings['CAPTURELEN'] / 2.0)    # rounded up to even kB
+        i_bytes = int((t_end - self.t_capture_start) * self.f_capture_rate_max / 2.0**self.settings['CAPTURERATE']) * 4 * count_vars   #pylint: disable=line-too-long
+        return min(i_bytes, i_len)
+
+    def capture_value(self, i_index):
+        """ the float stored at value index i_index of the capture buffer
+        """
+        return float(i_index % 30000)
+
+    def _capture_get(self, i_block, i_count):
+        """ IEEE-488.2 definite length block of little-endian floats, 1 kB per block
+        """
+        if i_count > 64:
+            raise ValueError('CAPTUREGET? count is limited to 64 blocks')
+        i_first = i_block * 256
+        i_last = min((i_block + i_count) * 256, self._capture_bytes() // 4)
+        data = pack('<%df'%max(0, i_last-i_first), *[self.capture_value(i) for i in range(i_first, i_last)])   #pylint: disable=line-too-long
+        s_len = '%d'%len(data)
+        self.response = ('#%d%s'%(len(s_len), s_len)).encode('ascii') + data
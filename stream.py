@@ -36,43 +36,112 @@
         for compatability with your network.
 
 """
+import array
+import collections
+import contextlib
+import json
 import math
+import io
+import itertools
+import os
+import shlex
+import shutil
 import socket
-from struct import unpack_from
+from struct import pack, pack_into, unpack_from
 import signal
 import sys
 import time
 import threading
 import queue
 
-# you may need to install these python modules
-try:
-    import vxi11            # required
-except ImportError:
-    print('required python vxi11 library not found. Please install vxi11')
+import export
+import profiling
+import scpi
 
-try:
-    import docopt           # handy command line parser.
-except ImportError:
-    print('python docopt library not found. Please install docopt')
+# vxi11 (required), docopt and numpy (optional) are imported the first time they are used,
+# by open_instrument(), the __main__ block and load_numpy(), so that importing stream as a
+# library, and starting the command line, stay quick. So are the heavier standard modules
+# only some options need: http.server (--metrics), multiprocessing (--process, --jobs),
+# concurrent.futures (--segment, --jobs) and subprocess (--hook).
+vxi11 = None                #pylint: disable=invalid-name
+np = None                   #pylint: disable=invalid-name
+b_numpy_tried = False       #pylint: disable=invalid-name
+
+
+def open_instrument(s_address):
+    """ return a vxi11 session with the SR865 at s_address, importing vxi11 if need be
+    """
+    global vxi11            #pylint: disable=global-statement, invalid-name
+    if vxi11 is None:
+        try:
+            import vxi11    #pylint: disable=redefined-outer-name, import-outside-toplevel
+        except ImportError:
+            print('required python vxi11 library not found. Please install vxi11')
+            raise
+    return vxi11.Instrument(s_address)
+
+
+def load_numpy():
+    """ import numpy the first time it is wanted. return it, or None when it is not installed.
+        Packets are decoded one at a time without it.
+    """
+    global np, b_numpy_tried    #pylint: disable=global-statement, invalid-name
+    if np is None and not b_numpy_tried:
+        b_numpy_tried = True
+        try:
+            import numpy as np      #pylint: disable=redefined-outer-name, import-outside-toplevel
+        except ImportError:
+            print('python numpy library not found. Decoding will be slower without numpy')
+    return np
 
 
 USE_STR = """
  --Stream Data from an SR865 to a file--
  Usage:
-  stream  [--address=<A>] [--length=<L>] [--port=<P>] [--duration=<D>] [--vars=<V>] [--rate=<R>] [--silent] [--thread] [--file=<F>] [--ints]
+  stream  [--address=<A>] [--length=<L>] [--port=<P>] [--duration=<D>] [--vars=<V>] [--rate=<R>] [--silent] [--thread | --buffer | --process | --record=<R> | --continuous] [--stamp] [--file=<F>] [--output=<O>] [--ints] [--slack=<T>] [--autotune] [--metrics=<M>] [--segment=<S>] [--hook=<H>] [--analyze=<Z>] [--decimate=<N>] [--index] [--compress=<C>] [--profile=<P>]
+  stream decode <record> [--file=<F>] [--output=<O>] [--silent] [--jobs=<J>] [--shards] [--index]
   stream -h | --help
 
  Options:
   -a --address <A>     IP address of SR865 [default: 172.25.98.253]
+  --analyze <Z>        Keep running stats, envelopes and a noise spectral density in the JSON
+                       summary file <Z>.
+                       The decimated stream goes to <Z> with a _dec.bin ending.
+  -A --autotune        Pick the packet length and rate with short test bursts. Results are
+                       cached per instrument.
+  -b --buffer          Receive into one preallocated buffer and decode after the stream ends
+  -z --compress <C>    Compress --output in independently compressed chunks on a thread pool.
+                       <C> is zlib, lzma or bz2, optionally followed by :shuffle (the default),
+                       :delta or :none
+  -c --continuous      Stream until Ctrl-C, ignoring --duration. --output is split into
+                       numbered segments.
   -d --duration <D>    How long to transfer in seconds [default: 10]
+  --decimate <N>       Decimation of the --analyze stream [default: 1024]
   -f --file <F>        Name for file output. No file output without a file name.
   -h --help            Show this screen
+  --hook <H>           Shell command run on each closed --continuous segment, e.g. "gzip {}".
+                       {} is the file name.
+  -x --index           Keep a sparse time index of --output in <O> with a .idx ending, marking
+                       lost packets.
+                       stream.IndexedFile(<O>).range(t0, t1) then reads any time range back.
   -i --ints            Data in 16-bit ints instead of 32-bit floats
+  -j --jobs <J>        Worker processes for decode [default: 1]
   -l --length <L>      Packet length enum (0 to 3) [default: 0]
+  -m --metrics <M>     Serve Prometheus metrics on http://127.0.0.1:<M>/metrics while streaming
+  -o --output <O>      Name for binary output, written as the data arrives. Memory use stays fixed.
   -p --port <P>        UDP Port [default: 1865]
+  --process            Receive in a separate process through a shared memory ring
+  --profile <P>        Time each stage (receive, decode, sink, ...) and print a report at the end.
+                       The numbers also go to the JSON file <P> unless <P> is -
+  -R --record <R>      Write the raw packets to a record file without decoding. Decode it later
+                       with: stream decode <R>
   -r --rate <R>        Sample rate per second. Actual will be less and depends on filter settings [default: 1e5]
+  --slack <T>          Seconds of packets the socket receive buffer should hold [default: 0.5]
   -s --silent          Refrain from printing packet count and data until complete
+  --segment <S>        --continuous segment length: seconds, or bytes with a k, M or G
+                       suffix [default: 60]
+  --shards             With --jobs, keep one output file per chunk instead of merging them
+  -S --stamp           Store the host receive time (ns) with each packet in the record file
   -t --thread          Decouple output from ethernet stream using threads
   -v --vars <V>        Lock-in variables to stream [default: X]    XY, RT, or XYRT are also allowed
     """
@@ -82,88 +151,1000 @@ def show_status(left_text='', right_text=''):
     """
     print(' %-30s %48s\r'%(left_text[:30], right_text[:48]), end=' ')
 
-# globals get assigned the udp and vxi11 objects to allow SIGINT to cleanup properly
-# pylint wants me to name these in all caps, as if they are constants. They're not.
-the_udp_socket = None       #pylint: disable=global-statement, invalid-name
-the_vx_ifc = None           #pylint: disable=global-statement, invalid-name
+
+STATUS_HZ = 10      # status line refreshes per second
+
+
+class StreamStats:      #pylint: disable=too-many-instance-attributes
+    """ Counters the receive and decode loops update as they go. Updating only stores
+        numbers; a background thread draws the status line STATUS_HZ times a second from
+        them, and an optional HTTP server hands them out in Prometheus text format.
+        fn_queue_depth, if set, returns how many packets are waiting to be decoded.
+    """
+    def __init__(self, s_prt_fmt, b_show, i_metrics_port=None):
+        self.s_prt_fmt = s_prt_fmt
+        self.b_show = b_show
+        self.count_packets = 0
+        self.count_samples = 0
+        self.count_dropped = 0
+        self.count_late = 0             # packets left out for arriving too late, or twice
+        self.count_batches = 0
+        self.t_decode = 0.0             # seconds spent decoding, all batches
+        self.last_sample = None
+        self.fn_queue_depth = None
+        self.sink = None                # a BinarySink to report bytes written from
+        self.rates = (0.0, 0.0)         # packets/s and samples/s at the last refresh
+        self.evt_stop = threading.Event()
+        self.lock_draw = threading.Lock()
+        self.b_done = False             # set by finish() once the last batch is in
+        self.thread = None
+        self.server = None
+        if i_metrics_port is not None:
+            self.server = metrics_server(i_metrics_port)
+            self.server.stats = self
+
+    def update(self, count_packets, count_dropped, samples, t_decode, count_late=0):   #pylint: disable=too-many-arguments
+        """ hot path: record the latest decoded batch
+        """
+        self.count_packets = count_packets
+        self.count_dropped = count_dropped
+        self.count_late = count_late
+        self.count_samples += len(samples)
+        self.count_batches += 1
+        self.t_decode += t_decode
+        self.last_sample = samples[-1]
+
+    def start(self):
+        """ start the status thread and the metrics server
+        """
+        self.thread = threading.Thread(target=self._refresh, daemon=True)
+        self.thread.start()
+        if self.server is not None:
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def finish(self):
+        """ draw the final status line and stop refreshing it, so results print cleanly after it
+        """
+        with self.lock_draw:
+            self.b_done = True
+            self._draw()
+
+    def stop(self):
+        """ stop the status thread and the metrics server
+        """
+        self.evt_stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _refresh(self):
+        count_prev = (0, 0)
+        t_prev = time.perf_counter()
+        while not self.evt_stop.wait(1.0/STATUS_HZ):
+            t_now = time.perf_counter()
+            count_now = (self.count_packets, self.count_samples)
+            self.rates = tuple((b-a)/(t_now-t_prev) for a, b in zip(count_prev, count_now))
+            count_prev, t_prev = count_now, t_now
+            with self.lock_draw:
+                if not self.b_done:
+                    self._draw()
+
+    def _draw(self):
+        if self.b_show and self.last_sample is not None:
+            t_start = time.perf_counter_ns()
+            show_status('dropped %4d of %d'%(self.count_dropped, self.count_packets), self.s_prt_fmt%tuple(self.last_sample))   #pylint: disable=line-too-long
+            the_profiler.add('show_status', time.perf_counter_ns() - t_start)
+
+    def metrics_text(self):
+        """ the counters in Prometheus text exposition format
+        """
+        lst_metrics = [
+            ('packets_total', 'counter', 'Packets decoded', self.count_packets),
+            ('samples_total', 'counter', 'Samples decoded', self.count_samples),
+            ('dropped_packets_total', 'counter', 'Packets missing from the stream', self.count_dropped),   #pylint: disable=line-too-long
+            ('late_packets_total', 'counter', 'Packets left out for arriving too late or twice', self.count_late),   #pylint: disable=line-too-long
+            ('decode_seconds_total', 'counter', 'Time spent decoding', self.t_decode),
+            ('decode_batches_total', 'counter', 'Batches decoded', self.count_batches),
+            ('packets_per_second', 'gauge', 'Packet rate at the last refresh', self.rates[0]),
+            ('samples_per_second', 'gauge', 'Sample rate at the last refresh', self.rates[1]),
+            ('queue_depth', 'gauge', 'Packets received but not decoded yet',
+             self.fn_queue_depth() if self.fn_queue_depth is not None else 0),
+            ('bytes_written_total', 'counter', 'Bytes written to the binary output',
+             self.sink.bytes_written if self.sink is not None else 0)]
+        return ''.join('# HELP sr865_stream_%s %s\n# TYPE sr865_stream_%s %s\nsr865_stream_%s %s\n'%(   #pylint: disable=line-too-long
+            s_name, s_help, s_name, s_type, s_name, repr(val)) for s_name, s_type, s_help, val in lst_metrics)   #pylint: disable=line-too-long
+
+
+def metrics_server(i_metrics_port):
+    """ return an HTTP server on 127.0.0.1:i_metrics_port that answers GET /metrics with
+        the metrics_text() of its stats attribute, a StreamStats
+    """
+    import http.server      #pylint: disable=import-outside-toplevel
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        """ answers GET /metrics for StreamStats
+        """
+        def do_GET(self):       #pylint: disable=invalid-name
+            """ serve the metrics page
+            """
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = self.server.stats.metrics_text().encode('ascii')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):   #pylint: disable=redefined-builtin
+            pass                                # keep the status line clean
+
+    return http.server.ThreadingHTTPServer(('127.0.0.1', i_metrics_port), MetricsHandler)
+
+
+# global that gets assigned the Streamer to allow SIGINT to cleanup properly
+# pylint wants me to name it in all caps, as if it is a constant. It's not.
+the_streamer = None         #pylint: disable=global-statement, invalid-name
+# --profile swaps in an enabled one
+the_profiler = profiling.Profiler(False)    #pylint: disable=invalid-name
 
 def cleanup_ifcs():
     """ Stop the stream and close the socket and vxi11.
     """
-    # global the_udp_socket
-    # global the_vx_ifc
     print("\n cleaning up...", end=' ')
-    the_vx_ifc.write('STREAM OFF')
-    the_vx_ifc.close()
-    the_udp_socket.close()
+    the_streamer.close()
     print('connections closed\n')
 
 
 
-def open_interfaces(ipadd, port):
-    """ open a UDP socket and a vxi11 instrument and assign them to the globals
+KERNEL_BYTES_PER_PACKET = 768   # rough sk_buff bookkeeping the kernel charges per datagram on top
+                                # of its size
+
+def tune_socket_buffer(sock_udp, f_rate, count_vars, bytes_per_pkt, b_integers, t_slack):   #pylint: disable=too-many-arguments
+    """ Ask for a receive buffer big enough to hold t_slack seconds of packets at f_rate, so
+        a hiccup on our side (GC, terminal output) doesn't overflow it.
+        Prints and returns the size requested and the size the OS granted. Linux reports
+        double what it reserves for the data and caps requests at net.core.rmem_max.
     """
-    global the_udp_socket   #pylint: disable=global-statement, invalid-name
-    global the_vx_ifc       #pylint: disable=global-statement, invalid-name
-    print('\nopening incoming UDP Socket at %d ...' % port, end=' ')
-    the_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    the_udp_socket.bind(('', port))      # listen to anything arriving on this port from anyone
-    print('done')
-    print('opening VXI-11 at %s ...' % ipadd, end=' ')
-    the_vx_ifc = vxi11.Instrument(ipadd)
-    the_vx_ifc.write('STREAMPORT %d'%port)
-    print('done')
+    f_pkt_rate = f_rate * count_vars * (2 if b_integers else 4) / bytes_per_pkt
+    i_request = min(int(f_pkt_rate * t_slack * (bytes_per_pkt + 4 + KERNEL_BYTES_PER_PACKET)), 2**31-1)   # SO_RCVBUF is a C int   #pylint: disable=line-too-long
+    i_before = sock_udp.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if i_request > i_before:
+        sock_udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, i_request)
+    i_granted = sock_udp.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    print('%.0f packets/s. Receive buffer for %.3g s: requested %d bytes, granted %d'%(f_pkt_rate, t_slack, i_request, i_granted))   #pylint: disable=line-too-long
+    if i_granted < i_request:
+        print('  the OS limits the buffer. Raise it with e.g.: sysctl -w net.core.rmem_max=%d'%(2*i_request))   #pylint: disable=line-too-long
+    return i_request, i_granted
 
 
+def read_udp_counters(i_port):
+    """ Read the kernel UDP counters from /proc (Linux only).
+        return the host-wide RcvbufErrors and InErrors, plus the drops and receive queue
+        bytes of the socket bound to i_port (None when not found), or None without /proc.
+    """
+    try:
+        with open('/proc/net/snmp') as f_snmp:
+            lst_udp = [x.split() for x in f_snmp if x.startswith('Udp:')]
+        with open('/proc/net/udp') as f_udp:
+            lst_socks = [x.split() for x in f_udp.readlines()[1:]]
+    except OSError:
+        return None
+    dict_counts = {k: int(v) for k, v in zip(lst_udp[0][1:], lst_udp[1][1:])}
+    dict_counts['SocketDrops'] = dict_counts['SocketQueue'] = None
+    for lst_sock in lst_socks:
+        if int(lst_sock[1].split(':')[1], 16) == i_port:
+            dict_counts['SocketDrops'] = int(lst_sock[-1])
+            dict_counts['SocketQueue'] = int(lst_sock[4].split(':')[1], 16)
+    return dict_counts
 
 
-def dut_config(vx_ifc, s_channels, idx_pkt_len, f_rate_req, b_integers):
-    """ Setup the SR865 for streaming. Return the rate (samples/sec)
+class KernelDropMonitor:
+    """ Samples read_udp_counters() on a background thread while streaming, so drops can be
+        blamed on the network, the kernel socket buffer, or our own receive loop.
+        The socket counters vanish when the socket closes, so they come from the last
+        sample taken (t_interval apart). The host-wide counters are read once more at stop().
     """
-    vx_ifc.write('STREAM OFF')                          # turn off streaming while we set it up
-    vx_ifc.write('STREAMCH %s'%s_channels)
-    if b_integers:
-        vx_ifc.write('STREAMFMT 1')                 # 16 bit int
-    else:
-        vx_ifc.write('STREAMFMT 0')                 # 32 bit float
-    vx_ifc.write('STREAMOPTION 2')      # use big-endian (~1) and data integrity checking (2)
-    vx_ifc.write('STREAMPCKT %d'%idx_pkt_len)
-    f_rate_max = float(vx_ifc.ask('STREAMRATEMAX?'))      # filters determine the max data rate
+    def __init__(self, i_port, t_interval=0.2):
+        self.i_port = i_port
+        self.t_interval = t_interval
+        self.dict_start = read_udp_counters(i_port)
+        self.dict_last = self.dict_start
+        self.i_peak_queue = 0
+        self.evt_stop = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """ start sampling, if the counters are available here
+        """
+        if self.dict_start is not None:
+            self.thread = threading.Thread(target=self._sample, daemon=True)
+            self.thread.start()
+
+    def _sample(self):
+        while not self.evt_stop.wait(self.t_interval):
+            dict_now = read_udp_counters(self.i_port)
+            if dict_now['SocketDrops'] is None:     # socket closed
+                continue
+            self.dict_last = dict_now
+            self.i_peak_queue = max(self.i_peak_queue, dict_now['SocketQueue'])
+
+    def stop(self, count_dropped):
+        """ stop sampling. return report lines comparing the kernel's drops with the
+            count_dropped packets missing from the stream
+        """
+        if self.thread is None:
+            return []
+        self.evt_stop.set()
+        self.thread.join()
+        dict_end = read_udp_counters(self.i_port)
+        lst_lines = ['kernel: host UDP RcvbufErrors +%d, InErrors +%d'%(
+            dict_end['RcvbufErrors']-self.dict_start['RcvbufErrors'], dict_end['InErrors']-self.dict_start['InErrors'])]   #pylint: disable=line-too-long
+        if self.dict_start['SocketDrops'] is not None:
+            i_sock_drops = self.dict_last['SocketDrops'] - self.dict_start['SocketDrops']
+            lst_lines.append('kernel: socket buffer overflowed %d times, peak fill %d bytes'%(i_sock_drops, self.i_peak_queue))   #pylint: disable=line-too-long
+            if count_dropped:
+                lst_lines.append('kernel: of %d missing packets, %d overflowed our socket buffer and %d never reached this host'%(   #pylint: disable=line-too-long
+                    count_dropped, min(i_sock_drops, count_dropped), max(0, count_dropped-i_sock_drops)))   #pylint: disable=line-too-long
+        return lst_lines
 
-    # calculate a decimation to stay under f_rate_req
+
+def decimation_for(f_rate_max, f_rate_req):
+    """ calculate a decimation (0 to 20) to stay under f_rate_req
+    """
     i_decimate = int(math.ceil(math.log(f_rate_max/f_rate_req, 2.0)))
-    if i_decimate < 0:
-        i_decimate = 0
-    if i_decimate > 20:
-        i_decimate = 20
+    return min(max(i_decimate, 0), 20)
+
+
+def dut_config(vx_ifc, s_channels, idx_pkt_len, f_rate_req, b_integers, i_decimate=None):   #pylint: disable=too-many-arguments
+    """ Setup the SR865 for streaming. Return the rate (samples/sec)
+        i_decimate, if given, is used instead of the decimation f_rate_req calls for.
+        Settings go out in scpi.Batch writes, leaving out those the instrument already has.
+        STREAMRATEMAX? is asked after the channels, format and packet length are sent, and
+        only the first time for that configuration.
+    """
+    batch = scpi.Batch(vx_ifc)
+    batch.command('STREAM OFF')                     # turn off streaming while we set it up
+    batch.setting('STREAMCH', s_channels)
+    batch.setting('STREAMFMT', 1 if b_integers else 0)     # 16 bit int or 32 bit float
+    batch.setting('STREAMOPTION', 2)    # use big-endian (~1) and data integrity checking (2)
+    batch.setting('STREAMPCKT', idx_pkt_len)
+    f_rate_max = float(batch.limit('STREAMRATEMAX?'))      # filters determine the max data rate
+
+    if i_decimate is None:
+        i_decimate = decimation_for(f_rate_max, f_rate_req)
 
     f_rate = f_rate_max/(2.0**i_decimate)
     print('Max rate is %.3f kS/S.'%(f_rate_max*1e-3))
     print('Decimating by 2^%d down to %.3f kS/S'%(i_decimate, f_rate*1e-3))
-    vx_ifc.write('STREAMRATE %d'%i_decimate)     # bring the rate under our target rate
+    batch.setting('STREAMRATE', i_decimate)         # bring the rate under our target rate
+    batch.send()
     return f_rate
 
 
+AUTOTUNE_BURST = 0.5        # seconds streamed per calibration burst
+AUTOTUNE_CACHE = os.path.join(os.path.expanduser('~'), '.sr865_autotune.json')
+
+def calibrate_burst(vx_ifc, sock_udp, bytes_per_packet, f_pkt_rate, t_burst):
+    """ Stream for t_burst seconds with whatever the instrument is set to, receiving with
+        recv_into() into a preallocated buffer. return the packets received, the packets
+        lost according to a SequenceTracker, and the host CPU used (fraction of a core).
+    """
+    count_max = int(f_pkt_rate*t_burst*1.5) + 16
+    buf_all = bytearray(count_max * bytes_per_packet)
+    view = memoryview(buf_all)
+    count_packets = 0
+    sock_udp.settimeout(0.2)
+    t_start = time.perf_counter()
+    t_cpu = time.process_time()
+    vx_ifc.write('STREAM ON')
+    try:
+        while count_packets < count_max and time.perf_counter() - t_start < t_burst:
+            sock_udp.recv_into(view[count_packets*bytes_per_packet:], bytes_per_packet)
+            count_packets += 1
+    except socket.timeout:
+        pass
+    vx_ifc.write('STREAM OFF')
+    f_cpu = (time.process_time() - t_cpu) / (time.perf_counter() - t_start)
+    try:
+        while True:                     # throw away the packets still on their way
+            sock_udp.recv(bytes_per_packet)
+    except socket.timeout:
+        pass
+    sock_udp.settimeout(None)
+    tracker = SequenceTracker()
+    tracker.reorder(view[:count_packets*bytes_per_packet], bytes_per_packet, True)
+    return count_packets, tracker.count_lost, f_cpu
+
+
+def autotune(vx_ifc, sock_udp, s_address, s_channels, b_integers, f_rate_req):   #pylint: disable=too-many-arguments, too-many-locals
+    """ --autotune: find the STREAMPCKT length and STREAMRATE decimation with the highest
+        sample rate this host and network take with no drops.
+        For each packet length, short calibration bursts step down from the full rate until
+        one comes through clean. Ties go to the setting using less host CPU. The answer
+        is cached in AUTOTUNE_CACHE per address, variables and format, and reused until
+        STREAMRATEMAX? changes (new filter settings). f_rate_req still caps the rate.
+        return the packet length enum and the decimation.
+    """
+    s_key = '%s %s %s'%(s_address, s_channels.upper(), 'ints' if b_integers else 'floats')
+    try:
+        with open(AUTOTUNE_CACHE) as f_cache:
+            dict_cache = json.load(f_cache)
+    except (OSError, ValueError):
+        dict_cache = {}
+    batch = scpi.Batch(vx_ifc)
+    batch.setting('STREAMCH', s_channels)
+    batch.setting('STREAMFMT', 1 if b_integers else 0)
+    f_rate_max = float(batch.limit('STREAMRATEMAX?'))
+    entry = dict_cache.get(s_key)
+    if entry is not None and entry['rate_max'] == f_rate_max:
+        print('autotune: using cached packet length %d, decimation %d'%(entry['length'], entry['decimate']))   #pylint: disable=line-too-long
+    else:
+        bytes_smallest, _, _ = packet_format(3, b_integers, len(s_channels))
+        tune_socket_buffer(sock_udp, f_rate_max, len(s_channels), bytes_smallest, b_integers, AUTOTUNE_BURST)   #pylint: disable=line-too-long
+        best = None                     # (rate, -cpu, length, decimation)
+        for idx_pkt_len in range(4):
+            bytes_per_pkt, _, _ = packet_format(idx_pkt_len, b_integers, len(s_channels))
+            for i_decimate in range(21):
+                f_rate = f_rate_max / 2.0**i_decimate
+                if best is not None and f_rate < best[0]:
+                    break               # can't beat what we have
+                with contextlib.redirect_stdout(io.StringIO()):
+                    dut_config(vx_ifc, s_channels, idx_pkt_len, f_rate, b_integers, i_decimate)
+                f_pkt_rate = f_rate * len(s_channels) * (2 if b_integers else 4) / bytes_per_pkt
+                count_packets, count_lost, f_cpu = calibrate_burst(vx_ifc, sock_udp, bytes_per_pkt+4, f_pkt_rate, AUTOTUNE_BURST)   #pylint: disable=line-too-long
+                b_clean = not count_lost and count_packets >= 0.9*f_pkt_rate*AUTOTUNE_BURST
+                print('autotune: %4d byte packets at %10.3f kS/S: %6d received, %4d lost, cpu %3.0f%%'%(   #pylint: disable=line-too-long
+                    bytes_per_pkt, f_rate*1e-3, count_packets, count_lost, 100*f_cpu))
+                if b_clean:
+                    best = max(best or (0,), (f_rate, -f_cpu, idx_pkt_len, i_decimate))
+                    break
+        if best is None:
+            print('autotune: no setting came through clean. Using the slowest.')
+            best = (0, 0, 0, 20)
+        entry = {'rate_max': f_rate_max, 'length': best[2], 'decimate': best[3]}
+        dict_cache[s_key] = entry
+        with open(AUTOTUNE_CACHE, 'w') as f_cache:
+            json.dump(dict_cache, f_cache, indent=1)
+        print('autotune: chose packet length %d, decimation %d'%(entry['length'], entry['decimate']))   #pylint: disable=line-too-long
+    return entry['length'], max(entry['decimate'], decimation_for(f_rate_max, f_rate_req))
+
+
+def packet_format(idx_pkt_len, b_integers, count_vars):
+    """ translate the packet size enumeration into an actual byte count (header excluded)
+        return the byte count, the unpacking format string and the status format string
+    """
+    bytes_per_pkt = [1024, 512, 256, 128][idx_pkt_len]
+    if b_integers:
+        fmt_unpk = '>%dh'%(bytes_per_pkt//2)            # create an unpacking format string.
+        fmt_live_printing = '%12d'*count_vars           # create status format string.
+    else:
+        fmt_unpk = '>%df'%(bytes_per_pkt//4)
+        fmt_live_printing = '%12.6f'*count_vars
+    return bytes_per_pkt, fmt_unpk, fmt_live_printing
+
+
 def write_to_file(f_name, s_channels, lst_stream):
-    """ Save data to a comma separated file. We could also use the csv python module...
-        s_channels is "X" or "XY", etc indicating how many values in a lst_sample
-        lst_stream[][] is a list of sample lists
+    """ Save data to a comma separated file using the chunked exporter shared with cap860.py
+        s_channels is "X" or "XY", etc indicating how many values in a sample
+        lst_stream[] is a list of blocks from decode_packets(), each block a sequence of samples
     """
     show_status('writing %s ...'%f_name)
-    with open(f_name, 'w') as f_ptr:
-        f_ptr.write(''.join(['%s,'%str.upper(v) for v in s_channels])+'\n')
-        if isinstance(lst_stream[0][0], float):
-            s_val_fmt = '%+12.6e,'*len(s_channels)
-        else:
-            s_val_fmt = '%+d,'*len(s_channels)
-        for lst_sample in lst_stream:
-            for i in range(0, len(lst_sample), len(s_channels)):
-                smpl = lst_sample[i:i+len(s_channels)]
-                f_ptr.write(s_val_fmt%tuple(smpl)+'\n')
+    t_start = time.perf_counter_ns()
+    count_rows = export.write_csv(f_name, s_channels, lst_stream, b_threads=True)
+    the_profiler.add('write_to_file', time.perf_counter_ns() - t_start, count_rows)
     show_status('%s written'%f_name)
 
 
 
+BINARY_HEADER_BYTES = export.BINARY_HEADER_BYTES
+
+def sample_bytes(samples, s_format):
+    """ return a block from decode_packets() as little-endian bytes in s_format, <f4 or <i2
+    """
+    if hasattr(samples, 'astype'):
+        return samples.astype(s_format, copy=False).tobytes()
+    arr = array.array('h' if s_format == '<i2' else 'f', [v for smpl in samples for v in smpl])
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr.tobytes()
+
+
+class BinarySink:
+    """ Append decoded sample blocks to a binary file as they arrive, so memory use does
+        not grow with the stream duration.
+        The file starts with one JSON line, padded to BINARY_HEADER_BYTES, holding the
+        channels, rate, sample format and sample count. Little-endian samples follow,
+        one row of len(channels) values per sample. read_binary() loads it back.
+    """
+    def __init__(self, f_name, s_channels, f_rate, b_integers, t_flush=1.0):   #pylint: disable=too-many-arguments
+        self.f_name = f_name
+        self.header = {'channels': s_channels.upper(),
+                       'rate': f_rate,
+                       'format': '<i2' if b_integers else '<f4',
+                       'samples': 0}
+        self.t_flush = t_flush                  # seconds between flushes to disk
+        self.bytes_written = 0
+        self.t_last_flush = time.perf_counter()
+        self.f_ptr = open(f_name, 'wb')         #pylint: disable=consider-using-with
+        self._write_header()
+
+    def _write_header(self):
+        self.f_ptr.write(export.binary_header(self.header))
+
+    def write(self, samples, tracker=None):     #pylint: disable=unused-argument
+        """ append a block from decode_packets(): a numpy array, or a list of sample lists.
+            tracker is for IndexedSink and not needed here.
+        """
+        t_start = time.perf_counter_ns()
+        data = sample_bytes(samples, self.header['format'])
+        self.f_ptr.write(data)
+        the_profiler.add('sink', time.perf_counter_ns() - t_start, len(samples))
+        self.bytes_written += len(data)
+        self.header['samples'] += len(samples)
+        if time.perf_counter() - self.t_last_flush > self.t_flush:
+            self.flush()
+
+    def write_raw(self, data, count_samples):
+        """ append count_samples already in the file's little-endian format
+        """
+        self.f_ptr.write(data)
+        self.bytes_written += len(data)
+        self.header['samples'] += count_samples
+
+    def flush(self):
+        """ update the sample count in the header and push everything to disk
+        """
+        self.f_ptr.seek(0)
+        self._write_header()
+        self.f_ptr.seek(0, 2)
+        self.f_ptr.flush()
+        self.t_last_flush = time.perf_counter()
+
+    def close(self):
+        """ final flush and close
+        """
+        self.flush()
+        self.f_ptr.close()
+        show_status('%s written'%self.f_name)
+
+
+class IndexedSink(BinarySink):
+    """ A BinarySink that also keeps a sparse time index in name.idx, so IndexedFile can
+        pull any time range out of a long stream without reading the rest.
+        The samples are stored back to back as usual; lost packets leave no filler.
+        Every block written starts a run, recorded in the index as two little-endian int64:
+        its first sample's position in the file and in the stream, lost samples included.
+        The stream position gives the extended sequence number of the packet the sample came
+        in (seq_start + position // packet_samples) and its time (position / rate after the
+        'time' in the header). Blocks are split where packets were lost.
+        t_start is the wall-clock time of the first sample when it is already known, as for
+        a recording; otherwise it is taken from the clock when the first block arrives.
+    """
+    def __init__(self, f_name, s_channels, f_rate, b_integers, i_packet_samples, t_flush=1.0, t_start=None):   #pylint: disable=too-many-arguments,line-too-long
+        super().__init__(f_name, s_channels, f_rate, b_integers, t_flush)
+        self.header.update(packet_samples=i_packet_samples, seq_start=None, time=None)
+        self.t_start = t_start
+        self.f_idx = open(os.path.splitext(f_name)[0] + '.idx', 'wb')     #pylint: disable=consider-using-with
+        self.count_lost = 0             # samples lost before the next one written
+        self.count_reported = 0         # samples lost in all the gaps seen so far
+        self.count_gaps = 0             # entries of the tracker's lst_gaps seen so far
+        self.lst_holes = []             # (file position, samples lost) still to come
+
+    def write(self, samples, tracker=None):
+        """ append a block, and find where packets were lost from the SequenceTracker
+            that released it. Its holes may be given up before the samples around them arrive.
+        """
+        if self.header['seq_start'] is None:
+            t_start = time.time() - len(samples)/self.header['rate'] if self.t_start is None else self.t_start   #pylint: disable=line-too-long
+            self.header.update(seq_start=tracker.seq_start if tracker else 0, time=t_start)
+        i_pkt = self.header['packet_samples']
+        lst_gaps = tracker.lst_gaps[self.count_gaps:] if tracker else []
+        self.count_gaps += len(lst_gaps)
+        for n_lost, seq in lst_gaps:
+            self.lst_holes.append(((seq - self.header['seq_start'])*i_pkt - self.count_reported, n_lost*i_pkt))   #pylint: disable=line-too-long
+            self.count_reported += n_lost*i_pkt
+        i_done = 0
+        while i_done < len(samples):
+            i_file = self.header['samples']
+            while self.lst_holes and self.lst_holes[0][0] <= i_file:
+                self.count_lost += self.lst_holes.pop(0)[1]
+            i_end = len(samples) if not self.lst_holes else min(len(samples), i_done + self.lst_holes[0][0] - i_file)   #pylint: disable=line-too-long
+            self.f_idx.write(pack('<qq', i_file, i_file + self.count_lost))
+            super().write(samples[i_done:i_end])
+            i_done = i_end
+
+    def flush(self):
+        """ push the index to disk, then the samples and header
+        """
+        self.f_idx.flush()
+        super().flush()
+
+    def close(self):
+        """ final flush and close of both files
+        """
+        super().close()
+        self.f_idx.close()
+
+
+class CompressedSink:
+    """ Writes the samples to an export.ChunkWriter container instead of a plain binary file:
+        chunks compressed with s_compress (e.g. "zlib" or "lzma:delta") on a thread pool.
+        Otherwise used like a BinarySink. read_binary() loads it back.
+    """
+    def __init__(self, f_name, s_channels, f_rate, b_integers, s_compress, t_flush=1.0):   #pylint: disable=too-many-arguments
+        self.f_name = f_name
+        self.writer = export.ChunkWriter(f_name, {'channels': s_channels.upper(), 'rate': f_rate,
+                                                  'format': '<i2' if b_integers else '<f4'}, s_compress)   #pylint: disable=line-too-long
+        self.header = self.writer.header
+        self.t_flush = t_flush
+        self.bytes_written = 0
+        self.t_last_flush = time.perf_counter()
+
+    def write(self, samples, tracker=None):     #pylint: disable=unused-argument
+        """ append a block from decode_packets(), as BinarySink.write()
+        """
+        t_start = time.perf_counter_ns()
+        self.write_raw(sample_bytes(samples, self.header['format']), len(samples))
+        the_profiler.add('sink', time.perf_counter_ns() - t_start, len(samples))
+
+    def write_raw(self, data, count_samples):   #pylint: disable=unused-argument
+        """ append samples already in the file's little-endian format. The writer counts them
+            as their chunks reach the file.
+        """
+        self.writer.write(data)
+        self.bytes_written += len(data)
+        if time.perf_counter() - self.t_last_flush > self.t_flush:
+            self.flush()
+
+    def flush(self):
+        """ write the chunks compressed so far and the header
+        """
+        self.writer.flush()
+        self.t_last_flush = time.perf_counter()
+
+    def close(self):
+        """ compress the rest and close
+        """
+        self.writer.close()
+        show_status('%s written'%self.f_name, 'compressed to %.0f%% of %d bytes'%(100.0*self.writer.bytes_compressed/max(1, self.bytes_written), self.bytes_written))   #pylint: disable=line-too-long
+
+
+def read_binary(f_name):
+    """ Load a file written by BinarySink. return the header dict and the samples,
+        as a memory-mapped numpy array with one column per channel.
+        A CompressedSink file is decompressed into memory instead.
+    """
+    with open(f_name, 'rb') as f_ptr:
+        header = json.loads(f_ptr.read(BINARY_HEADER_BYTES).decode('ascii'))
+    load_numpy()
+    if 'codec' in header:
+        samples = np.frombuffer(export.ChunkReader(f_name).read(), dtype=header['format'])
+        return header, samples.reshape(-1, len(header['channels']))
+    samples = np.memmap(f_name, dtype=header['format'], mode='r', offset=BINARY_HEADER_BYTES,
+                        shape=(header['samples'], len(header['channels'])))
+    return header, samples
+
+
+class IndexedFile:
+    """ Reads a file written by IndexedSink. The samples are memory-mapped, so only the
+        parts asked for are read from disk. range() finds its ends in the index by bisection.
+    """
+    def __init__(self, f_name):
+        self.header, self.samples = read_binary(f_name)
+        idx = np.fromfile(os.path.splitext(f_name)[0] + '.idx', dtype='<i8').reshape(-1, 2)
+        idx = idx[idx[:, 0] < len(self.samples)]    # runs the header count does not cover yet
+        self.pos_file = idx[:, 0]
+        self.pos_stream = idx[:, 1]
+        self.len_run = np.diff(np.append(self.pos_file, len(self.samples)))
+        # where the run before each ends
+        self.prev_end = np.append(0, self.pos_stream[:-1] + self.len_run[:-1])
+
+    def _file_position(self, i_stream):
+        """ where stream sample i_stream is, or would be if it was not lost, in the file
+        """
+        k = int(np.searchsorted(self.pos_stream, i_stream, 'right')) - 1
+        if k < 0:
+            return 0
+        return int(self.pos_file[k] + min(i_stream - self.pos_stream[k], self.len_run[k]))
+
+    def stream_position(self, i_file):
+        """ return the stream position of the sample at i_file in the file, lost samples included
+        """
+        k = int(np.searchsorted(self.pos_file, i_file, 'right')) - 1
+        return int(self.pos_stream[k] + i_file - self.pos_file[k])
+
+    def seq_of(self, i_stream):
+        """ return the extended sequence number of the packet that held stream sample i_stream
+        """
+        return self.header['seq_start'] + i_stream // self.header['packet_samples']
+
+    def range(self, t_start, t_end):
+        """ return the samples from t_start up to t_end seconds into the stream, as a view of the
+            file, the start time of the range, and a (position, count) for every hole in it:
+            count samples were lost just before samples[position], or at the end when position
+            is len(samples). So samples[i] was taken
+            (i + the counts of the holes at positions up to i) / rate after the start time.
+        """
+        f_rate = self.header['rate']
+        i_first = max(0, int(math.ceil(t_start*f_rate)))
+        i_end = max(i_first, int(math.ceil(t_end*f_rate)))
+        pos_first = self._file_position(i_first)
+        pos_end = self._file_position(i_end)
+        # runs that start inside the range, and how many samples are missing before each
+        k_first = int(np.searchsorted(self.pos_stream, i_first, 'right'))
+        k_end = int(np.searchsorted(self.pos_stream, i_end, 'left'))
+        count_missing = self.pos_stream[k_first:k_end] - np.maximum(self.prev_end[k_first:k_end], i_first)   #pylint: disable=line-too-long
+        lst_holes = [(int(p) - pos_first, int(n)) for p, n in zip(self.pos_file[k_first:k_end], count_missing) if n > 0]   #pylint: disable=line-too-long
+        if k_end < len(self.pos_stream) and self.prev_end[k_end] < i_end:    # ends in a hole
+            lst_holes.append((pos_end - pos_first, i_end - max(int(self.prev_end[k_end]), i_first)))
+        return self.samples[pos_first:pos_end], i_first/f_rate, lst_holes
+
+
+class AnalysisTee:
+    """ Hands each decoded block to an analysis.StreamAnalysis on its way to the real sink
+        (a BinarySink, a SegmentSink or None), so every receive mode can feed it unchanged.
+    """
+    def __init__(self, stream_analysis, sink):
+        self.analysis = stream_analysis
+        self.sink = sink
+
+    @property
+    def bytes_written(self):
+        """ sample bytes written by the real sink
+        """
+        return self.sink.bytes_written if self.sink is not None else 0
+
+    def write(self, samples, *args):
+        """ analyze, then pass the block and any other arguments on. None is passed on
+            without analysis.
+        """
+        t_start = time.perf_counter_ns()
+        self.analysis.write(samples)
+        the_profiler.add('analyze', time.perf_counter_ns() - t_start, len(samples) if samples is not None else 0)   #pylint: disable=line-too-long
+        if self.sink is not None:
+            self.sink.write(samples, *args)
+
+    def close(self):
+        """ write the final summary and close the real sink
+        """
+        self.analysis.close()
+        if self.sink is not None:
+            self.sink.close()
+
+
+def parse_segment(s_segment):
+    """ --segment is seconds ("60", "0.5") or bytes with a suffix ("512M", "2G").
+        return (seconds, bytes) with the unused one None.
+    """
+    dict_scale = {'k': 1e3, 'M': 1e6, 'G': 1e9}
+    if s_segment[-1:] in dict_scale:
+        return None, int(float(s_segment[:-1])*dict_scale[s_segment[-1]])
+    return float(s_segment), None
+
+
+class SegmentSink:      #pylint: disable=too-many-instance-attributes
+    """ Split a --continuous stream across BinarySink files name_00000.bin, name_00001.bin, ...
+        starting a new one every t_segment seconds or bytes_segment bytes.
+        Each header also holds the segment number, the sequence numbers of its first packet
+        and of the packet after its last (seq_first, seq_next), the packets dropped inside it
+        and its start time, so one segment's seq_next is the next segment's seq_first.
+        A full segment is closed on a worker thread, so the receive loop does not wait for
+        it (with s_compress, for its last chunks to be compressed), then handed to s_hook,
+        a shell command. With s_compress each segment is a CompressedSink.
+    """
+    def __init__(self, f_name, s_channels, f_rate, b_integers, t_segment=None, bytes_segment=None, s_hook=None, s_compress=None):   #pylint: disable=too-many-arguments, line-too-long
+        self.f_base, self.s_ext = os.path.splitext(f_name)
+        self.tpl_sink = (s_channels, f_rate, b_integers)
+        self.t_segment = t_segment
+        self.bytes_segment = bytes_segment
+        self.s_hook = s_hook
+        self.s_compress = s_compress
+        from concurrent.futures import ThreadPoolExecutor     #pylint: disable=import-outside-toplevel
+        self.pool = ThreadPoolExecutor(max_workers=1)      # one worker, so segments close in order
+        self.i_segment = 0
+        self.sink = None
+        self.t_opened = None
+        self.bytes_closed = 0           # bytes in the segments already closed
+        self.seq_next = None            # sequence number of the packet after the last one written
+        self.count_gaps = 0             # entries of the tracker's lst_gaps seen so far
+
+    @property
+    def bytes_written(self):
+        """ sample bytes written across all segments
+        """
+        return self.bytes_closed + (self.sink.bytes_written if self.sink is not None else 0)
+
+    def write(self, samples, tracker):
+        """ append a block just released by tracker, a SequenceTracker: the packets from the
+            last block's seq_next up to tracker.seq_next, less the holes it has given up since.
+            Starts a new segment first when the current one is full. None is ignored, so it
+            never starts an empty segment.
+        """
+        if samples is None:
+            return
+        seq_first = tracker.seq_start if self.seq_next is None else self.seq_next
+        self.seq_next = tracker.seq_next
+        lst_gaps = tracker.lst_gaps[self.count_gaps:]
+        self.count_gaps += len(lst_gaps)
+        if self.sink is None:
+            f_segment = '%s_%05d%s'%(self.f_base, self.i_segment, self.s_ext or '.bin')
+            if self.s_compress is not None:
+                self.sink = CompressedSink(f_segment, *self.tpl_sink, self.s_compress)
+            else:
+                self.sink = BinarySink(f_segment, *self.tpl_sink)
+            self.sink.header.update(segment=self.i_segment, seq_first=seq_first, seq_next=seq_first, dropped=0, time=time.time())   #pylint: disable=line-too-long
+            self.t_opened = time.perf_counter()
+        self.sink.write(samples)
+        self.sink.header['seq_next'] = self.seq_next
+        self.sink.header['dropped'] += sum(x[0] for x in lst_gaps)
+        if (self.bytes_segment is not None and self.sink.bytes_written >= self.bytes_segment) or \
+           (self.t_segment is not None and time.perf_counter() - self.t_opened >= self.t_segment):
+            self._rotate()
+
+    def _rotate(self):
+        self.bytes_closed += self.sink.bytes_written
+        self.pool.submit(self._close_segment, self.sink)
+        self.sink = None
+        self.i_segment += 1
+
+    def _close_segment(self, sink):
+        """ worker thread: close a full segment, then run the hook on it
+        """
+        sink.close()
+        if self.s_hook:
+            self._run_hook(sink.f_name)
+
+    def _run_hook(self, f_segment):
+        s_name = shlex.quote(f_segment)
+        s_cmd = self.s_hook.replace('{}', s_name) if '{}' in self.s_hook else '%s %s'%(self.s_hook, s_name)   #pylint: disable=line-too-long
+        import subprocess       #pylint: disable=import-outside-toplevel
+        result = subprocess.run(s_cmd, shell=True, check=False)
+        if result.returncode:
+            print('\nhook "%s" failed with %d'%(s_cmd, result.returncode))
+
+    def close(self):
+        """ close the last segment and wait for all of them to be closed and hooked
+        """
+        if self.sink is not None:
+            self._rotate()
+        self.pool.shutdown(wait=True)
+
+
+
+RECORD_CHUNK_PACKETS = 1024     # packets gathered in memory per record file write
+
+def record_packets(sock_udp, f_name, count_packets, bytes_per_packet, dict_header, b_stamp):   #pylint: disable=too-many-arguments
+    """ --record receiver. Writes every datagram verbatim to f_name with no decoding.
+        The file starts with dict_header as a JSON line padded to BINARY_HEADER_BYTES.
+        Each record that follows is the packet (header + payload), preceded by a
+        little-endian 64 bit host receive time in ns when b_stamp is set.
+        Packets are gathered in a RECORD_CHUNK_PACKETS chunk and written a chunk at a time.
+    """
+    bytes_per_record = bytes_per_packet + (8 if b_stamp else 0)
+    i_first = 8 if b_stamp else 0
+    chunk = bytearray(RECORD_CHUNK_PACKETS * bytes_per_record)
+    view = memoryview(chunk)
+    with open(f_name, 'wb') as f_ptr:
+        f_ptr.write(export.binary_header(dict_header))
+        offset = 0
+        t_start = time.perf_counter_ns()
+        for _ in range(count_packets):
+            sock_udp.recv_into(view[offset+i_first:offset+bytes_per_record], bytes_per_packet)
+            if b_stamp:
+                pack_into('<Q', chunk, offset, time.time_ns())
+            offset += bytes_per_record
+            if offset == len(chunk):
+                t_write = time.perf_counter_ns()
+                the_profiler.add('recv', t_write - t_start, RECORD_CHUNK_PACKETS)
+                f_ptr.write(chunk)
+                t_start = time.perf_counter_ns()
+                the_profiler.add('record_write', t_start - t_write, len(chunk))
+                offset = 0
+        the_profiler.add('recv', time.perf_counter_ns() - t_start, offset//bytes_per_record)
+        f_ptr.write(view[:offset])
+
+
+def read_record_header(f_ptr):
+    """ read the JSON header of a record file. return it with the record size added.
+    """
+    header = json.loads(f_ptr.read(BINARY_HEADER_BYTES).decode('ascii'))
+    header['record_bytes'] = header['packet_bytes'] + (8 if header['stamp'] else 0)
+    return header
+
+
+def read_records(f_ptr, header, count_records):
+    """ read up to count_records from the current position of a record file.
+        return the packets back to back (stamps removed) and a list of receive
+        times in ns (empty when the file has none).
+    """
+    bytes_per_record = header['record_bytes']
+    chunk = f_ptr.read(count_records * bytes_per_record)
+    chunk = chunk[:len(chunk) - len(chunk)%bytes_per_record]    # ignore a torn last record
+    if not header['stamp']:
+        return chunk, []
+    view = memoryview(chunk)
+    offsets = range(0, len(chunk), bytes_per_record)
+    stamps = [unpack_from('<Q', chunk, x)[0] for x in offsets]
+    return b''.join(view[x+8:x+bytes_per_record] for x in offsets), stamps
+
+
+def iter_record(f_name):
+    """ Read a file written by record_packets(), RECORD_CHUNK_PACKETS at a time.
+        yield the header dict, the packets and the receive times from read_records().
+    """
+    with open(f_name, 'rb') as f_ptr:
+        header = read_record_header(f_ptr)
+        while True:
+            buf, stamps = read_records(f_ptr, header, RECORD_CHUNK_PACKETS)
+            if not buf:
+                return
+            yield header, buf, stamps
+
+
+PARALLEL_CHUNK_PACKETS = 16384  # packets per worker task in decode_record_parallel()
+
+def decode_record_chunk(f_name, i_first, count_packets, fname_shard, fname_binary_shard, b_header):   #pylint: disable=too-many-arguments, too-many-locals, line-too-long
+    """ decode_record_parallel() worker. Puts the count_packets records from i_first in order
+        with a SequenceTracker and writes them to a CSV shard and/or a raw little-endian
+        binary shard. The tracker also reads REORDER_WINDOW records on either side, so packets
+        swapped across the chunk edges still go back in place.
+        The chunk owns the sequence numbers from one past the newest before i_first up to the
+        newest within it. The tracker numbers them from the start of what it read, so return
+        the first owned and first not owned sequence numbers for the caller to stitch the
+        chunks together, with the gaps among them and the packets left out as too late.
+    """
+    with open(f_name, 'rb') as f_ptr:
+        header = read_record_header(f_ptr)
+        i_read = max(0, i_first - REORDER_WINDOW)
+        f_ptr.seek(BINARY_HEADER_BYTES + i_read*header['record_bytes'])
+        buf, _ = read_records(f_ptr, header, i_first - i_read + count_packets + REORDER_WINDOW)
+    s_channels = header['channels']
+    bytes_per_pkt, fmt_unpk, _ = packet_format(header['length'], header['ints'], len(s_channels))
+    bytes_per_packet = bytes_per_pkt + 4
+    i_mid = (i_first - i_read) * bytes_per_packet
+    i_end = min(len(buf), i_mid + count_packets*bytes_per_packet)
+    seq_start = None
+    if i_mid:   # start from the oldest packet before the chunk, which need not be the first read
+        cntr_read = buf[3]
+        seq_start = cntr_read + min(((x - cntr_read + 128) & 0xff) - 128 for x in buf[3:i_mid:bytes_per_packet])   #pylint: disable=line-too-long
+    tracker = SequenceTracker(seq_start=seq_start)
+    lst_ordered = [tracker.reorder(buf[:i_mid], bytes_per_packet)[0]]
+    seq_begin = None if tracker.seq_max is None else tracker.seq_max + 1
+    count_late = tracker.count_late
+    lst_ordered.append(tracker.reorder(buf[i_mid:i_end], bytes_per_packet)[0])
+    seq_begin = tracker.seq_start if seq_begin is None else seq_begin
+    seq_end = tracker.seq_max + 1
+    count_late = tracker.count_late - count_late
+    lst_ordered.append(tracker.reorder(buf[i_end:], bytes_per_packet, True)[0])
+
+    def position(seq):      # where the packet numbered seq is, or would be, in the ordered packets
+        return seq - tracker.seq_start - sum(n_lost for n_lost, seq_lost in tracker.lst_gaps if seq_lost < seq)   #pylint: disable=line-too-long
+    ordered = b''.join(lst_ordered)[position(seq_begin)*bytes_per_packet:position(seq_end)*bytes_per_packet]   #pylint: disable=line-too-long
+    samples, _, _, _ = decode_packets(ordered, bytes_per_packet, fmt_unpk, len(s_channels))
+    if fname_shard is not None:
+        export.write_csv(fname_shard, s_channels, [samples], b_header=b_header)
+    if fname_binary_shard is not None:
+        sink = BinarySink(fname_binary_shard, s_channels, header['rate'], header['ints'])
+        sink.write(samples)
+        sink.close()
+    lst_gaps = [gap for gap in tracker.lst_gaps if seq_begin <= gap[1] < seq_end]
+    return seq_begin, seq_end, lst_gaps, count_late
+
+
+def decode_record_parallel(f_name, fname, fname_binary, i_jobs, b_shards, i_chunk_packets=PARALLEL_CHUNK_PACKETS):   #pylint: disable=too-many-arguments, too-many-locals, line-too-long
+    """ "stream decode --jobs": split the record file into i_chunk_packets chunks and
+        decode them on a pool of i_jobs processes. Each chunk is numbered from its own start,
+        so the chunks are stitched together where one chunk's sequence numbers end and the
+        next one's begin. The shards are merged in order into fname and fname_binary unless
+        b_shards asks to keep them.
+        return the list of (n_dropped, first lost sequence number) gaps, numbered as
+        decode_record() numbers them
+    """
+    with open(f_name, 'rb') as f_ptr:
+        header = read_record_header(f_ptr)
+    count_packets = (os.path.getsize(f_name) - BINARY_HEADER_BYTES) // header['record_bytes']
+    lst_firsts = list(range(0, count_packets, i_chunk_packets))
+    lst_shards = [None if fname is None else '%s.%04d'%(fname, i) for i in range(len(lst_firsts))]
+    lst_bin_shards = [None if fname_binary is None else '%s.%04d'%(fname_binary, i) for i in range(len(lst_firsts))]   #pylint: disable=line-too-long
+    from concurrent.futures import ProcessPoolExecutor     #pylint: disable=import-outside-toplevel
+    with ProcessPoolExecutor(max_workers=i_jobs) as pool:
+        lst_results = list(pool.map(decode_record_chunk, [f_name]*len(lst_firsts), lst_firsts,
+                                    [i_chunk_packets]*len(lst_firsts), lst_shards, lst_bin_shards,   #pylint: disable=line-too-long
+                                    [b_shards or i == 0 for i in range(len(lst_firsts))]))
+
+    # the first chunk is numbered as decode_record() numbers the stream. Each later one is
+    # shifted to begin where the one before it ends.
+    lst_dropped = []
+    count_late = 0
+    seq_shift = 0
+    seq_end_prev = None
+    for seq_begin, seq_end, lst_gaps, count_chunk_late in lst_results:
+        seq_shift += 0 if seq_end_prev is None else seq_end_prev - seq_begin
+        lst_dropped += [(n_lost, seq_lost + seq_shift) for n_lost, seq_lost in lst_gaps]
+        count_late += count_chunk_late
+        seq_end_prev = seq_end
+
+    if not b_shards:
+        if fname is not None:
+            show_status('merging %s ...'%fname)
+            with open(fname, 'wb') as f_out:
+                for s_shard in lst_shards:
+                    with open(s_shard, 'rb') as f_in:
+                        shutil.copyfileobj(f_in, f_out)
+                    os.remove(s_shard)
+        if fname_binary is not None:
+            show_status('merging %s ...'%fname_binary)
+            sink = BinarySink(fname_binary, header['channels'], header['rate'], header['ints'])
+            for s_shard in lst_bin_shards:
+                with open(s_shard, 'rb') as f_in:
+                    count_samples = json.loads(f_in.read(BINARY_HEADER_BYTES).decode('ascii'))['samples']   #pylint: disable=line-too-long
+                    sink.write_raw(f_in.read(), count_samples)
+                os.remove(s_shard)
+            sink.close()
+    bytes_per_pkt = header['packet_bytes'] - 4
+    show_results(sum(x[0] for x in lst_dropped), count_packets, lst_dropped, count_packets*bytes_per_pkt//(4*len(header['channels'])), count_late)   #pylint: disable=line-too-long
+    return lst_dropped
+
+
+def decode_record(f_name, fname, fname_binary, bshow_status, b_index=False):
+    """ "stream decode": the offline half of --record. Decodes the record file with
+        decode_packets(), reports drops, and writes the CSV and/or binary output.
+        b_index writes the binary output through an IndexedSink, timed from the receive
+        stamp of the first packet, or from the time the recording started without --stamp.
+        return the list of (n_dropped, packet index) gaps
+    """
+    tracker = SequenceTracker()
+    lst_stream = []
+    lst_dropped = []
+    sink = None
+    i = 0
+    t_first = t_last = None
+    for header, buf, stamps in iter_record(f_name):
+        s_channels = header['channels']
+        bytes_per_pkt, fmt_unpk, _ = packet_format(header['length'], header['ints'], len(s_channels))   #pylint: disable=line-too-long
+        if sink is None and fname_binary is not None and b_index:
+            i_pkt = bytes_per_pkt//((2 if header['ints'] else 4)*len(s_channels))
+            t_start = stamps[0]*1e-9 - i_pkt/header['rate'] if stamps else header.get('time')
+            sink = IndexedSink(fname_binary, s_channels, header['rate'], header['ints'], i_pkt, t_start=t_start)   #pylint: disable=line-too-long
+        elif sink is None and fname_binary is not None:
+            sink = BinarySink(fname_binary, s_channels, header['rate'], header['ints'])
+        i += len(buf) // (bytes_per_pkt+4)
+        b_last = len(buf) < RECORD_CHUNK_PACKETS*(bytes_per_pkt+4)
+        samples, _, lst_gaps = decode_ordered(tracker, buf, bytes_per_pkt+4, fmt_unpk, len(s_channels), b_last)   #pylint: disable=line-too-long
+        lst_dropped += lst_gaps
+        if samples is not None and sink is not None:
+            sink.write(samples, tracker)
+        if samples is not None and fname is not None:
+            lst_stream += [samples]
+        if stamps:
+            t_first = stamps[0] if t_first is None else t_first
+            t_last = stamps[-1]
+        if bshow_status:
+            show_status('decoded %d packets'%i)
+    if not i:
+        print('no packets in %s'%f_name)
+        return lst_dropped
+    samples, _, lst_gaps = decode_ordered(tracker, b'', bytes_per_pkt+4, fmt_unpk, len(s_channels), True)   #pylint: disable=line-too-long
+    lst_dropped += lst_gaps
+    if samples is not None and sink is not None:
+        sink.write(samples, tracker)
+    if samples is not None and fname is not None:
+        lst_stream += [samples]
+    if sink is not None:
+        sink.close()
+    if fname is not None:
+        write_to_file(fname, s_channels, lst_stream)
+    if t_first is not None and t_last > t_first:
+        print('\nreceived %d packets in %.3f seconds (%.0f packets/s)'%(i, (t_last-t_first)*1e-9, (i-1)/((t_last-t_first)*1e-9)))   #pylint: disable=line-too-long
+    show_results(sum(x[0] for x in lst_dropped), i, lst_dropped, i*bytes_per_pkt//(4*len(s_channels)), tracker.count_late)   #pylint: disable=line-too-long
+    return lst_dropped
+
+
+
 # socket seems to catch the KeyboardInterrupt exception if I don't grab it explicitly here
 def interrupt_handler(signum, frame):  #pylint: disable=unused-argument
     """ call my cleanup_ifcs when something bad happens
@@ -173,17 +1154,43 @@ def interrupt_handler(signum, frame):  #pylint: disable=unused-argument
     sys.exit(-2)      # so Terminate process here
 
 
-signal.signal(signal.SIGINT, interrupt_handler)
+# thread functions ----------------------------------------------
+BATCH_PACKETS = 64      # packets decoded together by decode_packets() in the blocking and
+                        # thread paths
+RING_PACKETS = 4096     # slots in the --process shared memory ring
+def fill_buffer(sock_udp, count_packets, bytes_per_packet):
+    """ Receive count_packets datagrams straight into one buffer sized up front.
+        recv_into() writes each datagram in place, so the receive loop creates no
+        bytes objects or lists. Decode the buffer with decode_packets() when the stream ends.
+    """
+    buf_all = bytearray(count_packets * bytes_per_packet)
+    view = memoryview(buf_all)
+    t_start = time.perf_counter_ns()
+    for offset in range(0, len(buf_all), bytes_per_packet):
+        sock_udp.recv_into(view[offset:offset+bytes_per_packet], bytes_per_packet)
+    the_profiler.add('recv', time.perf_counter_ns() - t_start, count_packets)
+    return buf_all
 
 
-# thread functions ----------------------------------------------
-def fill_queue(sock_udp, q_data, count_packets, bytes_per_packet):
-    """ Pump packets from the socket (SR865) to the python dataQueue
+def fill_ring(sock_udp, s_shm_name, val_head, val_tail, count_packets, bytes_per_packet, count_slots):   #pylint: disable=too-many-arguments, line-too-long
+    """ --process receiver. Runs in its own process and does nothing but recv_into() the
+        next free slot of the shared memory ring and advance val_head.
+        Streamer._ring_batches() advances val_tail as it frees slots. When the ring is full,
+        wait and let the kernel socket buffer hold the packets.
     """
-    for _ in range(count_packets):
-        buf, _ = sock_udp.recvfrom(bytes_per_packet)
-        q_data.put(buf)
-    cleanup_ifcs()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # the main process cleans up after Ctrl-C
+    from multiprocessing import shared_memory       #pylint: disable=import-outside-toplevel
+    shm_ring = shared_memory.SharedMemory(name=s_shm_name)
+    view = shm_ring.buf
+    for i in range(count_packets):
+        while i - val_tail.value >= count_slots:
+            time.sleep(0.0005)
+        offset = (i % count_slots) * bytes_per_packet
+        sock_udp.recv_into(view[offset:offset+bytes_per_packet], bytes_per_packet)
+        val_head.value = i+1
+    del view
+    shm_ring.close()
+    sock_udp.close()
 
 
 def process_packet(buf, fmt_unpk, prev_pkt_cntr):
@@ -200,60 +1207,500 @@ def process_packet(buf, fmt_unpk, prev_pkt_cntr):
     # check for missed packets
     # if this isn't the 1st and the difference isn't 1 then
     if prev_pkt_cntr is not None and ((prev_pkt_cntr+1)&0xff) != cntr:
-        n_dropped = cntr - prev_pkt_cntr                    # calculate how many we missed
-        if n_dropped < 0:
-            n_dropped += 0xff
+        n_dropped = (cntr - prev_pkt_cntr - 1) & 0xff       # calculate how many we missed
     else:
         n_dropped = 0
     return vals, head, n_dropped, cntr
 
 
-def empty_queue(q_data, q_drop, count_packets, bytes_per_packet, fmt_unpk, s_prt_fmt, s_channels, fname, bshow_status): #pylint: disable=too-many-arguments, too-many-locals, line-too-long
-    """ myThreads[1] calls this to pull data out of the dataQueue.
-        When all the packets have been processed:
-            writes to a file (optional)
-            displays the dropped packet stats
-            writes the drop list (maybe empty) to q_drop.
+def decode_packets(buf, bytes_per_packet, fmt_unpk, count_vars, prev_pkt_cntr=None, i_first=0):   #pylint: disable=too-many-arguments, too-many-locals, line-too-long
+    """ Decode a run of whole packets (headers included) stored back to back in buf.
+        The samples come back as a 2-D array with count_vars columns, typed by fmt_unpk
+        (>f4 for floats, >i2 for --ints) and converted to native byte order.
+        return the samples, the headers, a list of (n_dropped, packet index) gaps, and the
+        last packet counter. i_first is the index of the first packet in buf, so that gap
+        positions stay absolute when the caller decodes in batches.
+        Without numpy, falls back to process_packet() and returns lists of samples instead.
     """
-    prev_pkt_cntr = None                         # init the packet counter
-    lst_dropped = []                            # make a list of any missing packets
-    count_dropped = 0
-    lst_stream = []
-    count_vars = len(s_channels)
-    for i in range(count_packets):
-        buf = q_data.get()
-        vals, _, n_dropped, prev_pkt_cntr = process_packet(buf, fmt_unpk, prev_pkt_cntr)
-        lst_stream += [vals]
-        if n_dropped:
-            lst_dropped += [(n_dropped, i)]
-        count_dropped += n_dropped
-        if bshow_status:
-            show_status('dropped %4d of %d'%(count_dropped, i+1), s_prt_fmt%tuple(lst_stream[-1][-count_vars:]))   #pylint: disable=line-too-long
+    count_packets = len(buf) // bytes_per_packet
+    if load_numpy() is None:
+        lst_samples = []
+        lst_heads = []
+        lst_dropped = []
+        view = memoryview(buf)
+        for i in range(count_packets):
+            offset = i*bytes_per_packet
+            vals, head, n_dropped, prev_pkt_cntr = process_packet(view[offset:offset+bytes_per_packet], fmt_unpk, prev_pkt_cntr)   #pylint: disable=line-too-long
+            lst_samples += [vals[j:j+count_vars] for j in range(0, len(vals), count_vars)]
+            lst_heads += [head]
+            if n_dropped:
+                lst_dropped += [(n_dropped, i_first+i)]
+        return lst_samples, lst_heads, lst_dropped, prev_pkt_cntr
 
-    if fname is not None:
-        write_to_file(fname, s_channels, lst_stream)
+    dtype = np.dtype('>f4' if fmt_unpk.endswith('f') else '>i2')
+    vals_per_pkt = (bytes_per_packet-4) // dtype.itemsize
+    # strided views straight onto buf: one row per packet, skipping over the headers
+    heads = np.ndarray((count_packets,), dtype='>u4', buffer=buf, strides=(bytes_per_packet,))
+    vals = np.ndarray((count_packets, vals_per_pkt), dtype=dtype, buffer=buf, offset=4,
+                      strides=(bytes_per_packet, dtype.itemsize))
+    samples = vals.astype(dtype.newbyteorder('=')).reshape(-1, count_vars)
+
+    # the 8 bit counter in each header should advance by exactly one per packet
+    cntr = (heads & 0xff).astype(np.int16)
+    prev = np.empty_like(cntr)
+    prev[1:] = cntr[:-1]
+    prev[0] = cntr[0]-1 if prev_pkt_cntr is None else prev_pkt_cntr
+    n_dropped = (cntr - prev - 1) & 0xff
+    lst_dropped = [(int(n_dropped[i]), i_first+int(i)) for i in np.flatnonzero(n_dropped)]
+    return samples, heads.astype(np.uint32), lst_dropped, int(cntr[-1])
 
-    show_results(count_dropped, count_packets, lst_dropped, count_packets*bytes_per_packet/(4*count_vars))    #pylint: disable=line-too-long
-    q_drop.put(lst_dropped)    # signal to main thread that we finished the post-processing
 
+REORDER_WINDOW = 32     # packets a late packet may trail the newest one by and still be put
+                        # back in place
+LATE_LIMIT = 128        # packets a counter may be behind the newest one and still be taken
+                        # as a late packet
+COUNTER_RAMP = bytes(range(256))
 
+class SequenceTracker:
+    """ Extends the 8 bit packet counter into a sequence number that only ever increases,
+        and puts packets that arrive out of order back in order.
+        A packet that arrives after a hole is held until the hole fills, or until the newest
+        packet is i_window past the hole, when the hole is counted as lost.
+        A counter up to LATE_LIMIT behind the newest packet is taken as a late packet only
+        if it falls in a hole: one still open, which it fills, or one already given up, or
+        before the first packet, when it is too late and left out. Anything else is a jump
+        forward over lost packets.
+        lst_gaps collects (n_lost, first lost sequence number) as the holes are given up.
+        Numbering starts at the first packet's counter, or at seq_start if given, for a
+        tracker that joins the stream part way and should expect an earlier packet first.
+    """
+    def __init__(self, i_window=REORDER_WINDOW, seq_start=None):
+        self.i_window = i_window
+        self.seq_start = seq_start      # sequence number of the first packet
+        self.seq_next = seq_start       # sequence number of the next packet to release
+        self.seq_max = None if seq_start is None else seq_start - 1    # newest sequence number seen
+        self.dict_held = {}             # sequence number -> packet waiting for a hole to fill
+        self.lst_gaps = []
+        self.count_lost = 0
+        self.count_late = 0             # duplicates, and packets too late to put back
 
-def show_results(count_dropped, count_packets, lst_dropped, count_samples):
-    """ print indicating OK, or some dropped packets"""
+    def reorder(self, buf, bytes_per_packet, b_flush=False):
+        """ Feed the packets stored back to back in buf.
+            return the packets that are ready, back to back in sequence order, and the
+            sequence number of the first of them.
+            b_flush releases everything held, counting the holes left as lost.
+        """
+        count_packets = len(buf) // bytes_per_packet
+        if count_packets and self.seq_next is None:
+            self.seq_start = self.seq_next = buf[3]
+            self.seq_max = self.seq_next - 1
+        seq_first = self.seq_next
+        if count_packets and not self.dict_held:
+            # usual case: nothing held and the counters simply count up, so pass buf straight on
+            i_start = self.seq_next & 0xff
+            if bytes(buf[3::bytes_per_packet]) == (COUNTER_RAMP*(count_packets//256 + 2))[i_start:i_start+count_packets]:   #pylint: disable=line-too-long
+                self.seq_next += count_packets
+                self.seq_max = self.seq_next - 1
+                return buf, seq_first
+
+        lst_out = []
+        view = memoryview(buf)
+        for offset in range(0, count_packets*bytes_per_packet, bytes_per_packet):
+            delta = (view[offset+3] - self.seq_max - 1) & 0xff
+            seq = self.seq_max + 1 + delta
+            if delta >= 256-LATE_LIMIT and (seq-256 >= self.seq_next or seq-256 < self.seq_start or
+                                            self._given_up(seq-256)):
+                seq -= 256
+            if seq < self.seq_next or seq in self.dict_held:
+                self.count_late += 1
+                continue
+            self.dict_held[seq] = bytes(view[offset:offset+bytes_per_packet])
+            self.seq_max = max(self.seq_max, seq)
+            self._release(lst_out, False)
+        self._release(lst_out, b_flush)
+        return b''.join(lst_out), seq_first
+
+    def _given_up(self, seq):
+        """ True if seq is in one of the holes already counted as lost
+        """
+        for n_lost, seq_lost in reversed(self.lst_gaps):
+            if seq_lost + n_lost <= seq:
+                return False
+            if seq_lost <= seq:
+                return True
+        return False
+
+    def _release(self, lst_out, b_flush):
+        while self.dict_held:
+            if self.seq_next in self.dict_held:
+                lst_out.append(self.dict_held.pop(self.seq_next))
+                self.seq_next += 1
+            elif b_flush or self.seq_max - self.seq_next >= self.i_window:
+                seq = min(self.dict_held)       # give up on the hole
+                self.lst_gaps.append((seq - self.seq_next, self.seq_next))
+                self.count_lost += seq - self.seq_next
+                self.seq_next = seq
+            else:
+                break
+
+
+def decode_ordered(tracker, buf, bytes_per_packet, fmt_unpk, count_vars, b_flush=False):   #pylint: disable=too-many-arguments
+    """ Put buf through a SequenceTracker and decode the packets it releases.
+        return the samples, the headers and the gaps given up by this call.
+        The samples and headers are None when the tracker released nothing.
+    """
+    count_gaps = len(tracker.lst_gaps)
+    buf_ordered, seq_first = tracker.reorder(buf, bytes_per_packet, b_flush)
+    if not len(buf_ordered):    #pylint: disable=len-as-condition
+        return None, None, tracker.lst_gaps[count_gaps:]
+    samples, heads, _, _ = decode_packets(buf_ordered, bytes_per_packet, fmt_unpk, count_vars, None, seq_first)   #pylint: disable=line-too-long
+    return samples, heads, tracker.lst_gaps[count_gaps:]
+
+
+def show_results(count_dropped, count_packets, lst_dropped, count_samples, count_late=0):
+    """ print indicating OK, or some dropped packets, and any packets left out as too late"""
     if count_dropped:
         print('\nFAIL: Dropped %d out of %d packets in %d gaps:'%(count_dropped, count_packets, len(lst_dropped)), end=' ')   #pylint: disable=line-too-long
         print(''.join('%d at %d, '%(x[0], x[1]) for x in lst_dropped[:5]))
     else:
         print('\npass: No packets dropped out of %d. %d samples captured.'%(count_packets, count_samples))   #pylint: disable=line-too-long
+    if count_late:
+        print('%d packets arrived too late to put back in order, or twice, and were left out'%count_late)   #pylint: disable=line-too-long
+
+
+
+# the library interface --------------------------------------------
+PREFETCH_BATCHES = 64   # received batches a Streamer holds before its receive thread waits for
+                        # the consumer
+RECEIVE_TIMEOUT = 2.0   # seconds without a packet before a Streamer with a duration gives up
+STREAM_MODES = ('thread', 'block', 'buffer', 'process')     # how a Streamer receives
+
+# samples: numpy array with one column per channel, or a list of sample lists without numpy
+# i_first: index of the first sample in the stream. headers: packet headers decoded since the
+# last block. gaps: (n_lost, sequence number) holes given up since the last block.
+# count_dropped: packets lost so far
+StreamBlock = collections.namedtuple('StreamBlock', ['samples', 'i_first', 'headers', 'gaps', 'count_dropped', 'count_late'])   #pylint: disable=line-too-long
+
+
+def join_blocks(lst_blocks):
+    """ return the sample (or header) blocks in lst_blocks as one, numpy or list as they came
+    """
+    if len(lst_blocks) == 1:
+        return lst_blocks[0]
+    if hasattr(lst_blocks[0], 'ravel'):
+        return np.concatenate(lst_blocks)
+    return [v for block in lst_blocks for v in block]
+
+
+class Streamer:     #pylint: disable=too-many-instance-attributes
+    """ Streams from one SR865 inside another python program, e.g.
+
+            with stream.Streamer('172.25.98.253', s_channels='XY', duration=10) as streamer:
+                for block in streamer:
+                    use(block.samples)
+
+        open() connects and configures the instrument. start() turns the stream on. s_mode is
+        how the packets are received, BATCH_PACKETS at a time:
+          thread   a thread receives into a queue of at most i_prefetch batches (the default)
+          block    the thread iterating receives each batch, then decodes it
+          buffer   the whole stream goes into one buffer first, then is decoded
+          process  another process receives into a shared memory ring of RING_PACKETS slots
+        buffer and process need a duration.
+        Iterating decodes the batches through a SequenceTracker and yields StreamBlocks
+        of i_block samples (the last one may be shorter). i_block 0 yields each batch as it is
+        decoded, so the tracker describes the block just yielded. A consumer slower than the
+        stream fills the queue, which stops the receive thread, and then the socket buffer.
+        UDP cannot slow the instrument down, so after that packets are lost and show up in the gaps.
+        With duration None it streams until stop() or close().
+    """
+    def __init__(self, s_address, i_port=1865, s_channels='X', f_rate_req=1e5, idx_pkt_len=0,     #pylint: disable=too-many-arguments
+                 b_integers=False, duration=None, i_block=None, i_prefetch=PREFETCH_BATCHES,
+                 t_slack=0.5, b_autotune=False, s_mode='thread'):
+        if s_mode not in STREAM_MODES:
+            raise ValueError('s_mode must be one of %s'%', '.join(STREAM_MODES))
+        if s_mode in ('buffer', 'process') and duration is None:
+            raise ValueError('s_mode %s needs a duration'%s_mode)
+        self.s_address = s_address
+        self.i_port = i_port
+        self.s_channels = s_channels
+        self.f_rate_req = f_rate_req
+        self.idx_pkt_len = idx_pkt_len
+        self.b_integers = b_integers
+        self.duration = duration
+        self.i_block = i_block          # samples per block, one batch of packets when None
+        self.t_slack = t_slack
+        self.b_autotune = b_autotune
+        self.s_mode = s_mode
+        self.sock_udp = None
+        self.vx_ifc = None
+        self.f_rate = None              # the rate the instrument actually streams at
+        self.bytes_per_packet = None    # header included
+        self.i_packet_samples = None
+        self.fmt_unpk = None
+        self.fmt_live_printing = None
+        self.total_packets = None       # None streams until close()
+        self.tracker = SequenceTracker()
+        self.q_batches = queue.Queue(maxsize=i_prefetch)
+        self.evt_stop = threading.Event()
+        self.thread = None
+        self.proc_rcv = None            # the process mode receiver and its ring
+        self.shm_ring = None
+        self.val_head = None            # packets received, written by fill_ring()
+        self.val_tail = None            # packets decoded, written by _ring_batches()
+        self.count_packets = 0          # packets decoded so far
+        self.t_decode = 0.0             # seconds the last batch took to decode
+        self.profiler = the_profiler    # stages timed by the receive thread and the iterator
+
+    def __enter__(self):
+        self.open()
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """ open the UDP socket and the vxi11 session, and configure the instrument
+        """
+        print('\nopening incoming UDP Socket at %d ...' % self.i_port, end=' ')
+        self.sock_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock_udp.bind(('', self.i_port))  # anything arriving on this port from anyone
+        print('done')
+        print('opening VXI-11 at %s ...' % self.s_address, end=' ')
+        self.vx_ifc = open_instrument(self.s_address)
+        with scpi.Batch(self.vx_ifc) as batch:
+            batch.setting('STREAMPORT', self.i_port)
+        print('done')
+        i_decimate = None
+        if self.b_autotune:
+            self.idx_pkt_len, i_decimate = autotune(self.vx_ifc, self.sock_udp, self.s_address, self.s_channels, self.b_integers, self.f_rate_req)   #pylint: disable=line-too-long
+        self.f_rate = dut_config(self.vx_ifc, self.s_channels, self.idx_pkt_len, self.f_rate_req, self.b_integers, i_decimate)   #pylint: disable=line-too-long
+        bytes_per_pkt, self.fmt_unpk, self.fmt_live_printing = packet_format(self.idx_pkt_len, self.b_integers, len(self.s_channels))   #pylint: disable=line-too-long
+        self.bytes_per_packet = bytes_per_pkt + 4
+        if self.duration is not None:
+            self.total_packets = int(math.ceil(self.duration*self.f_rate*4*len(self.s_channels)/bytes_per_pkt))   #pylint: disable=line-too-long
+        self.i_packet_samples = bytes_per_pkt // ((2 if self.b_integers else 4)*len(self.s_channels))   #pylint: disable=line-too-long
+        if self.i_block is None:
+            self.i_block = BATCH_PACKETS*self.i_packet_samples
+        tune_socket_buffer(self.sock_udp, self.f_rate, len(self.s_channels), bytes_per_pkt, self.b_integers, self.t_slack)   #pylint: disable=line-too-long
+
+    def start(self, b_receive=True):
+        """ turn the stream on, and start the receive thread or process s_mode calls for.
+            Without b_receive the caller reads sock_udp itself.
+        """
+        self.vx_ifc.write('STREAM ON')
+        if b_receive and self.s_mode == 'thread':
+            self.thread = threading.Thread(target=self._receive, daemon=True)
+            self.thread.start()
+        elif b_receive and self.s_mode == 'process':
+            import multiprocessing                      #pylint: disable=import-outside-toplevel
+            from multiprocessing import shared_memory   #pylint: disable=import-outside-toplevel
+            self.shm_ring = shared_memory.SharedMemory(create=True, size=RING_PACKETS*self.bytes_per_packet)   #pylint: disable=line-too-long
+            self.val_head = multiprocessing.RawValue('q', 0)
+            self.val_tail = multiprocessing.RawValue('q', 0)
+            self.proc_rcv = multiprocessing.Process(target=fill_ring, daemon=True,
+                                                    args=(self.sock_udp, self.shm_ring.name, self.val_head, self.val_tail,   #pylint: disable=line-too-long
+                                                          self.total_packets, self.bytes_per_packet, RING_PACKETS))   #pylint: disable=line-too-long
+            self.proc_rcv.start()
+
+    def queue_depth(self):
+        """ return how many packets are received but not decoded yet
+        """
+        if self.s_mode == 'thread':
+            return self.q_batches.qsize()*BATCH_PACKETS
+        if self.val_head is not None:
+            return self.val_head.value - self.val_tail.value
+        return 0
+
+    def _put(self, item):
+        """ queue item, waiting while the queue is full unless close() is called
+        """
+        t_start = time.perf_counter_ns()
+        while not self.evt_stop.is_set():
+            with contextlib.suppress(queue.Full):
+                self.q_batches.put(item, timeout=0.2)
+                self.profiler.add('queue_put', time.perf_counter_ns() - t_start)
+                return
 
+    def _receive_batches(self, t_timeout):
+        """ yield batches of packets received back to back, until total_packets have arrived,
+            stop() is called, or no packet arrives for RECEIVE_TIMEOUT seconds (with a
+            duration). With t_timeout None recv_into() blocks and only the packet count ends it.
+        """
+        self.sock_udp.settimeout(t_timeout)
+        count_left = self.total_packets
+        t_last = time.perf_counter()
+        while not self.evt_stop.is_set() and (count_left is None or count_left > 0):
+            count_batch = BATCH_PACKETS if count_left is None else min(BATCH_PACKETS, count_left)
+            buf = bytearray(count_batch*self.bytes_per_packet)
+            view = memoryview(buf)
+            i = 0
+            t_start = time.perf_counter_ns()
+            with contextlib.suppress(socket.timeout):
+                while i < count_batch and not self.evt_stop.is_set():
+                    offset = i*self.bytes_per_packet
+                    self.sock_udp.recv_into(view[offset:offset+self.bytes_per_packet], self.bytes_per_packet)   #pylint: disable=line-too-long
+                    i += 1
+            if not i:
+                if count_left is not None and time.perf_counter() - t_last > RECEIVE_TIMEOUT:
+                    print('\n**** STREAM TIMEOUT! ****')
+                    break
+                continue
+            t_last = time.perf_counter()
+            self.profiler.add('recv', time.perf_counter_ns() - t_start, i)
+            if count_left is not None:
+                count_left -= i
+            yield buf if i == count_batch else buf[:i*self.bytes_per_packet]
+
+    def _receive(self):
+        """ the receive thread. Queues the batches, then a None to mark the end.
+        """
+        try:
+            # the timeout lets close() be noticed even when no packets arrive
+            for buf in self._receive_batches(0.2):
+                self._put(buf)
+        except OSError:
+            pass                        # close() shut the socket
+        finally:
+            self._put(None)
+
+    def _queued_batches(self):
+        """ thread mode: yield the batches the receive thread queues
+        """
+        while True:
+            self.profiler.gauge('queue_depth', self.q_batches.qsize())
+            t_start = time.perf_counter_ns()
+            buf = self.q_batches.get()
+            self.profiler.add('queue_get', time.perf_counter_ns() - t_start)
+            if buf is None:
+                return
+            yield buf
+
+    def _buffered_batches(self):
+        """ buffer mode: receive the whole stream into one buffer and stop the stream, so
+            nothing piles up in the socket while it is decoded
+        """
+        buf_all = fill_buffer(self.sock_udp, self.total_packets, self.bytes_per_packet)
+        self.vx_ifc.write('STREAM OFF')
+        yield buf_all
+
+    def _ring_batches(self):
+        """ process mode: yield each contiguous run of the slots fill_ring() has filled, and
+            hand it back by advancing val_tail once the next one is asked for, when its
+            samples and held packets are copies. Gives up when no packet arrives for
+            RECEIVE_TIMEOUT seconds.
+        """
+        i = 0
+        t_last = time.perf_counter()
+        while i < self.total_packets and not self.evt_stop.is_set():
+            i_head = self.val_head.value
+            if i_head == i:
+                if time.perf_counter() - t_last > RECEIVE_TIMEOUT:
+                    print('\n**** STREAM TIMEOUT! ****')
+                    break
+                time.sleep(0.001)
+                continue
+            t_last = time.perf_counter()
+            self.profiler.gauge('ring_depth', i_head - i)
+            i_slot = i % RING_PACKETS
+            count_batch = min(i_head-i, RING_PACKETS-i_slot)    # stop at the end of the ring
+            offset = i_slot*self.bytes_per_packet
+            yield self.shm_ring.buf[offset:offset+count_batch*self.bytes_per_packet]
+            i += count_batch
+            self.val_tail.value = i
+
+    def _batches(self):
+        """ return an iterator over the received batches, the way s_mode receives them
+        """
+        if self.s_mode == 'thread':
+            return self._queued_batches()
+        if self.s_mode == 'block':
+            return self._receive_batches(0.2 if self.total_packets is None else None)
+        if self.s_mode == 'buffer':
+            return self._buffered_batches()
+        return self._ring_batches()
+
+    def __iter__(self):
+        """ yield StreamBlocks until the stream ends
+        """
+        count_vars = len(self.s_channels)
+        lst_pending = []                # decoded blocks not yet handed out
+        count_pending = 0
+        lst_heads = []
+        lst_gaps = []
+        i_first = 0
+        for buf in itertools.chain(self._batches(), [None]):
+            b_end = buf is None         # release whatever the tracker still holds
+            t_start = time.perf_counter_ns()
+            samples, heads, gaps = decode_ordered(self.tracker, b'' if b_end else buf, self.bytes_per_packet, self.fmt_unpk, count_vars, b_end)   #pylint: disable=line-too-long
+            t_decode = time.perf_counter_ns() - t_start
+            self.profiler.add('decode', t_decode, 0 if b_end else len(buf)//self.bytes_per_packet)
+            self.t_decode = t_decode/1e9
+            del buf                     # a process mode ring slot may be reused from here on
+            lst_gaps += gaps
+            if samples is not None:
+                lst_pending.append(samples)
+                count_pending += len(samples)
+                lst_heads.append(heads)
+                self.count_packets += len(heads)
+            if not self.i_block and count_pending:
+                yield StreamBlock(samples, i_first, heads, lst_gaps, self.tracker.count_lost, self.tracker.count_late)   #pylint: disable=line-too-long
+                i_first += count_pending
+                lst_pending, count_pending, lst_heads, lst_gaps = [], 0, [], []
+            while self.i_block and (count_pending >= self.i_block or (b_end and count_pending)):
+                joined = join_blocks(lst_pending)
+                block = joined[:self.i_block]
+                lst_pending = [joined[self.i_block:]] if len(joined) > self.i_block else []
+                count_pending -= len(block)
+                yield StreamBlock(block, i_first, join_blocks(lst_heads) if lst_heads else [], lst_gaps, self.tracker.count_lost, self.tracker.count_late)   #pylint: disable=line-too-long
+                i_first += len(block)
+                lst_heads = []
+                lst_gaps = []
+
+    @property
+    def lst_gaps(self):
+        """ every (n_lost, sequence number) hole given up so far """
+        return self.tracker.lst_gaps
+
+    def stop(self):
+        """ end a stream early: iterating ends once the packets held are released.
+            Only sets an event, so a signal handler may call it.
+        """
+        self.evt_stop.set()
+
+    def close(self):
+        """ stop the receive thread or process and the stream, and close the socket and vxi11.
+            Safe to call more than once.
+        """
+        self.evt_stop.set()
+        if self.thread is not None:
+            self.thread.join(1.0)
+            self.thread = None
+        if self.vx_ifc is not None:
+            self.vx_ifc.write('STREAM OFF')
+            self.vx_ifc.close()
+            self.vx_ifc = None
+        if self.proc_rcv is not None:
+            self.proc_rcv.join(2)
+            if self.proc_rcv.is_alive():
+                self.proc_rcv.terminate()
+            self.proc_rcv = None
+        if self.shm_ring is not None:
+            with contextlib.suppress(BufferError):  # a slot an abandoned iterator still holds
+                self.shm_ring.close()
+            self.shm_ring.unlink()
+            self.shm_ring = None
+        if self.sock_udp is not None:
+            self.sock_udp.close()
+            self.sock_udp = None
 
 
 # the main program -----------------------------------------------
 def test(opts):     #pylint: disable=too-many-locals, too-many-statements
     """ example main()
+        return the list of (n_dropped, packet index) gaps
     """
-    # global the_udp_socket
-    # global the_vx_ifc
+    global the_streamer     #pylint: disable=global-statement, invalid-name
 
     # group the docopt stuff to make it easier to remove, if desired
     dut_add = opts['--address']               # IP address and streaming port of the SR865
@@ -266,72 +1713,130 @@ def test(opts):     #pylint: disable=too-many-locals, too-many-statements
     duration_stream = float(opts['--duration'])     # in seconds
     bshow_status = not opts['--silent']
     fname = opts['--file']
+    fname_binary = opts['--output']
     s_channels = str(opts['--vars'])           # what to stream. X, XY, RT, or XYRT allowed
     lst_vars_allowed = ['X', 'XY', 'RT', 'XYRT']
     b_integers = opts['--ints']
     b_use_threads = opts['--thread']
+    b_use_buffer = opts['--buffer']
+    b_use_process = opts['--process']
+    fname_record = opts['--record']
+    b_continuous = opts['--continuous']
+    the_profiler.b_enabled = opts['--profile'] is not None
 
     if s_channels.upper() not in lst_vars_allowed:
         print('bad --vars option (%s). Must be one of'%s_channels.upper(), ', '.join(lst_vars_allowed))   #pylint: disable=line-too-long
         sys.exit(-1)
+    if b_continuous and fname is not None:
+        print('--file keeps every sample in memory. Use --output with --continuous')
+        sys.exit(-1)
+    if opts['--index'] and (fname_binary is None or b_continuous or opts['--compress']):
+        print('--index needs --output, and does not work with --continuous or --compress')
+        sys.exit(-1)
+    if opts['--compress'] is not None:
+        try:
+            export.parse_compress(opts['--compress'])
+        except ValueError as err:
+            print(err)
+            sys.exit(-1)
+    if opts['--analyze'] is not None and fname_record is not None:
+        print('--record does not decode the stream, so there is nothing to --analyze')
+        sys.exit(-1)
+    if opts['--analyze'] is not None and load_numpy() is None:
+        print('--analyze needs numpy. Please install numpy')
+        sys.exit(-1)
 
-    open_interfaces(dut_add, dut_port)
-    f_total_samples = duration_stream * dut_config(the_vx_ifc, s_channels, idx_pkt_len, f_rate_req, b_integers)   #pylint: disable=line-too-long
-    # translate the packet size enumeration into an actual byte count
-    bytes_per_pkt = [1024, 512, 256, 128][idx_pkt_len]
-    if b_integers:
-        fmt_unpk = '>%dh'%(bytes_per_pkt//2)            # create an unpacking format string.
-        fmt_live_printing = '%12d'*len(s_channels)        # create status format string.
-    else:
-        fmt_unpk = '>%df'%(bytes_per_pkt//4)
-        fmt_live_printing = '%12.6f'*len(s_channels)
-
-    total_packets = int(math.ceil(f_total_samples*4*len(s_channels)/bytes_per_pkt))
-    prev_pkt_cntr = None                         # init the packet counter
-    lst_stream = []                              # make a list of lists of the float data
-    headers = []                            # make a list of the packet headers
+    load_numpy()            # a missing numpy is reported now rather than part way into the stream
+    s_mode = 'thread' if b_use_threads else 'buffer' if b_use_buffer else 'process' if b_use_process else 'block'   #pylint: disable=line-too-long
+    the_streamer = Streamer(dut_add, dut_port, s_channels, f_rate_req, idx_pkt_len, b_integers,
+                            None if b_continuous else duration_stream, i_block=0, t_slack=float(opts['--slack']),   #pylint: disable=line-too-long
+                            b_autotune=opts['--autotune'], s_mode=s_mode)
+    the_streamer.open()
+    # --continuous ends on Ctrl-C, after releasing the packets held. Everything else cleans up
+    # and exits
+    signal.signal(signal.SIGINT, (lambda signum, frame: the_streamer.stop()) if b_continuous else interrupt_handler)   #pylint: disable=line-too-long
+    f_rate = the_streamer.f_rate
+    sink = None
+    if b_continuous and fname_binary is not None:
+        sink = SegmentSink(fname_binary, s_channels, f_rate, b_integers, *parse_segment(opts['--segment']), opts['--hook'], opts['--compress'])   #pylint: disable=line-too-long
+    elif fname_binary is not None and fname_record is None and opts['--index']:
+        sink = IndexedSink(fname_binary, s_channels, f_rate, b_integers, the_streamer.i_packet_samples)   #pylint: disable=line-too-long
+    elif fname_binary is not None and fname_record is None and opts['--compress']:
+        sink = CompressedSink(fname_binary, s_channels, f_rate, b_integers, opts['--compress'])
+    elif fname_binary is not None and fname_record is None:
+        sink = BinarySink(fname_binary, s_channels, f_rate, b_integers)
+    if opts['--analyze'] is not None:
+        import analysis     #pylint: disable=import-outside-toplevel
+        i_reduce = int(opts['--decimate'])     # on the host, after the instrument's own decimation
+        stream_analysis = analysis.StreamAnalysis(opts['--analyze'], s_channels, f_rate, i_reduce)
+        stream_analysis.sink_decimated = BinarySink(os.path.splitext(opts['--analyze'])[0] + '_dec.bin', ''.join(stream_analysis.lst_names), f_rate/i_reduce, False)   #pylint: disable=line-too-long
+        sink = AnalysisTee(stream_analysis, sink)
+    monitor = KernelDropMonitor(dut_port)
+    stats = StreamStats(the_streamer.fmt_live_printing, bshow_status, None if opts['--metrics'] is None else int(opts['--metrics']))   #pylint: disable=line-too-long
+    stats.sink = sink
+    stats.fn_queue_depth = the_streamer.queue_depth
+    lst_stream = []                         # make a list of the decoded sample blocks for --file
     dropped = []                            # make a list of any gaps in the packets
 
     show_status('streaming ...')
     time_start = time.perf_counter()
-    the_vx_ifc.write('STREAM ON')
-    if b_use_threads:
-        the_threads = []
-        queue_drops = queue.Queue()
-        queue_data = queue.Queue()            # decouple the printing/saving from the UDP socket
-        for queue_func, queue_args in [(fill_queue, (the_udp_socket, queue_data, total_packets, bytes_per_pkt+4)),    #pylint: disable=line-too-long
-                                       (empty_queue, (queue_data, queue_drops, total_packets, bytes_per_pkt, fmt_unpk, fmt_live_printing, s_channels, fname, bshow_status))]:   #pylint: disable=line-too-long
-            the_threads.append(threading.Thread(target=queue_func, args=queue_args))
-            # the_threads[-1].setDaemon(True)
-            the_threads[-1].start()
-        s_no_printing = '' if bshow_status else 'silently'
-        print('threads started %s\n'%s_no_printing)
-        the_threads[0].join(duration_stream+2)    # time out 2 seconds after the expected duration
-        the_threads[1].join(duration_stream*2)    # time out 2x the duration more
-        # queue_drops.get() blocks until empty_queue() writes to queue_drops showing it finished.
-        dropped = queue_drops.get()
-        print('threads done')
-
-    else:           # don't use threads. "block" instead
-        for i in range(total_packets):
-            # .recvfrom "blocks" program execution until all the bytes have been received.
-            buf, _ = the_udp_socket.recvfrom(bytes_per_pkt+4)
-            vals, head, n_dropped, prev_pkt_cntr = process_packet(buf, fmt_unpk, prev_pkt_cntr)
-            lst_stream += [vals]
-            headers += [head]
-            dropped += [n_dropped]
-            if bshow_status:
-                show_status('dropped %4d of %d'%(sum(dropped), i), fmt_live_printing%tuple(lst_stream[-1][-len(s_channels):]))   #pylint: disable=line-too-long
-
+    monitor.start()
+    stats.start()
+    if fname_record is not None:    # no decoding at all. "stream decode" does it later
+        the_streamer.start(False)
+        dict_header = {'channels': s_channels.upper(), 'rate': f_rate, 'ints': b_integers,
+                       'length': the_streamer.idx_pkt_len, 'packet_bytes': the_streamer.bytes_per_packet, 'stamp': opts['--stamp'], 'time': time.time()}   #pylint: disable=line-too-long
+        record_packets(the_streamer.sock_udp, fname_record, the_streamer.total_packets, the_streamer.bytes_per_packet, dict_header, opts['--stamp'])   #pylint: disable=line-too-long
+        cleanup_ifcs()
+        print('%d packets recorded. Decode them with: python stream.py decode %s'%(the_streamer.total_packets, fname_record))   #pylint: disable=line-too-long
+    else:
+        the_streamer.start()
+        if b_continuous:
+            print('streaming until Ctrl-C\n')
+        elif b_use_threads:
+            print('receive thread started %s\n'%('' if bshow_status else 'silently'))
+        for block in the_streamer:
+            if sink is not None:
+                sink.write(block.samples, the_streamer.tracker)
+            if fname is not None:
+                lst_stream += [block.samples]
+            stats.update(the_streamer.count_packets, block.count_dropped, block.samples, the_streamer.t_decode, block.count_late)   #pylint: disable=line-too-long
+        dropped = the_streamer.lst_gaps
+        stats.finish()
+        if sink is not None:
+            sink.close()
         if fname is not None:
             write_to_file(fname, s_channels, lst_stream)
         cleanup_ifcs()
-        show_results(sum(dropped), total_packets, dropped, total_packets*bytes_per_pkt//(4*len(s_channels)))    #pylint: disable=line-too-long
+        count_packets = the_streamer.count_packets + the_streamer.tracker.count_lost if b_continuous else the_streamer.total_packets   #pylint: disable=line-too-long
+        show_results(sum(x[0] for x in dropped), count_packets, dropped, stats.count_samples, the_streamer.tracker.count_late)   #pylint: disable=line-too-long
     time_end = time.perf_counter()
+    stats.stop()
+    for s_line in monitor.stop(sum(x[0] for x in dropped)):
+        print(s_line)
     print('Time elapsed: %.3f seconds'%(time_end-time_start))
+    if opts['--profile'] is not None:
+        for s_line in the_profiler.report():
+            print(s_line)
+        if opts['--profile'] != '-':
+            the_profiler.dump(opts['--profile'])
+    return dropped
 
 
 if __name__ == '__main__':
     # group the docopt stuff to make it easier to remove, if desired
+    try:
+        import docopt       # handy command line parser.
+    except ImportError:
+        print('python docopt library not found. Please install docopt')
+        sys.exit(-1)
     dict_options = docopt.docopt(USE_STR, version='0.0.2')  #pylint: disable=invalid-name
-    test(dict_options)
+    if dict_options['decode']:
+        if int(dict_options['--jobs']) > 1 and dict_options['--index']:
+            print('--index needs --jobs 1')
+        elif int(dict_options['--jobs']) > 1:
+            decode_record_parallel(dict_options['<record>'], dict_options['--file'], dict_options['--output'], int(dict_options['--jobs']), dict_options['--shards'])   #pylint: disable=line-too-long
+        else:
+            decode_record(dict_options['<record>'], dict_options['--file'], dict_options['--output'], not dict_options['--silent'], dict_options['--index'])   #pylint: disable=line-too-long
+    else:
+        test(dict_options)
@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) 2015-2019 Stanford Research Systems
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnshished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+""" Checks of stream.py's offline decoding on record files built from bench_decode's
+        synthetic packets, and of the export and scpi helpers it uses. No hardware or
+        network needed.
+
+        python -m pytest test_stream.py
+"""
+import array
+import contextlib
+import io
+import os
+import types
+
+import bench_decode
+import export
+import scpi
+import sr865sim
+import stream
+
+
+def write_record(s_dir, count_packets, f_drop=0.0, f_reorder=0.0):
+    """ write a record file of count_packets XY float packets, 128 bytes each, with
+        f_drop of them lost and f_reorder sent after their neighbour.
+        return its name
+    """
+    sim = bench_decode.make_sim('XY', 3, False)
+    buf, _ = bench_decode.make_packets(sim, count_packets, f_drop, f_reorder, i_seed=1)
+    dict_header = {'channels': 'XY', 'rate': 1e5, 'ints': False, 'length': 3,
+                   'packet_bytes': 132, 'stamp': False}
+    f_name = os.path.join(s_dir, 'test.rec')
+    with open(f_name, 'wb') as f_ptr:
+        f_ptr.write(export.binary_header(dict_header) + buf)
+    return f_name
+
+
+def decode_both(s_dir, f_name):
+    """ decode f_name serially and with --jobs 2 in small chunks.
+        return the two gap lists and the two binary outputs
+    """
+    f_serial = os.path.join(s_dir, 'serial.bin')
+    f_parallel = os.path.join(s_dir, 'parallel.bin')
+    lst_serial = stream.decode_record(f_name, None, f_serial, False)
+    lst_parallel = stream.decode_record_parallel(f_name, None, f_parallel, 2, False, 1000)
+    with open(f_serial, 'rb') as f_ptr:
+        data_serial = f_ptr.read()
+    with open(f_parallel, 'rb') as f_ptr:
+        data_parallel = f_ptr.read()
+    return lst_serial, lst_parallel, data_serial, data_parallel
+
+
+def test_parallel_gaps_match_serial(tmp_path):
+    """ --jobs reports the same gaps, at the same positions, as a serial decode
+    """
+    f_name = write_record(str(tmp_path), 5000, f_drop=0.01)
+    lst_serial, lst_parallel, data_serial, data_parallel = decode_both(str(tmp_path), f_name)
+    assert lst_serial
+    assert lst_parallel == lst_serial
+    assert data_parallel == data_serial
+
+
+def test_parallel_reordered_matches_serial(tmp_path):
+    """ with packets swapped with their neighbour, including across chunk edges, --jobs
+        puts them back in order and agrees with a serial decode
+    """
+    f_name = write_record(str(tmp_path), 5000, f_drop=0.01, f_reorder=0.05)
+    lst_serial, lst_parallel, data_serial, data_parallel = decode_both(str(tmp_path), f_name)
+    assert sum(x[0] for x in lst_serial) < 100
+    assert lst_parallel == lst_serial
+    assert data_parallel == data_serial
+
+
+def test_tracker_burst_loss_and_late_packet():
+    """ a loss of more than 256-LATE_LIMIT packets is counted, and a packet too late to put
+        back is left out rather than taken as a jump forward
+    """
+    def track(lst_seqs):
+        tracker = stream.SequenceTracker()
+        buf = b''.join(bytes((0, 0, 0, seq & 0xff, seq & 0xff)) for seq in lst_seqs)
+        ordered, _ = tracker.reorder(buf, 5, True)
+        return tracker.lst_gaps, tracker.count_late, list(ordered[4::5])
+    assert track(list(range(101)) + list(range(331, 400))) == ([(230, 101)], 0, [x & 0xff for x in list(range(101)) + list(range(331, 400))])   #pylint: disable=line-too-long
+    lst_late = [x for x in range(91) if x != 50] + [50] + list(range(91, 120))
+    assert track(lst_late)[:2] == ([(1, 50)], 1)
+
+
+def test_tracker_reordered_first_packets():
+    """ a packet from before the first one received is late, not a jump forward over 255
+        lost packets
+    """
+    tracker = stream.SequenceTracker()
+    buf = b''.join(bytes((0, 0, 0, seq, seq)) for seq in [1, 0] + list(range(2, 40)))
+    ordered, seq_first = tracker.reorder(buf, 5, True)
+    assert (tracker.lst_gaps, tracker.count_late, seq_first) == ([], 1, 1)
+    assert list(ordered[4::5]) == list(range(1, 40))
+
+
+def test_segments_closed_off_the_receive_thread(tmp_path):
+    """ a full segment is closed, then hooked, on the worker thread, in segment order
+    """
+    f_log = os.path.join(str(tmp_path), 'hook.log')
+    sink = stream.SegmentSink(os.path.join(str(tmp_path), 'c.bin'), 'XY', 1e5, False,
+                              bytes_segment=1024, s_hook='echo {} >> %s'%f_log, s_compress='zlib')
+    samples = [(0.5, -0.5)]*64
+    for i in range(4):
+        sink.write(samples, types.SimpleNamespace(seq_start=0, seq_next=64*(i + 1), lst_gaps=[]))
+    sink.write(None, None)              # a block with nothing in it
+    sink.close()
+    with open(f_log) as f_ptr:
+        lst_hooked = f_ptr.read().split()
+    assert [os.path.basename(x) for x in lst_hooked] == ['c_%05d.bin'%i for i in range(2)]
+    for i, f_segment in enumerate(lst_hooked):
+        dict_header, samples_read = stream.read_binary(f_segment)
+        assert (dict_header['seq_first'], dict_header['seq_next']) == (128*i, 128*(i + 1))
+        assert len(samples_read) == 128
+
+
+def test_limits_cached_per_configuration():
+    """ STREAMRATEMAX? is asked after the stream configuration is sent, once per
+        configuration, and again after forget_limits()
+    """
+    class CountingSim(sr865sim.Instrument):
+        """ counts the queries """
+        lst_asked = []
+
+        def ask(self, s_cmd):
+            self.lst_asked.append(s_cmd)
+            return super().ask(s_cmd)
+    instrument = CountingSim(host='test-limits')
+    scpi.forget(instrument)
+    with contextlib.redirect_stdout(io.StringIO()):
+        stream.dut_config(instrument, 'XY', 0, 1e5, False)
+        instrument.f_rate_max = 6.25e5
+        stream.dut_config(instrument, 'XY', 0, 1e5, False)
+        f_rate = stream.dut_config(instrument, 'XY', 1, 1e5, False)
+        scpi.forget_limits(instrument)
+        f_rate_fresh = stream.dut_config(instrument, 'XY', 1, 1e5, False)
+    assert instrument.lst_asked == ['STREAMRATEMAX?']*3
+    assert (f_rate, f_rate_fresh) == (6.25e5/8, 6.25e5/8)
+    scpi.forget(instrument)
+
+
+def test_write_csv_chunked_and_threaded(tmp_path):
+    """ write_csv gives the same rows, one per sample, whether the chunks are formatted on
+        the writing thread or a worker, and whatever the blocks are made of
+    """
+    lst_rows = [(i*0.25, -i*0.5) for i in range(2*export.CHUNK_ROWS + 100)]
+    s_expected = 'X,Y,\n' + ''.join('%+12.6e,%+12.6e,\n'%row for row in lst_rows)
+    i_split = export.CHUNK_ROWS - 7     # a block ends part way into the first chunk
+    lst_blocks = [lst_rows[:i_split], [v for row in lst_rows[i_split:i_split+50] for v in row],
+                  array.array('d', [v for row in lst_rows[i_split+50:] for v in row])]
+    for b_threads in (False, True):
+        f_name = os.path.join(str(tmp_path), 'threads.csv' if b_threads else 'chunks.csv')
+        assert export.write_csv(f_name, 'XY', lst_blocks, b_threads=b_threads) == len(lst_rows)
+        with open(f_name) as f_ptr:
+            assert f_ptr.read() == s_expected
+
+
+def test_batch_skips_cached_settings():
+    """ a setting the instrument already has is not sent again, a changed one is, and
+        commands always go out, all of a batch in one write
+    """
+    vx_ifc = types.SimpleNamespace(host='test-batch', lst_written=[])
+    vx_ifc.write = vx_ifc.lst_written.append
+    scpi.forget(vx_ifc)
+    with scpi.Batch(vx_ifc) as batch:
+        batch.setting('STREAMCH', 1)
+        batch.setting('STREAMFMT', 0)
+    with scpi.Batch(vx_ifc) as batch:
+        batch.command('STREAM OFF')
+        batch.setting('STREAMCH', 1)
+        batch.setting('STREAMFMT', 1)
+    with scpi.Batch(vx_ifc) as batch:
+        batch.setting('STREAMCH', 1)
+    assert vx_ifc.lst_written == ['STREAMCH 1;STREAMFMT 0', 'STREAM OFF;STREAMFMT 1']
+    scpi.forget(vx_ifc)
+
+
+def test_indexed_range_matches_brute_force(tmp_path):
+    """ IndexedFile.range() of a decoded recording with lost packets gives the samples and
+        holes found by laying the samples out over the whole stream, lost ones included
+    """
+    np = stream.load_numpy()
+    f_name = write_record(str(tmp_path), 3000, f_drop=0.02, f_reorder=0.02)
+    f_binary = os.path.join(str(tmp_path), 'indexed.bin')
+    with contextlib.redirect_stdout(io.StringIO()):
+        lst_gaps = stream.decode_record(f_name, None, f_binary, False, b_index=True)
+    indexed = stream.IndexedFile(f_binary)
+    i_pkt, f_rate = indexed.header['packet_samples'], indexed.header['rate']
+    lost = np.zeros(len(indexed.samples) + sum(n for n, _ in lst_gaps)*i_pkt, dtype=bool)
+    for n_lost, seq in lst_gaps:
+        lost[(seq - indexed.header['seq_start'])*i_pkt:(seq - indexed.header['seq_start'] + n_lost)*i_pkt] = True   #pylint: disable=line-too-long
+    i_kept = np.cumsum(~lost) - ~lost       # samples kept before each stream position
+    t_holes = [((seq - indexed.header['seq_start'])*i_pkt + 3)/f_rate for _, seq in lst_gaps[:5]]
+    for t_start, t_end in ((0.0, 0.48), (0.0371, 0.1), (0.11, 0.1101), (0.2, 0.1), (0.3, 1.0),
+                           (t_holes[0], t_holes[4]), (t_holes[1], t_holes[1] + 1e-5)):
+        samples, t_first, lst_holes = indexed.range(t_start, t_end)
+        i_first = int(np.ceil(t_start*f_rate))
+        i_end = max(i_first, min(len(lost), int(np.ceil(t_end*f_rate))))
+        assert t_first == i_first/f_rate
+        assert np.array_equal(samples, indexed.samples[i_kept[i_first]:i_kept[i_first] + np.count_nonzero(~lost[i_first:i_end])])   #pylint: disable=line-too-long
+        lst_expected = []
+        for i in range(i_first, i_end):
+            if lost[i] and (i == i_first or not lost[i-1]):
+                lst_expected.append((int(i_kept[i] - i_kept[i_first]), 0))
+            if lost[i]:
+                lst_expected[-1] = (lst_expected[-1][0], lst_expected[-1][1] + 1)
+        assert lst_holes == lst_expected
+
+
+def test_chunks_round_trip(tmp_path, monkeypatch):
+    """ every codec and filter gives back the samples bit for bit, whole or a range
+        across chunk edges, with floats and ints
+    """
+    monkeypatch.setattr(export, 'CHUNK_BYTES', 4096)
+    for s_format, s_type in (('<f4', 'f'), ('<i2', 'h')):
+        data = array.array(s_type, [(i*37 % 2001) - 1000 for i in range(2*5000)])
+        if s_type == 'f':
+            data[::7] = array.array('f', [x*1e-3 for x in data[::7]])
+        for s_codec in export.CODECS:
+            for s_filter in export.FILTERS:
+                f_name = os.path.join(str(tmp_path), '%s_%s_%s.bin'%(s_type, s_codec, s_filter))
+                writer = export.ChunkWriter(f_name, {'channels': 'XY', 'format': s_format}, '%s:%s'%(s_codec, s_filter), 2)   #pylint: disable=line-too-long
+                writer.write(data[:3000].tobytes())     # not a whole chunk
+                writer.write(data[3000:].tobytes())
+                writer.close()
+                reader = export.ChunkReader(f_name)
+                assert (reader.header['samples'], reader.count_samples) == (5000, 5000)
+                assert reader.read().tobytes() == data.tobytes()
+                assert reader.read(1000, 1500, 2).tobytes() == data[2000:5000].tobytes()